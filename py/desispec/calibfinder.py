@@ -14,6 +14,22 @@ from desispec.util import parse_fibers
 from desiutil.log import get_logger
 
 
+#- parsed yaml files, keyed by filename, with their (modification time, size)
+_yaml_cache = dict()
+
+def _load_yaml(filename):
+    '''
+    Returns the content of yaml file `filename`, only parsing it again if
+    the file was modified since it was last read by this process
+    '''
+    stat = os.stat(filename)
+    filename = os.path.abspath(filename)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if filename not in _yaml_cache or _yaml_cache[filename][0] != version:
+        with open(filename, 'r') as stream:
+            _yaml_cache[filename] = (version, yaml.safe_load(stream))
+    return _yaml_cache[filename][1]
+
 def parse_date_obs(value):
     '''
     converts DATE-OBS keywork to int
@@ -172,9 +188,7 @@ class CalibFinder() :
 
         log.debug("reading calib data in {}".format(yaml_file))
         
-        stream = open(yaml_file, 'r')
-        data   = yaml.safe_load(stream)
-        stream.close()
+        data = _load_yaml(yaml_file)
 
         
         if not cameraid in data :
@@ -233,7 +247,8 @@ class CalibFinder() :
             raise KeyError("Didn't find matching calibration data in %s"%(yaml_file))
 
         
-        self.data = matching_data
+        #- copy since the parsed yaml data are shared by all CalibFinders
+        self.data = dict(matching_data)
                 
     def haskey(self,key) :
         """
@@ -25,18 +25,53 @@ from desispec.spectra import Spectra
 from desispec.resolution import Resolution
 from desispec.fiberbitmasking import get_all_fiberbitmask_with_amp, get_all_nonamp_fiberbitmask_val, get_justamps_fiberbitmask
 
+def _target_groups(targetid, rows=None) :
+    """
+    Sort spectra once by TARGETID to process all targets with segment reductions
+
+    Args:
+       targetid: 1D array of TARGETID of all spectra
+
+    Options:
+       rows: 1D array of indices of the spectra to consider (default is all)
+
+    Returns (sorted_rows, starts, group_targetid) where sorted_rows are the
+    indices of the spectra sorted by TARGETID, starts are the indices in
+    sorted_rows of the first spectrum of each target (to use with
+    np.ufunc.reduceat), and group_targetid the TARGETID of each group.
+    """
+    targetid = np.asarray(targetid)
+    if rows is None :
+        rows = np.arange(targetid.size)
+    sorted_rows = rows[np.argsort(targetid[rows],kind="stable")]
+    group_targetid, starts = np.unique(targetid[sorted_rows],return_index=True)
+    return sorted_rows, starts, group_targetid
+
+def _group_sum_matrix(sorted_rows, starts, nspec) :
+    """
+    Sparse matrix G such that G.dot(x) is the sum of the rows of x of each group
+
+    Args:
+       sorted_rows: indices of the rows sorted by group
+       starts: indices in sorted_rows of the first row of each group
+       nspec: total number of rows of x (rows not in sorted_rows are ignored)
+
+    Returns scipy.sparse.csr_matrix of shape (starts.size, nspec)
+    """
+    counts = np.diff(np.append(starts,sorted_rows.size))
+    group = np.repeat(np.arange(starts.size),counts)
+    return scipy.sparse.csr_matrix((np.ones(sorted_rows.size),(group,sorted_rows)),shape=(starts.size,nspec))
+
 def coadd_fibermap(fibermap) :
 
     log = get_logger()
     log.debug("'coadding' fibermap")
     
-    targets = np.unique(fibermap["TARGETID"])
+    sorted_rows, starts, targets = _target_groups(fibermap["TARGETID"])
     ntarget = targets.size
-    
+    counts = np.diff(np.append(starts,sorted_rows.size))
 
-    jj=np.zeros(ntarget,dtype=int)
-    for i,tid in enumerate(targets) :
-        jj[i]=np.where(fibermap["TARGETID"]==tid)[0][0]
+    jj=sorted_rows[starts]
     tfmap=fibermap[jj]
 
     #- initialize NUMEXP=-1 to check that they all got filled later
@@ -57,42 +92,176 @@ def coadd_fibermap(fibermap) :
             xx = Column(np.arange(ntarget))
             tfmap.add_column(xx,name='NUM_'+k)
 
-    for i,tid in enumerate(targets) :
-        jj = fibermap["TARGETID"]==tid
-
-        #- coadded FIBERSTATUS = bitwise AND of input FIBERSTATUS
-        tfmap['FIBERSTATUS'][i] = np.bitwise_and.reduce(fibermap['FIBERSTATUS'][jj])
-
-        #- Only FIBERSTATUS=0 were included in the coadd
-        fiberstatus_nonamp_bits = get_all_nonamp_fiberbitmask_val()
-        fiberstatus_amp_bits = get_justamps_fiberbitmask()
-        targ_fibstatuses = fibermap['FIBERSTATUS'][jj]
-        nonamp_fiberstatus_flagged = ( (targ_fibstatuses & fiberstatus_nonamp_bits) > 0 )
-        allamps_flagged = ( (targ_fibstatuses & fiberstatus_amp_bits) == fiberstatus_amp_bits )
-        good_coadds = np.bitwise_not( nonamp_fiberstatus_flagged | allamps_flagged )
-        tfmap['COADD_NUMEXP'][i] = np.count_nonzero(good_coadds)
-
-        for k in ['DELTA_X','DELTA_Y'] :
-            if k in fibermap.colnames :
-                vals=fibermap[k][jj]
-                tfmap['MEAN_'+k][i] = np.mean(vals)
-                tfmap['RMS_'+k][i] = np.sqrt(np.mean(vals**2)) # inc. mean offset, not same as std
-
-        for k in ['NIGHT','EXPID','TILEID','SPECTROID','FIBER'] :
-            if k in fibermap.colnames :
-                vals=fibermap[k][jj]
-                tfmap['FIRST_'+k][i] = np.min(vals)
-                tfmap['LAST_'+k][i] = np.max(vals)
-                tfmap['NUM_'+k][i] = np.unique(vals).size
-        for k in ['FIBERASSIGN_X', 'FIBERASSIGN_Y','FIBER_RA', 'FIBER_DEC'] :
-            if k in fibermap.colnames :
-                tfmap[k][i]=np.mean(fibermap[k][jj])
-        for k in ['FIBER_RA_IVAR', 'FIBER_DEC_IVAR','DELTA_X_IVAR', 'DELTA_Y_IVAR'] :
-            if k in fibermap.colnames :
-                tfmap[k][i]=np.sum(fibermap[k][jj])
+    #- coadded FIBERSTATUS = bitwise AND of input FIBERSTATUS
+    fiberstatus = np.asarray(fibermap['FIBERSTATUS'])[sorted_rows]
+    tfmap['FIBERSTATUS'][:] = np.bitwise_and.reduceat(fiberstatus,starts)
+
+    #- Only FIBERSTATUS=0 were included in the coadd
+    fiberstatus_nonamp_bits = get_all_nonamp_fiberbitmask_val()
+    fiberstatus_amp_bits = get_justamps_fiberbitmask()
+    nonamp_fiberstatus_flagged = ( (fiberstatus & fiberstatus_nonamp_bits) > 0 )
+    allamps_flagged = ( (fiberstatus & fiberstatus_amp_bits) == fiberstatus_amp_bits )
+    good_coadds = np.bitwise_not( nonamp_fiberstatus_flagged | allamps_flagged )
+    tfmap['COADD_NUMEXP'][:] = np.add.reduceat(good_coadds.astype(int),starts)
+
+    for k in ['DELTA_X','DELTA_Y'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k],dtype=float)[sorted_rows]
+            tfmap['MEAN_'+k][:] = np.add.reduceat(vals,starts)/counts
+            tfmap['RMS_'+k][:] = np.sqrt(np.add.reduceat(vals**2,starts)/counts) # inc. mean offset, not same as std
+
+    for k in ['NIGHT','EXPID','TILEID','SPECTROID','FIBER'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k])[sorted_rows]
+            tfmap['FIRST_'+k][:] = np.minimum.reduceat(vals,starts)
+            tfmap['LAST_'+k][:] = np.maximum.reduceat(vals,starts)
+            # number of unique values per target: sort values within each target
+            # and count the changes
+            group = np.repeat(np.arange(ntarget),counts)
+            svals = vals[np.lexsort((vals,group))]
+            first = np.ones(svals.size,dtype=int)
+            first[1:] = (svals[1:]!=svals[:-1])
+            first[starts] = 1
+            tfmap['NUM_'+k][:] = np.add.reduceat(first,starts)
+    for k in ['FIBERASSIGN_X', 'FIBERASSIGN_Y','FIBER_RA', 'FIBER_DEC'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k],dtype=float)[sorted_rows]
+            tfmap[k][:]=np.add.reduceat(vals,starts)/counts
+    for k in ['FIBER_RA_IVAR', 'FIBER_DEC_IVAR','DELTA_X_IVAR', 'DELTA_Y_IVAR'] :
+        if k in fibermap.colnames :
+            vals=np.asarray(fibermap[k],dtype=float)[sorted_rows]
+            tfmap[k][:]=np.add.reduceat(vals,starts)
 
     return tfmap
 
+def _cosmics_gradient_outliers(wave, flux, ivar, mask, starts, cosmics_nsig) :
+    """
+    Identify cosmic ray residuals from outliers in the flux gradient among the spectra of each target
+
+    Args:
+       wave: 1D[nwave] wavelength array
+       flux: 2D[nspec,nwave] flux of the spectra sorted by target
+       ivar: 2D[nspec,nwave] inverse variance of the spectra
+       mask: 2D[nspec,nwave] mask or None
+       starts: indices of the first spectrum of each target
+       cosmics_nsig: float, nsigma clipping threshold
+
+    Returns 2D[nspec,nwave] boolean array, True for the flux bins to discard
+    """
+    log = get_logger()
+    nspec,nwave = flux.shape
+    counts = np.diff(np.append(starts,nspec))
+
+    # interpolate over bad measurements
+    # to be able to compute gradient next
+    # to a bad pixel and identify oulier
+    # many cosmics residuals are on edge
+    # of cosmic ray trace, and so can be
+    # next to a masked flux bin
+    if mask is not None :
+        bad = (ivar*(mask==0) <= 0)
+    else :
+        bad = (ivar <= 0)
+    tflux = flux.copy()
+    tivar = ivar.copy()
+    for j in np.where(np.any(bad,axis=1) & ~np.all(bad,axis=1))[0] :
+        good = ~bad[j]
+        tflux[j,bad[j]] = np.interp(wave[bad[j]],wave[good],tflux[j,good])
+        tivar[j,bad[j]] = np.interp(wave[bad[j]],wave[good],tivar[j,good])
+
+    with np.errstate(divide='ignore') :
+        tvar = 1./tivar
+    grad = np.zeros_like(tflux)
+    grad[:,1:] = tflux[:,1:]-tflux[:,:-1]
+    gradvar = tvar.copy()
+    gradvar[:,1:] += tvar[:,:-1]
+    gradivar = 1/gradvar
+
+    outliers = np.zeros(flux.shape,dtype=bool)
+    if np.all(counts<2) :
+        return outliers
+    gsum = _group_sum_matrix(np.arange(nspec),starts,nspec)
+
+    # the weighted mean gradient is normalized by the sum of weights over all spectra and wavelength of the target
+    meangrad = gsum.dot(gradivar*grad)/gsum.dot(np.sum(gradivar,axis=1))[:,None]
+    deltagrad = grad-np.repeat(meangrad,counts,axis=0)
+    chi2_contrib = gradivar*deltagrad**2
+    with np.errstate(divide='ignore',invalid='ignore') :
+        chi2 = gsum.dot(chi2_contrib)/(counts[:,None]-1)
+    t,l = np.where((chi2>cosmics_nsig**2) & (counts[:,None]>1))
+
+    # mask the spectrum with the largest contribution to chi2 for each flagged target and wavelength
+    # (spectra of each target padded to the same number with -1 contributions to use argmax)
+    rows = starts[:,None]+np.arange(np.max(counts))
+    padded = (rows>=np.append(starts[1:],nspec)[:,None])
+    contrib = np.where(padded[t],-1.,chi2_contrib[np.where(padded,0,rows)[t],l[:,None]])
+    k = np.argmax(contrib,axis=1)
+    outliers[rows[t,k],l] = True
+    log.debug("masking {} flux bins".format(t.size))
+    return outliers
+
+def _coadd_band(spectra, b, targets, cosmics_nsig=0.) :
+    """
+    Unnormalized ivar-weighted sums of the spectra of each target for one band
+
+    All targets are processed at once with segment reductions after
+    sorting the spectra by TARGETID.
+
+    Args:
+       spectra: desispec.spectra.Spectra object
+       b: band
+       targets: sorted 1D array of TARGETID to coadd
+
+    Options:
+       cosmics_nsig: float, nsigma clipping threshold for cosmics rays
+
+    Returns dictionary with
+       index: indices in targets of the targets with at least one valid spectrum,
+       ivar_unmasked, ivar, flux, flux_unmasked, rdata and mask (if spectra.mask is not None)
+       for these targets, where the flux and resolution are the ivar-weighted sums.
+    """
+    fiberstatus_bits = get_all_fiberbitmask_with_amp(b)
+    good_fiberstatus = ( (spectra.fibermap["FIBERSTATUS"] & fiberstatus_bits) == 0 )
+    sorted_rows, starts, group_targetid = _target_groups(spectra.fibermap["TARGETID"],np.where(good_fiberstatus)[0])
+
+    #- if all spectra were flagged as bad (FIBERSTATUS != 0)
+    #- the target is not in the groups
+    res = dict()
+    res["index"] = np.searchsorted(targets,group_targetid)
+    if sorted_rows.size == 0 :
+        return res
+
+    nspec = spectra.flux[b].shape[0]
+    flux = spectra.flux[b]
+    ivar = spectra.ivar[b]
+    if spectra.mask is not None :
+        ivarjj = ivar*(spectra.mask[b]==0)
+    else :
+        ivarjj = ivar.copy()
+
+    if cosmics_nsig is not None and cosmics_nsig > 0 :
+        if spectra.mask is not None :
+            mask = spectra.mask[b][sorted_rows]
+        else :
+            mask = None
+        outliers = _cosmics_gradient_outliers(spectra.wave[b],flux[sorted_rows],ivar[sorted_rows],mask,starts,cosmics_nsig)
+        k,l = np.where(outliers)
+        ivarjj[sorted_rows[k],l] = 0.
+
+    gsum = _group_sum_matrix(sorted_rows,starts,nspec)
+    res["ivar_unmasked"] = gsum.dot(ivar)
+    res["ivar"] = gsum.dot(ivarjj)
+    res["flux"] = gsum.dot(ivarjj*flux)
+    res["flux_unmasked"] = gsum.dot(ivar*flux)
+    rdata = spectra.resolution_data[b]
+    trdata = np.zeros((starts.size,rdata.shape[1],rdata.shape[2]),dtype=rdata.dtype)
+    for r in range(rdata.shape[1]) :
+        trdata[:,r] = gsum.dot(ivar*rdata[:,r]) # not sure applying mask is wise here
+    res["rdata"] = trdata
+    if spectra.mask is not None :
+        res["mask"] = np.bitwise_and.reduceat(spectra.mask[b][sorted_rows],starts,axis=0)
+    return res
+
 def coadd(spectra, cosmics_nsig=0.) :
     """
     Coaddition the spectra for each target and each camera. The input spectra is modified.
@@ -118,78 +287,22 @@ def coadd(spectra, cosmics_nsig=0.) :
             tmask=None
         trdata=np.zeros((ntarget,spectra.resolution_data[b].shape[1],nwave),dtype=spectra.resolution_data[b].dtype)
 
-        fiberstatus_bits = get_all_fiberbitmask_with_amp(b)
-        good_fiberstatus = ( (spectra.fibermap["FIBERSTATUS"] & fiberstatus_bits) == 0 )
-        for i,tid in enumerate(targets) :
-            jj=np.where( (spectra.fibermap["TARGETID"]==tid) & good_fiberstatus )[0]
-
-            #- if all spectra were flagged as bad (FIBERSTATUS != 0), contine
-            #- to next target, leaving tflux and tivar=0 for this target
-            if len(jj) == 0:
-                continue
-
-            if cosmics_nsig is not None and cosmics_nsig > 0 :
-                # interpolate over bad measurements
-                # to be able to compute gradient next
-                # to a bad pixel and identify oulier
-                # many cosmics residuals are on edge
-                # of cosmic ray trace, and so can be
-                # next to a masked flux bin
-                grad=[]
-                gradvar=[]
-                for j in jj :
-                    if spectra.mask is not None :
-                        ttivar = spectra.ivar[b][j]*(spectra.mask[b][j]==0)
-                    else :
-                        ttivar = spectra.ivar[b][j]
-                    good = (ttivar>0)
-                    bad  = (ttivar<=0)
-                    ttflux = spectra.flux[b][j]
-                    ttflux[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttflux[good])
-                    ttivar = spectra.ivar[b][j]
-                    ttivar[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttivar[good])
-                    ttvar = 1./ttivar
-                    ttflux[1:] = ttflux[1:]-ttflux[:-1]
-                    ttvar[1:]  = ttvar[1:]+ttvar[:-1]
-                    ttflux[0]  = 0
-                    grad.append(ttflux)
-                    gradvar.append(ttvar)
-
-            tivar_unmasked= np.sum(spectra.ivar[b][jj],axis=0)
-            if spectra.mask is not None :
-                ivarjj=spectra.ivar[b][jj]*(spectra.mask[b][jj]==0)
-            else :
-                ivarjj=spectra.ivar[b][jj]
-            if cosmics_nsig is not None and cosmics_nsig > 0 and len(grad)>1  :
-                grad=np.array(grad)
-                gradivar=1/np.array(gradvar)
-                nspec=grad.shape[0]
-                meangrad=np.sum(gradivar*grad,axis=0)/np.sum(gradivar)
-                deltagrad=grad-meangrad
-                chi2=np.sum(gradivar*deltagrad**2,axis=0)/(nspec-1)
-                
-                for l in np.where(chi2>cosmics_nsig**2)[0]  :
-                    k=np.argmax(gradivar[:,l]*deltagrad[:,l]**2)
-                    #k=np.argmax(flux[:,j])
-                    log.debug("masking spec {} wave={}".format(k,spectra.wave[b][l]))
-                    ivarjj[k][l]=0.
-            
-            tivar[i]=np.sum(ivarjj,axis=0)
-            tflux[i]=np.sum(ivarjj*spectra.flux[b][jj],axis=0)
-            for r in range(spectra.resolution_data[b].shape[1]) :
-                trdata[i,r]=np.sum((spectra.ivar[b][jj]*spectra.resolution_data[b][jj,r]),axis=0) # not sure applying mask is wise here
-            bad=(tivar[i]==0)
-            if np.sum(bad)>0 :
-                tivar[i][bad] = np.sum(spectra.ivar[b][jj][:,bad],axis=0) # if all masked, keep original ivar
-                tflux[i][bad] = np.sum(spectra.ivar[b][jj][:,bad]*spectra.flux[b][jj][:,bad],axis=0)
-            ok=(tivar[i]>0)
-            if np.sum(ok)>0 :
-                tflux[i][ok] /= tivar[i][ok]
-            ok=(tivar_unmasked>0)
-            if np.sum(ok)>0 :
-                trdata[i][:,ok] /= tivar_unmasked[ok]
+        #- targets with all spectra flagged as bad (FIBERSTATUS != 0)
+        #- are left with tflux and tivar=0
+        sums = _coadd_band(spectra,b,targets,cosmics_nsig)
+        ii = sums["index"]
+        if ii.size > 0 :
+            bad = (sums["ivar"]==0)
+            # if all masked, keep original ivar
+            tivar[ii] = np.where(bad,sums["ivar_unmasked"],sums["ivar"])
+            tflux[ii] = np.where(bad,sums["flux_unmasked"],sums["flux"])
             if spectra.mask is not None :
-                tmask[i]      = np.bitwise_and.reduce(spectra.mask[b][jj],axis=0)
+                tmask[ii] = sums["mask"]
+            ok=(tivar>0)
+            tflux[ok] /= tivar[ok]
+            ivar_unmasked = sums["ivar_unmasked"]
+            sums["rdata"] /= np.where(ivar_unmasked>0,ivar_unmasked,1.)[:,None,:]
+            trdata[ii] = sums["rdata"]
         spectra.flux[b] = tflux
         spectra.ivar[b] = tivar
         if spectra.mask is not None :
@@ -247,11 +360,10 @@ def coadd_cameras(spectra,cosmics_nsig=0.) :
     b = sbands[0]
     flux=np.zeros((ntarget,nwave),dtype=spectra.flux[b].dtype)
     ivar=np.zeros((ntarget,nwave),dtype=spectra.ivar[b].dtype)
+    ivar_unmasked=np.zeros((ntarget,nwave),dtype=spectra.ivar[b].dtype)
     if spectra.mask is not None :
-        ivar_unmasked=np.zeros((ntarget,nwave),dtype=spectra.ivar[b].dtype)
         mask=np.zeros((ntarget,nwave),dtype=spectra.mask[b].dtype)
     else :
-        ivar_unmasked=ivar
         mask=None
     
     rdata=np.zeros((ntarget,ndiag,nwave),dtype=spectra.resolution_data[b].dtype)
@@ -264,89 +376,36 @@ def coadd_cameras(spectra,cosmics_nsig=0.) :
 
         band_ndiag = spectra.resolution_data[b].shape[1]
 
-        fiberstatus_bits = get_all_fiberbitmask_with_amp(b)
-        good_fiberstatus = ( (spectra.fibermap["FIBERSTATUS"] & fiberstatus_bits) == 0 )
-        for i,tid in enumerate(targets) :
-            jj=np.where( (spectra.fibermap["TARGETID"]==tid) & good_fiberstatus )[0]
-
-            #- if all spectra were flagged as bad (FIBERSTATUS != 0), contine
-            #- to next target, leaving tflux and tivar=0 for this target
-            if len(jj) == 0:
-                continue
-
-            if cosmics_nsig is not None and cosmics_nsig > 0 :
-                # interpolate over bad measurements
-                # to be able to compute gradient next
-                # to a bad pixel and identify oulier
-                # many cosmics residuals are on edge
-                # of cosmic ray trace, and so can be
-                # next to a masked flux bin
-                grad=[]
-                gradvar=[]
-                for j in jj :
-                    if spectra.mask is not None :
-                        ttivar = spectra.ivar[b][j]*(spectra.mask[b][j]==0)
-                    else :
-                        ttivar = spectra.ivar[b][j]
-                    good = (ttivar>0)
-                    bad  = (ttivar<=0)
-                    ttflux = spectra.flux[b][j]
-                    ttflux[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttflux[good])
-                    ttivar = spectra.ivar[b][j]
-                    ttivar[bad] = np.interp(spectra.wave[b][bad],spectra.wave[b][good],ttivar[good])
-                    ttvar = 1./ttivar
-                    ttflux[1:] = ttflux[1:]-ttflux[:-1]
-                    ttvar[1:]  = ttvar[1:]+ttvar[:-1]
-                    ttflux[0]  = 0
-                    grad.append(ttflux)
-                    gradvar.append(ttvar)
-
-            ivar_unmasked[i,windices] += np.sum(spectra.ivar[b][jj],axis=0)
-
-            if spectra.mask is not None :
-                ivarjj=spectra.ivar[b][jj]*(spectra.mask[b][jj]==0)
-            else :
-                ivarjj=spectra.ivar[b][jj]
+        #- targets with all spectra flagged as bad (FIBERSTATUS != 0)
+        #- are left with flux and ivar=0 for this band
+        sums = _coadd_band(spectra,b,targets,cosmics_nsig)
+        ii = sums["index"]
+        if ii.size == 0 :
+            continue
+        jj = np.ix_(ii,windices)
+
+        ivar_unmasked[jj] += sums["ivar_unmasked"]
+        ivar[jj] += sums["ivar"]
+        flux[jj] += sums["flux"]
+        for r in range(band_ndiag) :
+            rdata[ii[:,None],r+(ndiag-band_ndiag)//2,windices] += sums["rdata"][:,r]
+        if spectra.mask is not None :
+            # this deserves some attention ...
             
-            if cosmics_nsig is not None and cosmics_nsig > 0 and len(grad)>1  :
-                grad=np.array(grad)
-                gradivar=1/np.array(gradvar)
-                nspec=grad.shape[0]
-                meangrad=np.sum(gradivar*grad,axis=0)/np.sum(gradivar)
-                deltagrad=grad-meangrad
-                chi2=np.sum(gradivar*deltagrad**2,axis=0)/(nspec-1)
-                
-                for l in np.where(chi2>cosmics_nsig**2)[0]  :
-                    k=np.argmax(gradivar[:,l]*deltagrad[:,l]**2)
-                    log.debug("masking spec {} wave={}".format(k,spectra.wave[b][l]))
-                    ivarjj[k][l]=0.
-
+            tmpmask=sums["mask"]
             
-            ivar[i,windices] += np.sum(ivarjj,axis=0)
-            flux[i,windices] += np.sum(ivarjj*spectra.flux[b][jj],axis=0)
-            for r in range(band_ndiag) :
-                rdata[i,r+(ndiag-band_ndiag)//2,windices] += np.sum((spectra.ivar[b][jj]*spectra.resolution_data[b][jj,r]),axis=0)
-            if spectra.mask is not None :
-                # this deserves some attention ...
-                
-                tmpmask=np.bitwise_and.reduce(spectra.mask[b][jj],axis=0)
-                
-                # directly copy mask where no overlap
-                jj=(number_of_overlapping_cameras[windices]==1)
-                mask[i,windices[jj]] = tmpmask[jj]
-                
-                # 'and' in overlapping regions
-                jj=(number_of_overlapping_cameras[windices]>1)
-                mask[i,windices[jj]] = mask[i,windices[jj]] & tmpmask[jj]
-                
+            # directly copy mask where no overlap
+            kk=(number_of_overlapping_cameras[windices]==1)
+            mask[np.ix_(ii,windices[kk])] = tmpmask[:,kk]
+            
+            # 'and' in overlapping regions
+            kk=(number_of_overlapping_cameras[windices]>1)
+            mask[np.ix_(ii,windices[kk])] &= tmpmask[:,kk]
                 
-    for i,tid in enumerate(targets) :
-        ok=(ivar[i]>0)
-        if np.sum(ok)>0 :
-            flux[i][ok] /= ivar[i][ok]
-        ok=(ivar_unmasked[i]>0)
-        if np.sum(ok)>0 :
-            rdata[i][:,ok] /= ivar_unmasked[i][ok]
+    ok=(ivar>0)
+    flux[ok] /= ivar[ok]
+    ok=(ivar_unmasked>0)
+    rdata /= np.where(ok,ivar_unmasked,1.)[:,None,:]
 
     if 'COADD_NUMEXP' in spectra.fibermap.colnames:
         fibermap = spectra.fibermap
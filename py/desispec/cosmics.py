@@ -10,11 +10,12 @@ from desiutil.log import get_logger
 import numpy as np
 import math
 import copy
+import os
 import scipy.ndimage
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import numba
-
+from desispec.kernels import jit
 from desispec.maskbits import ccdmask
 from desispec.maskbits import specmask
 from desispec.joincosmics import RepairMask
@@ -62,7 +63,7 @@ def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
     chi2m=dfm**2*(dfm>0)*(tflux>0)/(vm+(vm==0))
         
     for fiber in range(chi2m.shape[0]) :
-        R=frame.R[fiber]
+        Rdata=frame.Rstack.data[fiber]
         
         # potential cosmics 
         selection=np.where( ( (chi2p[fiber]>nsig**2) | (chi2m[fiber]>nsig**2) ) & (peaks[fiber]>0) )[0]
@@ -79,7 +80,7 @@ def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
             errm=np.sqrt(vm[fiber,i])/tflux[fiber,i]
             
             # profile from resolution matrix
-            r  =  R.data[:,i]
+            r  =  Rdata[:,i]
             d  = r.size//2
             rdrp = 1-r[d+1]/r[d]
             rdrm = 1-r[d-1]/r[d]
@@ -105,7 +106,7 @@ def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
                         log.info("fiber {} wave={} S/N={} add cosmic mask of {} pix".format(fiber,int(frame.wave[i]),int(snr),nmasked))
     log.info("done")
 
-@numba.jit(nopython=True)
+@jit('(boolean[:,::1],boolean)')
 def dilate_numba(input_boolean_array,include_input=False) :
     output_boolean_array = np.zeros(input_boolean_array.shape, input_boolean_array.dtype)
     if include_input :
@@ -125,7 +126,80 @@ def dilate_numba(input_boolean_array,include_input=False) :
 
 
 
-@numba.jit(nopython=True)
+@jit()
+def _psf_axes_offsets(naxis) :
+    """Pixel offsets (d0,d1) of the 4 axes: horizontal,vertical and 2 diagonals"""
+    dd = np.zeros((naxis,2),dtype=np.int64)
+    for a in range(naxis) :
+        if a==0 :
+            dd[a,0]=0
+            dd[a,1]=1
+        elif a==1 :
+            dd[a,0]=1
+            dd[a,1]=0
+        elif a==2 :
+            dd[a,0]=1
+            dd[a,1]=1
+        else :
+            dd[a,0]=1
+            dd[a,1]=-1
+    return dd
+
+@jit()
+def _is_cosmic_pixel_numba(pix,ivar,i0,i1,dd,psf_gradients,nsig,cfudge,c2fudge) :
+    """Apply the SDSS/BOSS cosmic ray criteria to the single pixel (i0,i1).
+
+    See _reject_cosmic_rays_ala_sdss_single_numba for the arguments;
+    dd are the axes offsets from _psf_axes_offsets.
+    Returns True if the pixel is rejected.
+    """
+    central_pix_ivar=ivar[i0,i1]
+    if central_pix_ivar<=0 : return False
+
+    # first criterion, signal in pix must be significantly higher than neighbors
+    # in all directions
+    # JG comment : this does not look great for muon tracks that are perfectly aligned
+    # with one the axis. I change the algorithm to accept 2 out of 4 valid tests
+    first_criterion=0
+
+    # second criterion, rejected if at least for one axis
+    # the neighbors average value are not consistent with PSF given the central pixel value
+    # here the number of sigmas is the parameter cfudge
+    # c2fudge alters the PSF
+    second_criterion=False
+
+    central_pix_val=pix[i0,i1]
+    central_pix_err=1/np.sqrt(central_pix_ivar)
+
+    # loop on axis
+    for a in range(dd.shape[0]) :
+
+        # the offsets
+        d0=dd[a,0]
+        d1=dd[a,1]
+
+        neighboring_pix_val=0.
+        neighboring_pix_err=0.
+
+        # compute average value on both sides of central pix
+        for signe in (-1,1) :
+            tmp_ivar = ivar[i0+signe*d0,i1+signe*d1]
+            if tmp_ivar > 0 :
+                neighboring_pix_val  += pix[i0+signe*d0,i1+signe*d1]
+                neighboring_pix_err  += 1/tmp_ivar
+            else : # replace it by the central pixel value
+                neighboring_pix_val  += central_pix_val
+                neighboring_pix_err  += central_pix_err**2
+
+        neighboring_pix_val  *= 0.5 # average value
+        neighboring_pix_err   = np.sqrt(neighboring_pix_err)*0.5 # uncertainty on average value
+
+        first_criterion += (central_pix_val>(neighboring_pix_val+nsig*central_pix_err))
+        second_criterion |= (((central_pix_val-cfudge*central_pix_err)*c2fudge*psf_gradients[a]) > ( neighboring_pix_val+cfudge*neighboring_pix_err ))
+
+    return ( (first_criterion>=2) & second_criterion )
+
+@jit('(float64[:,::1],float64[:,::1],boolean[:,::1],float64[::1],float64,float64,float64)')
 def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
@@ -154,75 +228,108 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
     n1    = pix.shape[1]
     
     # definition of axis
-    naxis = psf_gradients.size
-    dd = np.zeros((naxis,2),dtype=type(n0))
-    for a in range(naxis) :
-        if a==0 : 
-            dd[a,0]=0
-            dd[a,1]=1
-        elif a==1 :
-            dd[a,0]=1
-            dd[a,1]=0
-        elif a==2 :
-            dd[a,0]=1
-            dd[a,1]=1
-        else :
-            dd[a,0]=1
-            dd[a,1]=-1
+    dd = _psf_axes_offsets(psf_gradients.size)
         
     rejection=np.zeros(pix.shape,dtype=type(True))
     
     for i0 in range(1,n0-1) :
         for i1 in range(1,n1-1) :
-            
-            central_pix_ivar=ivar[i0,i1]
-            if (not selection[i0,i1]) or central_pix_ivar<=0 : continue
-            
-            # first criterion, signal in pix must be significantly higher than neighbors
-            # in all directions
-            # JG comment : this does not look great for muon tracks that are perfectly aligned
-            # with one the axis. I change the algorithm to accept 2 out of 4 valid tests
-            first_criterion=0 
-            
-            # second criterion, rejected if at least for one axis
-            # the neighbors average value are not consistent with PSF given the central pixel value
-            # here the number of sigmas is the parameter cfudge
-            # c2fudge alters the PSF
-            second_criterion=False
-            
-            central_pix_val=pix[i0,i1]
-            central_pix_err=1/np.sqrt(central_pix_ivar)
-                        
-            # loop on axis
-            for a in range(naxis) : 
-
-                # the offsets
-                d0=dd[a,0]
-                d1=dd[a,1]
-                
-                neighboring_pix_val=0.
-                neighboring_pix_err=0.
-                
-                # compute average value on both sides of central pix 
-                for signe in [-1,1] :
-                    tmp_ivar = ivar[i0+signe*d0,i1+signe*d1]
-                    if tmp_ivar > 0 :
-                        neighboring_pix_val  += pix[i0+signe*d0,i1+signe*d1]
-                        neighboring_pix_err  += 1/tmp_ivar
-                    else : # replace it by the central pixel value
-                        neighboring_pix_val  += central_pix_val
-                        neighboring_pix_err  += central_pix_err**2
-                
-                neighboring_pix_val  *= 0.5 # average value
-                neighboring_pix_err   = np.sqrt(neighboring_pix_err)*0.5 # uncertainty on average value
-                
-                first_criterion += (central_pix_val>(neighboring_pix_val+nsig*central_pix_err))
-                second_criterion |= (((central_pix_val-cfudge*central_pix_err)*c2fudge*psf_gradients[a]) > ( neighboring_pix_val+cfudge*neighboring_pix_err ))
-            
-            rejection[i0,i1] = ( (first_criterion>=2) & second_criterion )
+            if not selection[i0,i1] : continue
+            rejection[i0,i1] = _is_cosmic_pixel_numba(pix,ivar,i0,i1,dd,psf_gradients,nsig,cfudge,c2fudge)
             
     return rejection
-    
+
+@jit('(float64[:,::1],float64[:,::1],int64[::1],int64[::1],float64[::1],float64,float64,float64)',nogil=True)
+def _reject_cosmic_rays_ala_sdss_sparse_numba(pix,ivar,rows,cols,psf_gradients,nsig,cfudge,c2fudge) :
+    """Same as _reject_cosmic_rays_ala_sdss_single_numba, but only for the
+    candidate pixels (rows[k],cols[k]), which must be at least 1 pixel off
+    from the CCD edge.
+
+    Returns a 1D boolean array, True for the rejected candidates.
+    """
+    dd = _psf_axes_offsets(psf_gradients.size)
+    rejection = np.zeros(rows.size,dtype=type(True))
+    for k in range(rows.size) :
+        rejection[k] = _is_cosmic_pixel_numba(pix,ivar,rows[k],cols[k],dd,psf_gradients,nsig,cfudge,c2fudge)
+    return rejection
+
+def _reject_cosmic_rays_candidates(pix,ivar,rows,cols,psf_gradients,nsig,cfudge,c2fudge,nthreads=None,chunksize=10000) :
+    """Run _reject_cosmic_rays_ala_sdss_sparse_numba on chunks of at least
+    chunksize candidates in nthreads threads (default $OMP_NUM_THREADS or
+    desispec.parallel.default_nproc).
+
+    The numba kernel releases the GIL, and the threads only live during
+    the call, so that the caller can still fork (e.g. desi_preproc --ncpu).
+    """
+    if nthreads is None :
+        if "OMP_NUM_THREADS" in os.environ :
+            nthreads = int(os.environ["OMP_NUM_THREADS"])
+        else :
+            from desispec.parallel import default_nproc
+            nthreads = default_nproc
+    nthreads = max(1,min(nthreads,rows.size//chunksize))
+    if nthreads == 1 :
+        return _reject_cosmic_rays_ala_sdss_sparse_numba(pix,ivar,rows,cols,psf_gradients,nsig,cfudge,c2fudge)
+
+    bounds = np.linspace(0,rows.size,nthreads+1).astype(int)
+    def _run(chunk) :
+        b,e = bounds[chunk],bounds[chunk+1]
+        return _reject_cosmic_rays_ala_sdss_sparse_numba(pix,ivar,rows[b:e],cols[b:e],psf_gradients,nsig,cfudge,c2fudge)
+    with ThreadPoolExecutor(nthreads) as pool :
+        return np.concatenate(list(pool.map(_run,range(nthreads))))
+
+def _neighbor_candidates(rows,cols,rejected) :
+    """Return the (rows,cols) of the 8 neighbors of the pixels (rows,cols)
+    that are not already rejected and at least 1 pixel off from the CCD edge.
+
+    Neighbors shared by several input pixels are only returned once.
+    """
+    n0,n1 = rejected.shape
+    offsets = np.array([-n1-1,-n1,-n1+1,-1,1,n1-1,n1,n1+1])
+    index = np.unique((rows*n1+cols)[:,np.newaxis]+offsets)
+    index = index[(index>=0)&(index<n0*n1)]
+    nrows = index//n1
+    ncols = index%n1
+    keep  = (nrows>0)&(nrows<n0-1)&(ncols>0)&(ncols<n1-1)
+    nrows = nrows[keep]
+    ncols = ncols[keep]
+    keep  = ~rejected[nrows,ncols]
+    return nrows[keep],ncols[keep]
+
+def _repair_mask_tiled(rejected,tile=32) :
+    """Apply repair_mask.repair only around the tiles of the image that
+    contain rejected pixels.
+
+    The binary closure only sets pixels within half a selection element
+    of a rejected pixel, and depends on the mask within a full selection
+    element. The image is divided in tiles of tile x tile pixels; groups of
+    connected tiles containing rejected pixels (and their direct neighbors)
+    are repaired separately with this halo, which gives a result identical
+    to repairing the full image.
+    """
+    halo = max(max(se.se.shape) for se in repair_mask.selems)
+    n0,n1 = rejected.shape
+    repaired = np.zeros(rejected.shape,dtype=rejected.dtype)
+
+    # coarse map of tiles containing rejected pixels
+    t0 = (n0+tile-1)//tile
+    t1 = (n1+tile-1)//tile
+    padded = np.zeros((t0*tile,t1*tile),dtype=bool)
+    padded[:n0,:n1] = rejected
+    occupied = padded.reshape(t0,tile,t1,tile).any(axis=(1,3))
+    if not np.any(occupied) :
+        return repaired
+    occupied = scipy.ndimage.binary_dilation(occupied,structure=np.ones((3,3)))
+    labels,_ = scipy.ndimage.label(occupied,structure=np.ones((3,3)))
+
+    for s0,s1 in scipy.ndimage.find_objects(labels) :
+        b0,e0 = s0.start*tile,min(s0.stop*tile,n0)
+        b1,e1 = s1.start*tile,min(s1.stop*tile,n1)
+        h0,h1 = max(b0-halo,0),max(b1-halo,0)
+        stamp = rejected[h0:min(e0+halo,n0),h1:min(e1+halo,n1)]
+        repaired[b0:e0,b1:e1] |= repair_mask.repair(stamp)[b0-h0:e0-h0,b1-h1:e1-h1]
+    return repaired
+
 def _reject_cosmic_rays_ala_sdss_single(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
@@ -391,7 +498,15 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
     use_numba = True
     
     if use_numba :
-        rejected   = _reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
+        # only test the selected pixels, in parallel threads
+        rows,cols  = np.nonzero(selection[1:-1,1:-1])
+        rows += 1
+        cols += 1
+        newrejected = _reject_cosmic_rays_candidates(img.pix,tivar,rows,cols,psf_gradients,nsig,cfudge,c2fudge)
+        rows = rows[newrejected]
+        cols = cols[newrejected]
+        rejected   = np.zeros(selection.shape,dtype=bool)
+        rejected[rows,cols] = True
     else :
         rejected  = _reject_cosmic_rays_ala_sdss_single(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
     
@@ -402,9 +517,20 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
         
         for iteration in range(niter) :
 
-            # if np.sum(rejected)==0 : break
             if use_numba :
-                neighbors = dilate_numba(rejected,False)
+                # the neighbors of pixels rejected before the previous
+                # iteration have not changed since they were last tested,
+                # so we only need to test the neighbors of the pixels
+                # newly rejected (rows,cols)
+                tivar[rows,cols] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
+                rows,cols = _neighbor_candidates(rows,cols,rejected)
+
+                # rerun with much more strict cuts
+                newrejected = _reject_cosmic_rays_candidates(img.pix,tivar,rows,cols,psf_gradients,3.,0.,c2fudge)
+                rows = rows[newrejected]
+                cols = cols[newrejected]
+                nnew = rows.size
+                rejected[rows,cols] = True
             else :
                 neighbors = np.zeros(rejected.shape,dtype=bool)
                 # left and right neighbors
@@ -417,19 +543,17 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
                 neighbors[:-1,:-1]  |= rejected[1:,1:]
                 neighbors[1:,:-1]  |= rejected[:-1,1:]
                 neighbors[:-1,1:]  |= rejected[1:,:-1]
-            neighbors &= (rejected==False) # excluded already rejected pixel
-            tivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
+                neighbors &= (rejected==False) # excluded already rejected pixel
+                tivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
 
-            # rerun with much more strict cuts
-            if use_numba :
-                newrejected=_reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
-            else :
+                # rerun with much more strict cuts
                 newrejected=_reject_cosmic_rays_ala_sdss_single(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=c2fudge)
-                
-            log.info("at iter %d: %d new pixels rejected"%(iteration,np.sum(newrejected)))
-            if np.sum(newrejected)<1 :            
+                nnew = np.sum(newrejected)
+                rejected |= newrejected
+
+            log.info("at iter %d: %d new pixels rejected"%(iteration,nnew))
+            if nnew<1 :
                 break
-            rejected |= newrejected
         
 
     if dilate :
@@ -451,7 +575,7 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.5,niter=6,dilate
         
         # Apply binary closure repair defined in joincosmics.
         log.debug('Repairing gaps in cosmic ray mask')
-        rejected = repair_mask.repair(rejected)
+        rejected = _repair_mask_tiled(rejected)
 
     t1=time.time()
     log.info("end : {} pixels rejected in {:3.1f} sec".format(np.sum(rejected),t1-t0))
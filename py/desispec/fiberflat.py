@@ -253,15 +253,15 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
             mean_spectrum[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
             log.info("cholesky failes, trying svd inverse in iter {}".format(iteration))
 
+        # convolve the mean spectrum with the resolution of all fibers at once
+        convolved_mean_spectrum = frame.Rstack.dot(mean_spectrum)
+
         for fiber in range(nfibers) :
 
             if np.sum(ivar[fiber]>0)==0 :
                 continue
 
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-
-            M = R.dot(mean_spectrum)
+            M = convolved_mean_spectrum[fiber]
             ok=(M!=0) & (ivar[fiber,:]>0)
             if ok.sum()==0:
                 continue
@@ -329,14 +329,14 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
 
     nsig_for_mask=nsig_clipping # only mask out N sigma outliers
 
+    convolved_mean_spectrum = frame.Rstack.dot(mean_spectrum)
+
     for fiber in range(nfibers) :
 
         if np.sum(ivar[fiber]>0)==0 :
             continue
 
-        ### R = Resolution(resolution_data[fiber])
-        R = frame.R[fiber]
-        M = np.array(np.dot(R.todense(),mean_spectrum)).flatten()
+        M = convolved_mean_spectrum[fiber]
         fiberflat[fiber] = (M!=0)*flux[fiber]/(M+(M==0)) + (M==0)
         fiberflat_ivar[fiber] = ivar[fiber]*M**2
         nbad_tot=0
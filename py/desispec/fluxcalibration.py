@@ -8,9 +8,11 @@ from __future__ import absolute_import
 import numpy as np
 from .resolution import Resolution
 from .linalg import cholesky_solve, cholesky_solve_and_invert, spline_fit
-from .interpolation import resample_flux
+from .interpolation import resample_flux, resampling_matrix
 from desiutil.log import get_logger
 from .io.filters import load_legacy_survey_filter
+from .sky import _weighted_resolution_data, _banded_normal_matrix, _banded_normal_vector
+from .sky import _solve_banded_normal_equation, _banded_parameter_covariance, _convolved_variance
 from desispec import util
 from desitarget.targets import main_cmx_or_sv
 import scipy, scipy.sparse, scipy.ndimage
@@ -18,6 +20,7 @@ import sys
 import time
 from astropy import units
 import multiprocessing
+import collections
 from pkg_resources import resource_exists, resource_filename
 import numpy.linalg
 
@@ -62,7 +65,7 @@ def applySmoothingFilter(flux,width=200) :
     """ Return a smoothed version of the input flux array using a median filter
 
     Args:
-        flux  : 1D array of flux 
+        flux  : 1D array of flux, or 2D array in which case each row is smoothed independently
         width : size of the median filter box
             
     Returns:
@@ -71,6 +74,8 @@ def applySmoothingFilter(flux,width=200) :
 
     # it was checked that the width of the median_filter has little impact on best fit stars
     # smoothing the ouput (with a spline for instance) does not improve the fit
+    if np.ndim(flux) == 2 :
+        return scipy.ndimage.filters.median_filter(flux,(1,width),mode='constant')
     return scipy.ndimage.filters.median_filter(flux,width,mode='constant')
 #
 # Import some global constants.
@@ -127,18 +132,96 @@ def resample_template(data_wave_per_camera,resolution_data_per_camera,template_w
     return template_id,output_wave,output_flux,output_norm
 
 
-def _func(arg) :
-    """ Used for multiprocessing.Pool """
-    return resample_template(**arg)
+#- resampling matrices of the templates for the data wavelength grid of a camera
+#- with log_resampling, cached per process because they do not depend on the
+#- star redshift: the templates are resampled on a log wavelength grid where a
+#- redshift is a shift by an integer number of pixels, then on the camera grid
+_resampling_matrices = collections.OrderedDict()
+_max_resampling_matrices = 16
 
-def _smooth_template(template_id,camera_index,template_flux) :
-    """ Used for multiprocessing.Pool """
-    norme = applySmoothingFilter(template_flux)
-    return template_id,camera_index,norme
+def _get_resampling_matrices(data_wave, template_wave, z_max, z_res) :
+    """ Returns the cached resampling matrices of the templates for data_wave
 
-def _func2(arg) :
-    """ Used for multiprocessing.Pool """
-    return _smooth_template(**arg)
+    Args:
+        data_wave : 1D array of vacuum wavelengths [Angstroms] of a camera
+        template_wave : 1D array, rest frame template wavelength [Angstroms]
+        z_max : float, maximum blueshift and redshift, see redshift_fit
+        z_res : float, step of the redshift scan, see redshift_fit
+
+    Returns:
+        to_log : sparse matrix from template_wave to the log wavelength grid,
+                 extended by margin pixels on both sides
+        from_log : sparse matrix from the log wavelength grid to data_wave
+        margin : int, number of pixels of the extension
+    """
+    key = (data_wave.size, hash(np.asarray(data_wave,dtype=float).tobytes()),
+           template_wave.size, hash(np.asarray(template_wave,dtype=float).tobytes()),
+           z_max, z_res)
+    if key in _resampling_matrices :
+        _resampling_matrices.move_to_end(key)
+    else :
+        # same log wavelength step and margin as redshift_fit
+        lstep=np.log10(1+z_res)
+        margin=int(np.log10(1+z_max)/lstep)+1
+        # the log grid covers the outer boundaries of the first and last data bins
+        minlwave=np.log10(1.5*data_wave[0]-0.5*data_wave[1])-lstep
+        maxlwave=np.log10(1.5*data_wave[-1]-0.5*data_wave[-2])+lstep
+        nstep=int((maxlwave-minlwave)/lstep)+2
+        log_wave=10**(minlwave+lstep*np.arange(-margin,nstep+margin))
+        to_log=resampling_matrix(log_wave,template_wave)
+        from_log=resampling_matrix(data_wave,log_wave[margin:-margin])
+        _resampling_matrices[key] = (to_log,from_log,margin)
+        if len(_resampling_matrices) > _max_resampling_matrices :
+            _resampling_matrices.popitem(last=False)
+    return _resampling_matrices[key]
+
+def resample_templates(data_wave_per_camera,resolution_data_per_camera,template_wave,template_flux,redshift=0.,log_resampling=False,z_max=0.005,z_res=0.00002) :
+    """Same as resample_template for all templates at once.
+
+    Resample the spectral templates on the data wavelength grid of each camera,
+    convolve them by the resolution and divide them by the result of applySmoothingFilter.
+
+    Args:
+        data_wave_per_camera : A dictionary of 1D array of vacuum wavelengths [Angstroms], one entry per camera and exposure.
+        resolution_data_per_camera :  A dictionary of resolution corresponding for the fiber, one entry per camera and exposure.
+        template_wave : 1D array, input spectral template wavelength [Angstroms] (arbitrary spacing).
+        template_flux : 2D[ntemplates,nwave] array, input spectral template flux density.
+        redshift : float, redshift of the templates
+        log_resampling : if True, the templates are resampled through a log
+                   wavelength grid with matrices cached for each camera wavelength
+                   grid, which is faster for many stars but differs from the exact
+                   resampling of the redshifted templates by about 1e-3 of the
+                   normalized flux. The redshift must be one of redshift_fit
+                   with the same z_max and z_res.
+        z_max : float, maximum blueshift and redshift, see redshift_fit
+        z_res : float, step of the redshift scan, see redshift_fit
+
+    Returns:
+        output_wave   : 1D array of vacuum wavelengths, concatenation of the cameras in sorted order
+        output_flux   : 2D[ntemplates,output_wave.size] array of output template normalized flux
+        output_norm   : 2D[ntemplates,output_wave.size] array of output template smoothed flux
+    """
+    sorted_keys = list(data_wave_per_camera.keys())
+    sorted_keys.sort() # force sorting the keys to agree with data
+    output_wave=[]
+    output_flux=[]
+    output_norm=[]
+    if log_resampling :
+        # redshift_fit returns z=10**(-i*lstep)-1 for a shift of i pixels
+        shift=-int(np.rint(np.log10(1+redshift)/np.log10(1+z_res)))
+    for cam in sorted_keys :
+        if not log_resampling :
+            matrix=resampling_matrix(data_wave_per_camera[cam],template_wave*(1+redshift))
+        else :
+            to_log,from_log,margin=_get_resampling_matrices(data_wave_per_camera[cam],template_wave,z_max,z_res)
+            matrix=from_log.dot(to_log[margin+shift:margin+shift+from_log.shape[1]])
+        flux1=matrix.dot(template_flux.T)
+        flux2=Resolution(resolution_data_per_camera[cam]).dot(flux1).T
+        norme=applySmoothingFilter(flux2) # this is slow
+        output_flux.append(flux2/(norme+(norme==0)))
+        output_norm.append(norme)
+        output_wave.append(data_wave_per_camera[cam])
+    return np.hstack(output_wave),np.hstack(output_flux),np.hstack(output_norm)
 
 def redshift_fit(wave, flux, ivar, resolution_data, stdwave, stdflux, z_max=0.005, z_res=0.00005, template_error=0.):
     """ Redshift fit of a single template
@@ -517,7 +600,7 @@ def interpolate_on_parameter_grid(data_wave, data_flux, data_ivar, template_flux
     return final_coefficients,chi2
         
 
-def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, logg, feh, ncpu=1, z_max=0.005, z_res=0.00002, template_error=0):
+def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, logg, feh, ncpu=None, z_max=0.005, z_res=0.00002, template_error=0, log_resampling=False):
     """For each input spectrum, identify which standard star template is the closest
     match, factoring out broadband throughput/calibration differences.
 
@@ -531,7 +614,14 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         teff : 1D[nstd] effective model temperature
         logg : 1D[nstd] model surface gravity
         feh : 1D[nstd] model metallicity
-        ncpu : number of cpu for multiprocessing
+        ncpu : deprecated and ignored, all templates are processed at once;
+               use match_templates_for_stars to fit several stars in parallel
+        z_max : float, maximum blueshift and redshift, see redshift_fit
+        z_res : float, step of the redshift scan, see redshift_fit
+        template_error : float, assumed template flux relative error
+        log_resampling : resample the redshifted templates with cached matrices
+               through a log wavelength grid, see resample_templates; the best
+               fit coefficients and chi2 then differ by less than about 1e-3
 
     Returns:
         coef : numpy.array of linear coefficient of standard stars        
@@ -554,6 +644,8 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
     cameras = list(flux.keys())
     log = get_logger()
     log.debug(time.asctime())
+    if ncpu is not None :
+        log.warning("match_templates ncpu is deprecated and ignored, use match_templates_for_stars to fit several stars in parallel")
 
     # fit continuum and save it
     continuum={}
@@ -647,58 +739,17 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
             
     # now we go back to the model spectra , redshift them, resample, apply resolution, normalize and chi2 match
     
-    ntemplates=stdflux.shape[0]
-
-    # here we take into account the redshift once and for all
-    shifted_stdwave=stdwave*(1+z)
-        
-    func_args = []
-    # need to parallelize the model resampling
-    for template_id in range(ntemplates) :
-        arguments={"data_wave_per_camera":wave,
-                   "resolution_data_per_camera":resolution_data,
-                   "template_wave":shifted_stdwave,
-                   "template_flux":stdflux[template_id],
-                   "template_id":template_id}
-        func_args.append( arguments )
-    
-    
-    if ncpu > 1:
-        log.debug("creating multiprocessing pool with %d cpus"%ncpu); sys.stdout.flush()
-        pool = multiprocessing.Pool(ncpu)
-        log.debug("Running pool.map() for {} items".format(len(func_args))); sys.stdout.flush()
-        results  =  pool.map(_func, func_args)
-        log.debug("Finished pool.map()"); sys.stdout.flush()
-        pool.close()
-        pool.join()
-        log.debug("Finished pool.join()"); sys.stdout.flush()
-    else:
-        log.debug("Not using multiprocessing for {} cpus".format(ncpu))
-        
-        results = [_func(x) for x in func_args]
-        log.debug("Finished serial loop")
-
-    # collect results
-    # in case the exit of the multiprocessing pool is not ordered as the input
-    # we returned the template_id
-    template_flux=np.zeros((ntemplates,data_flux.size))
-    template_norm=np.zeros((ntemplates,data_flux.size))
-    for result in results :
-        template_id       = result[0]
-        template_tmp_wave = result[1]
-        template_tmp_flux = result[2]
-        template_tmp_norm = result[3]
-        mdiff=np.max(np.abs(data_wave-template_tmp_wave)) # just a safety check
-        if mdiff>1.e-5 :
-            log.error("error indexing of wave and flux somewhere above, checking if it's just an ordering issue, max diff=%f"%mdiff)
-            raise ValueError("wavelength array difference cannot be fixed with reordering, ordered max diff=%f"%mdiff)
-        template_flux[template_id] = template_tmp_flux
-        template_norm[template_id] = template_tmp_norm
+    # resample at redshift z, convolve and normalize all the templates at once
+    template_wave,template_flux,template_norm = resample_templates(wave,resolution_data,stdwave,stdflux,
+                                                                   redshift=z,log_resampling=log_resampling,
+                                                                   z_max=z_max,z_res=z_res)
+    mdiff=np.max(np.abs(data_wave-template_wave)) # just a safety check
+    if mdiff>1.e-5 :
+        log.error("error indexing of wave and flux somewhere above, max diff=%f"%mdiff)
+        raise ValueError("wavelength array difference, max diff=%f"%mdiff)
 
     # compute model chi2
-    template_chi2=np.zeros(ntemplates)
-    for template_id in range(ntemplates) :
-        template_chi2[template_id] = np.sum(data_ivar*(data_flux-template_flux[template_id])**2)
+    template_chi2 = np.sum(data_ivar*(data_flux-template_flux)**2,axis=1)
     
     best_model_id=np.argmin(template_chi2) 
     best_chi2=template_chi2[best_model_id]
@@ -723,7 +774,6 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         if c>0 : model += c*t
 
 
-    func_args=[]    
     for index in np.unique(data_index) :
         log.debug("compute calib for cam index %d"%index)
         ii=np.where(data_index==index)[0]
@@ -739,33 +789,11 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
         template_flux[:,ii] *= scalib
         
         # apply this to all the templates and recompute median filter
-        for t in range(template_flux.shape[0]) :
-            arguments={"template_id":t,"camera_index":index,"template_flux":template_flux[t][ii]}
-            func_args.append(arguments)
-    
-    if ncpu > 1:
-        log.debug("divide templates by median filters using multiprocessing.Pool of ncpu=%d"%ncpu)
-        pool = multiprocessing.Pool(ncpu)
-        results  =  pool.map(_func2, func_args)
-        log.debug("finished pool.map()"); sys.stdout.flush()
-        pool.close()
-        pool.join()
-        log.debug("finished pool.join()"); sys.stdout.flush()
-    else :
-        log.debug("divide templates serially")
-        results = [_func2(x) for x in func_args]
-        log.debug("Finished serial loop")
-    
-    # collect results
-    for result in results :
-        template_id = result[0]
-        index  = result[1]
-        template_flux[template_id][data_index==index] /= (result[2] + (result[2]==0))
+        norme = applySmoothingFilter(template_flux[:,ii])
+        template_flux[:,ii] /= (norme + (norme==0))
     
     log.debug("refit the model ...")
-    template_chi2=np.zeros(ntemplates)
-    for template_id in range(ntemplates) :
-        template_chi2[template_id] = np.sum(data_ivar*(data_flux-template_flux[template_id])**2)
+    template_chi2 = np.sum(data_ivar*(data_flux-template_flux)**2,axis=1)
     
     best_model_id=np.argmin(template_chi2) 
     best_chi2=template_chi2[best_model_id]
@@ -780,6 +808,77 @@ def match_templates(wave, flux, ivar, resolution_data, stdwave, stdflux, teff, l
     return coef,z,chi2/ndata
 
 
+#- template grid of the standard star fit worker processes,
+#- set once per process by _init_template_worker
+_worker_templates = None
+
+def _init_template_worker(stdwave, shared_stdflux, stdflux_shape, teff, logg, feh) :
+    """ Used for multiprocessing.Pool initializer, maps the shared memory template flux once per process """
+    global _worker_templates
+    stdflux = np.frombuffer(shared_stdflux, dtype=np.float64).reshape(stdflux_shape)
+    _worker_templates = dict(stdwave=stdwave, stdflux=stdflux, teff=teff, logg=logg, feh=feh)
+
+def _match_templates_worker(arg) :
+    """ Used for multiprocessing.Pool """
+    t = _worker_templates
+    selection = arg["selection"]
+    return match_templates(arg["wave"], arg["flux"], arg["ivar"], arg["resolution_data"],
+                           t["stdwave"], t["stdflux"][selection],
+                           t["teff"][selection], t["logg"][selection], t["feh"][selection],
+                           z_max=arg["z_max"], z_res=arg["z_res"], template_error=arg["template_error"],
+                           log_resampling=arg["log_resampling"])
+
+def match_templates_for_stars(stars, stdwave, stdflux, teff, logg, feh, ncpu=1, z_max=0.005, z_res=0.00002, template_error=0, log_resampling=False):
+    """Run match_templates for several standard stars, in parallel over stars.
+
+    A single pool of ncpu processes is used for all stars. The template flux
+    is copied once in shared memory and mapped by each process, and only the
+    star data and the indices of the selected templates are sent for each star.
+
+    Args:
+        stars : list of dictionaries, one per star, with keys
+            wave, flux, ivar, resolution_data (see match_templates) and
+            selection, 1D array of indices of the templates to fit for this star
+        stdwave : 1D standard star template wavelengths [Angstroms]
+        stdflux : 2D[nstd, nwave] template flux
+        teff : 1D[nstd] effective model temperature
+        logg : 1D[nstd] model surface gravity
+        feh : 1D[nstd] model metallicity
+        ncpu : number of cpu for multiprocessing
+        z_max, z_res, template_error, log_resampling : see match_templates
+
+    Returns:
+        list of (coef, redshift, chi2pdf) results of match_templates, one per star,
+        where coef are the coefficients of the selected templates
+    """
+    log = get_logger()
+    func_args = []
+    for star in stars :
+        arguments = dict(star)
+        arguments.update(z_max=z_max, z_res=z_res, template_error=template_error,
+                         log_resampling=log_resampling)
+        func_args.append(arguments)
+
+    ncpu = min(ncpu,len(func_args))
+    if ncpu > 1:
+        log.debug("creating multiprocessing pool with %d cpus for %d stars"%(ncpu,len(func_args))); sys.stdout.flush()
+        shared_stdflux = multiprocessing.RawArray('d', stdflux.size)
+        np.frombuffer(shared_stdflux, dtype=np.float64).reshape(stdflux.shape)[:] = stdflux
+        pool = multiprocessing.Pool(ncpu, initializer=_init_template_worker,
+                                    initargs=(stdwave, shared_stdflux, stdflux.shape, teff, logg, feh))
+        results = pool.map(_match_templates_worker, func_args, chunksize=1)
+        pool.close()
+        pool.join()
+        log.debug("Finished pool.join()"); sys.stdout.flush()
+    else :
+        results = [match_templates(x["wave"], x["flux"], x["ivar"], x["resolution_data"],
+                                   stdwave, stdflux[x["selection"]],
+                                   teff[x["selection"]], logg[x["selection"]], feh[x["selection"]],
+                                   z_max=z_max, z_res=z_res, template_error=template_error,
+                                   log_resampling=log_resampling) for x in func_args]
+    return results
+
+
 def normalize_templates(stdwave, stdflux, mag, band, photsys):
     """Returns spectra normalized to input magnitudes.
 
@@ -869,12 +968,11 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
 
     # resample model to data grid and convolve by resolution
     model_flux=np.zeros((nstds, nwave))
-    convolved_model_flux=np.zeros((nstds, nwave))
 
     for star in range(nstds) :
         model_flux_index = np.where(input_model_fibers == stdfibers[star])[0][0]
         model_flux[star]=resample_flux(stdstars.wave,input_model_wave,input_model_flux[model_flux_index])
-        convolved_model_flux[star]=stdstars.R[star].dot(model_flux[star])
+    convolved_model_flux=stdstars.Rstack.dot(model_flux)
 
     input_model_flux = None # I shall not use any more the input_model_flux here
 
@@ -898,7 +996,7 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
             badfiber[star] = 1
             continue
 
-        M = median_calib*stdstars.R[star].dot(model_flux[star])
+        M = median_calib*convolved_model_flux[star]
 
         try:
             ii = np.where(M>0.1*np.mean(M))[0]
@@ -938,35 +1036,22 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     sqrtw=np.sqrt(current_ivar)
     sqrtwflux=np.sqrt(current_ivar)*stdstars.flux
 
-    # diagonal sparse matrices
-    D1=scipy.sparse.lil_matrix((nwave,nwave))
-    D2=scipy.sparse.lil_matrix((nwave,nwave))
+    # resolution matrix diagonals of all stars, Rdata[star,k,j] = R[star][j-hw+k,j]
+    Rdata = stdstars.Rstack.data
 
-    
     nout_tot=0
     previous_mean=0.
     for iteration in range(20) :
 
         # fit mean calibration
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # loop on star to handle resolution
-        for star in range(nstds) :
-            if star%10==0 :
-                log.info("iter %d star %d"%(iteration,star))
-
-            if badfiber[star]: continue
-
-            R = stdstars.R[star]
-
-            # diagonal sparse matrix with content = sqrt(ivar)*flat
-            D1.setdiag(sqrtw[star]*smooth_fiber_correction[star])
-            D2.setdiag(model_flux[star])
-            sqrtwmodelR = D1.dot(R.dot(D2)) # chi2 = sum (sqrtw*data_flux -diag(sqrtw)*smooth_fiber_correction*R*diag(model_flux)*calib )
-
-            A = A+(sqrtwmodelR.T*sqrtwmodelR).tocsr()
-            B += sqrtwmodelR.T*sqrtwflux[star]
+        # chi2 = sum_star |sqrtw*data_flux - diag(sqrtw*smooth_fiber_correction)*R*diag(model_flux)*calib|^2
+        # A = sum_star sqrtwmodelR[star]^t sqrtwmodelR[star] is banded, we only
+        # store its lower diagonals, with A_band[d,j] = A[j+d,j] (LAPACK lower band storage)
+        log.info("iter %d accumulating"%iteration)
+        wdata = _weighted_resolution_data(Rdata,sqrtw*smooth_fiber_correction,scale=model_flux)
+        goodfiber = (badfiber==0).astype(float)
+        A_band = _banded_normal_matrix(wdata,fiber_weights=goodfiber)
+        B = _banded_normal_vector(wdata,sqrtwflux,fiber_weights=goodfiber)
 
         if np.sum(current_ivar>0)==0 :
             log.error("null ivar, cannot calibrate this frame")
@@ -977,32 +1062,25 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
         minivar = np.min(current_ivar[current_ivar>0])
         log.debug('min(ivar[ivar>0]) = {}'.format(minivar))
         epsilon = minivar/10000
-        A = epsilon*np.eye(nwave) + A   #- converts sparse A -> dense A
+        A_band[0] += epsilon
         B += median_calib*epsilon
 
         log.info("iter %d solving"%iteration)
-        ### log.debug('cond(A) {:g}'.format(np.linalg.cond(A)))
-        #calibration=cholesky_solve(A, B)
-        w = np.diagonal(A)>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        calibration = B*0
-        try:
-            calibration[w]=cholesky_solve(A_pos_def, B[w])
-        except np.linalg.linalg.LinAlgError :
-            log.info('cholesky fails in iteration {}, trying svd'.format(iteration))
-            calibration[w] = np.linalg.lstsq(A_pos_def,B[w])[0]
+        calibration = _solve_banded_normal_equation(A_band,B,iteration)
 
-        wmask = (np.diagonal(A)<=0)
+        wmask = (A_band[0]<=0)
         if np.sum(wmask)>0 :
+            R = stdstars.R[np.where(badfiber==0)[0][-1]]
             wmask = wmask.astype(float)
             wmask = R.dot(R.dot(wmask))
             bad = np.where(wmask!=0)[0]
             log.info("nbad={}".format(bad.size))
             good = np.where(wmask==0)[0]
             calibration[bad] = np.interp(bad,good,calibration[good],left=0,right=0)
-                
+
         log.info("iter %d fit smooth correction per fiber"%iteration)
+        # convolve the calibrated models of all stars at once
+        convolved_calibrated_model_flux = stdstars.Rstack.dot(calibration*model_flux)
         # fit smooth fiberflat and compute chi2
         for star in range(nstds) :
             if star%10==0 :
@@ -1010,7 +1088,7 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
 
             if badfiber[star]: continue
             
-            M = stdstars.R[star].dot(calibration*model_flux[star])
+            M = convolved_calibrated_model_flux[star]
 
             try:
                 ii = np.where(M>0.1*np.mean(M))[0]
@@ -1108,12 +1186,12 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     log.info("nout tot=%d"%nout_tot)
 
     # solve once again to get deconvolved variance
-    #calibration,calibcovar=cholesky_solve_and_invert(A.todense(),B)
-    calibcovar=np.linalg.inv(A)
-    calibvar=np.diagonal(calibcovar)
+    # only the band of the covariance is needed for the variance of the calibration
+    # and of its convolution with the resolution
+    calibcovar_band=_banded_parameter_covariance(A_band)
+    calibvar=np.array(calibcovar_band[0])
     log.info("mean(var)={0:f}".format(np.mean(calibvar)))
 
-    calibvar=np.array(np.diagonal(calibcovar))
     # apply the mean (as in the iterative loop)
     calibvar *= mean**2
     calibivar=(calibvar>0)/(calibvar+(calibvar==0))
@@ -1123,16 +1201,13 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     mean_res_data=np.mean(frame.resolution_data,axis=0)
     R = Resolution(mean_res_data)
     # compute convolved calib
+    norme = frame.Rstack.dot(np.ones(calibration.shape))
+    ok = (norme>0)
     ccalibration = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        norme = frame.R[i].dot(np.ones(calibration.shape))
-        ok=np.where(norme>0)[0]
-        if ok.size :
-            ccalibration[i][ok]=frame.R[i].dot(calibration)[ok]/norme[ok]
+    ccalibration[ok] = frame.Rstack.dot(calibration)[ok]/norme[ok]
         
     # Use diagonal of mean calibration covariance for output.
-    ccalibcovar=R.dot(calibcovar).dot(R.T.todense())
-    ccalibvar=np.array(np.diagonal(ccalibcovar))
+    ccalibvar=_convolved_variance(R,calibcovar_band)
 
     # apply the mean (as in the iterative loop)
     ccalibvar *= mean**2
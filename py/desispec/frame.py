@@ -11,7 +11,7 @@ import numbers
 import numpy as np
 
 from desispec import util
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 from desiutil.log import get_logger
 from desispec import util
 
@@ -82,7 +82,9 @@ class Frame(object):
             nwave : number of wavelengths, flux.shape[1]
             specmin : minimum fiber number
             R: array of sparse Resolution matrix objects converted
-               from resolution_data
+               from resolution_data (or wsigma), built on first access
+            Rstack: ResolutionStack of all spectra, to apply all the
+               resolution matrices at once
             fibermap: fibermap table if provided
         """
         assert wave.ndim == 1
@@ -118,18 +120,13 @@ class Frame(object):
 
         #- Maybe setup non-None identity matrix resolution matrix instead?
         self.wsigma=wsigma
+        #- R and Rstack are built on first access
         self.resolution_data = resolution_data
         if resolution_data is not None:
             self.wsigma=None #ignore width coefficients if resolution data is given explicitly
             self.ndiag=None 
-            self.R = np.array( [Resolution(r) for r in resolution_data] )
         elif wsigma is not None:
-            from desispec.quicklook.qlresolution import QuickResolution
             assert ndiag is not None
-            r=[]
-            for sigma in wsigma:
-                r.append(QuickResolution(sigma=sigma,ndiag=self.ndiag))
-            self.R=np.array(r)
         else:
             #SK I believe this should be error, but looking at the
             #tests frame objects are allowed to not to have resolution data
@@ -167,6 +164,50 @@ class Frame(object):
         if self.meta is not None:
             self.meta['FIBERMIN'] = np.min(self.fibers)
 
+    @property
+    def resolution_data(self):
+        """3D[nspec, ndiag, nwave] resolution matrix data"""
+        return self._resolution_data
+
+    @resolution_data.setter
+    def resolution_data(self, value):
+        #- R and Rstack are rebuilt from the new data
+        self._resolution_data = value
+        self._R = None
+        self._Rstack = None
+
+    @property
+    def R(self):
+        """array of sparse Resolution matrix objects, one per spectrum"""
+        if self._R is None:
+            if self.resolution_data is not None:
+                self._R = np.array( [Resolution(r) for r in self.resolution_data] )
+            elif self.wsigma is not None:
+                from desispec.quicklook.qlresolution import QuickResolution
+                r=[]
+                for sigma in self.wsigma:
+                    r.append(QuickResolution(sigma=sigma,ndiag=self.ndiag))
+                self._R=np.array(r)
+            else:
+                raise AttributeError("Frame has no resolution data")
+        return self._R
+
+    @R.setter
+    def R(self, value):
+        self._R = value
+        self._Rstack = None
+
+    @property
+    def Rstack(self):
+        """ResolutionStack of all spectra"""
+        if self._Rstack is None:
+            if self.resolution_data is not None:
+                self._Rstack = ResolutionStack(self.resolution_data)
+            else:
+                R = self.R
+                self._Rstack = ResolutionStack(np.array([r.data for r in R]), offsets=R[0].offsets)
+        return self._Rstack
+
     def vet(self):
         """ Perform very basic checks on the frame
         Generally run before writing to disk (or when read)
@@ -228,7 +269,11 @@ class Frame(object):
         scalars or arrays when indexing numpy.ndarray .
         """
         if isinstance(index, numbers.Integral):
-            return Spectrum(self.wave, self.flux[index], self.ivar[index], self.mask[index], self.R[index])
+            if self.resolution_data is not None and self._R is None:
+                R = Resolution(self.resolution_data[index])
+            else:
+                R = self.R[index]
+            return Spectrum(self.wave, self.flux[index], self.ivar[index], self.mask[index], R)
 
         #- convert index to 1d array to maintain dimentionality of sliced arrays
         if not isinstance(index, slice):
@@ -6,6 +6,7 @@ Utility functions for interpolation of spectra over different wavelength grids.
 """
 
 import numpy as np
+import scipy.sparse
 import sys
 from desiutil.log import get_logger
 
@@ -226,3 +227,80 @@ def _unweighted_resample(output_x,input_x,input_flux_density, extrapolate=False)
     
     return np.histogram(trapeze_centers, bins=bins, weights=trapeze_integrals)[0] / binsize
 
+def resampling_matrix(xout, x, extrapolate=False) :
+    """Returns the sparse matrix of the flux conserving resampling of resample_flux
+
+    The resampling of resample_flux (without ivar) is linear in the input flux
+    density, so for a given pair of input and output grids it can be precomputed
+    as a sparse matrix M, and applied at once to many spectra sampled on the same
+    input grid: resample_flux(xout, x, flux) = M.dot(flux) for 1D flux,
+    and M.dot(flux.T).T resamples all the rows of a 2D flux array.
+
+    Args:
+        - xout: output SORTED vector, not necessarily linearly spaced
+        - x: input SORTED vector, not necessarily linearly spaced
+
+    Options:
+        - extrapolate: extrapolate using edge values of input array, default is False,
+          in which case values outside of input array are set to zero.
+
+    Returns:
+        scipy.sparse.csr_matrix of shape (xout.size, x.size)
+    """
+    # this follows step by step _unweighted_resample, replacing node values
+    # by their linear dependence on the input flux densities
+    ox=np.asarray(xout)
+    ix=np.asarray(x,dtype=float)
+    nin=ix.size
+
+    # boundary of output bins
+    bins=np.zeros(ox.size+1)
+    bins[1:-1]=(ox[:-1]+ox[1:])/2.
+    bins[0]=1.5*ox[0]-0.5*ox[1]
+    bins[-1]=1.5*ox[-1]-0.5*ox[-2]
+    binsize = bins[1:]-bins[:-1]
+    if np.any(binsize<=0)  :
+        raise ValueError("Zero or negative bin size")
+
+    # node values at the output bin boundaries, linear interpolation of the input
+    # (with two additional input nodes of zero flux density if we do not extrapolate)
+    tx=bins
+    if not extrapolate :
+        px = np.append(np.append(2*ix[0]-ix[1],ix),2*ix[-1]-ix[-2])
+        pcol = np.arange(-1,nin+1)
+    else :
+        px = ix
+        pcol = np.arange(nin)
+    j = np.clip(np.searchsorted(px,tx,side="right")-1,0,px.size-2)
+    w = np.clip((tx-px[j])/(px[j+1]-px[j]),0.,1.)
+    rows = np.concatenate([np.arange(tx.size),np.arange(tx.size)])
+    cols = np.concatenate([pcol[j],pcol[j+1]])
+    vals = np.concatenate([1-w,w])
+
+    # add input nodes which are inside the node array
+    k=np.where((px>=tx[0])&(px<=tx[-1]))[0]
+    nodes_x = np.append(tx,px[k])
+    rows = np.concatenate([rows,tx.size+np.arange(k.size)])
+    cols = np.concatenate([cols,pcol[k]])
+    vals = np.concatenate([vals,np.ones(k.size)])
+
+    # sort the node array
+    p = nodes_x.argsort()
+    rank = np.empty(p.size,dtype=int)
+    rank[p] = np.arange(p.size)
+    nodes_x = nodes_x[p]
+    valid = (cols>=0)&(cols<nin)&(vals!=0)
+    nodes = scipy.sparse.csr_matrix((vals[valid],(rank[rows[valid]],cols[valid])),shape=(nodes_x.size,nin))
+
+    # integral of individual trapezes, summed in the output bins
+    # of their centers, and divided by the bin size
+    dx = (nodes_x[1:]-nodes_x[:-1])/2.
+    ntrap = dx.size
+    trapezes = scipy.sparse.csr_matrix((np.append(dx,dx),(np.tile(np.arange(ntrap),2),np.append(np.arange(ntrap),np.arange(1,ntrap+1)))),shape=(ntrap,nodes_x.size))
+    centers = (nodes_x[1:]+nodes_x[:-1])/2.
+    b = np.searchsorted(bins,centers,side="right")-1
+    b[centers==bins[-1]] = binsize.size-1
+    inside = (b>=0)&(b<binsize.size)
+    histo = scipy.sparse.csr_matrix((1./binsize[b[inside]],(b[inside],np.where(inside)[0])),shape=(binsize.size,ntrap))
+
+    return (histo.dot(trapezes)).dot(nodes).tocsr()
@@ -13,31 +13,63 @@ import warnings
 warnings.filterwarnings('ignore', message="'.*nanomaggies.* did not parse as fits unit.*")
 warnings.filterwarnings('ignore', message=".*'10\*\*6 arcsec.* did not parse as fits unit.*")
 
-# from .download import download, filepath2url
-from .fiberflat import read_fiberflat, write_fiberflat
-from .fibermap import read_fibermap, write_fibermap, empty_fibermap
-from .filters import load_filter,load_legacy_survey_filter
-from .fluxcalibration import (read_stdstar_templates, write_stdstar_models,
-                              read_stdstar_models, read_flux_calibration,
-                              write_flux_calibration)
-from .spectra import read_spectra, write_spectra, read_frame_as_spectra
-from .frame import read_meta_frame, read_frame, write_frame
-from .xytraceset import read_xytraceset, write_xytraceset
-from .image import read_image, write_image
-from .meta import (findfile, get_exposures, get_files, get_raw_files,
-                   rawdata_root, specprod_root, validate_night, qaprod_root,
-                   get_pipe_rundir, get_pipe_scriptdir, get_pipe_database,
-                   get_pipe_logdir, get_reduced_frames, get_pipe_pixeldir,
-                   get_nights, get_pipe_nightdir, find_exposure_night)
-from .params import read_params
-from .qa import (read_qa_frame, read_qa_data, write_qa_frame, write_qa_brick,
-                 load_qa_frame, write_qa_exposure, write_qa_multiexp, load_qa_multiexp,
-                 qafile_from_framefile)
-from .raw import read_raw, write_raw
-from .sky import read_sky, write_sky
-from .util import (header2wave, fitsheader, native_endian, makepath,
-                   write_bintable, iterfiles, healpix_degrade_fixed,
-                   healpix_subdirectory)
+# The I/O functions are imported from their submodule on first access
+# (PEP 562), so that e.g. importing findfile does not pull in astropy,
+# fitsio and the QA readers.  Map public name -> submodule.
+_public_api = {
+    # from .download import download, filepath2url
+    'fiberflat': ('read_fiberflat', 'write_fiberflat'),
+    'fibermap': ('read_fibermap', 'write_fibermap', 'empty_fibermap'),
+    'filters': ('load_filter', 'load_legacy_survey_filter'),
+    'fluxcalibration': ('read_stdstar_templates', 'write_stdstar_models',
+                        'read_stdstar_models', 'read_flux_calibration',
+                        'write_flux_calibration'),
+    'spectra': ('read_spectra', 'write_spectra', 'read_frame_as_spectra'),
+    'frame': ('read_meta_frame', 'read_frame', 'write_frame'),
+    'xytraceset': ('read_xytraceset', 'write_xytraceset'),
+    'image': ('read_image', 'write_image'),
+    'meta': ('findfile', 'get_exposures', 'get_files', 'get_raw_files',
+             'rawdata_root', 'specprod_root', 'validate_night', 'qaprod_root',
+             'get_pipe_rundir', 'get_pipe_scriptdir', 'get_pipe_database',
+             'get_pipe_logdir', 'get_reduced_frames', 'get_pipe_pixeldir',
+             'get_nights', 'get_pipe_nightdir', 'find_exposure_night'),
+    'params': ('read_params',),
+    'qa': ('read_qa_frame', 'read_qa_data', 'write_qa_frame', 'write_qa_brick',
+           'load_qa_frame', 'write_qa_exposure', 'write_qa_multiexp',
+           'load_qa_multiexp', 'qafile_from_framefile', 'qastore_from_qafile',
+           'write_qa_store', 'read_qa_store', 'query_qa_store',
+           'convert_qa_yaml'),
+    'raw': ('read_raw', 'read_raw_data', 'write_raw'),
+    'sky': ('read_sky', 'write_sky'),
+    'util': ('header2wave', 'fitsheader', 'native_endian', 'makepath',
+             'write_bintable', 'iterfiles', 'healpix_degrade_fixed',
+             'healpix_subdirectory'),
+}
+
+_name2module = {name: module for module, names in _public_api.items()
+                for name in names}
+
+__all__ = sorted(_name2module)
+
+
+def __getattr__(name):
+    """Import the public functions, and the submodules that were previously
+    imported by this package, on first access.
+    """
+    from importlib import import_module
+    if name in _name2module:
+        module = import_module('.' + _name2module[name], __name__)
+        value = getattr(module, name)
+    elif name in _public_api:
+        value = import_module('.' + name, __name__)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_name2module) | set(_public_api))
 
 # Why is this even here?
 # Commented out by JXP as this causes a circular import on Python 3.7
@@ -89,6 +89,7 @@ def findfile(filetype, night=None, expid=None, camera=None, tile=None, groupname
         # Note: coadd naming convention and location needs to be resolved, path may change.
         #
         zcatalog = '{specprod_dir}/zcatalog-{specprod}.fits',
+        exp2healpix = '{specprod_dir}/spectra-{nside:d}/exp2healpix-{nside:d}.fits',
         coadd = '{specprod_dir}/spectra-{nside:d}/{hpixdir}/coadd-{nside:d}-{groupname}.fits',
         redrock = '{specprod_dir}/spectra-{nside:d}/{hpixdir}/redrock-{nside:d}-{groupname}.h5',
         spectra = '{specprod_dir}/spectra-{nside:d}/{hpixdir}/spectra-{nside:d}-{groupname}.fits',
@@ -108,6 +109,7 @@ def findfile(filetype, night=None, expid=None, camera=None, tile=None, groupname
         qa_calib_html = '{qaprod_dir}/calib2d/qa-calib2d.html',
         qa_calib_exp = '{qaprod_dir}/calib2d/{night}/qa-{expid:08d}.yaml',
         qa_calib_exp_html = '{qaprod_dir}/calib2d/{night}/qa-{expid:08d}.html',
+        qa_store = '{qaprod_dir}/metrics/qa-metrics-{night}.sqlite',
         qa_exposures_html = '{qaprod_dir}/exposures/qa-exposures.html',
         qa_exposure_html = '{qaprod_dir}/exposures/{night}/{expid:08d}/qa-{expid:08d}.html',
         qa_flat_fig = '{qaprod_dir}/calib2d/{night}/qa-flat-{camera}-{expid:08d}.png',
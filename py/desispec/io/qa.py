@@ -42,6 +42,33 @@ def qafile_from_framefile(frame_file, qaprod_dir=None, output_dir=None):
     return qafile, qatype
 
 
+def qastore_from_qafile(qafile, qaframe):
+    """ QA store of the night of a frame QA file, if it is in the QA production
+
+    Args:
+        qafile: str
+        qaframe: QA_Frame object
+
+    Returns:
+        store : str or None
+          findfile('qa_store') of the night if qafile is the default QA file
+          of the frame, otherwise None (QA written elsewhere)
+    """
+    if qaframe.flavor in ['flat', 'arc']:
+        qatype = 'qa_calib'
+    else:
+        qatype = 'qa_data'
+    try:
+        default = findfile(qatype, night=qaframe.night, camera=qaframe.camera,
+                           expid=qaframe.expid)
+    except KeyError:
+        # No $DESI_SPECTRO_REDUX or $SPECPROD
+        return None
+    if os.path.abspath(qafile) != os.path.abspath(default):
+        return None
+    return findfile('qa_store', night=qaframe.night)
+
+
 def read_qa_data(filename):
     """Read data from a QA file
     """
@@ -157,7 +184,7 @@ def write_qa_brick(outfile, qabrick):
     return outfile
 
 
-def write_qa_frame(outfile, qaframe, verbose=False):
+def write_qa_frame(outfile, qaframe, verbose=False, store=None):
     """Write QA for a given frame
 
     Args:
@@ -165,6 +192,11 @@ def write_qa_frame(outfile, qaframe, verbose=False):
           filename
         qa_exp : QA_Frame object, with the following attributes
             qa_data: dict of QA info
+        store : str, optional
+          QA store of the night, where the QA is also written
+          (see write_qa_store and qastore_from_qafile).  Failures to
+          write the store, e.g. when it stays locked by other writers,
+          are logged and do not fail the frame QA.
     """
     log=get_logger()
     outfile = makepath(outfile, 'qa')
@@ -178,6 +210,13 @@ def write_qa_frame(outfile, qaframe, verbose=False):
         yamlf.write(yaml.dump(ydict))
     if verbose:
         log.info("Wrote QA frame file: {:s}".format(outfile))
+    if store is not None:
+        import sqlite3
+        try:
+            write_qa_store(store, odict)
+        except sqlite3.Error as err:
+            log.error("Failed to write QA of {:s} to the QA store {:s}: {}".format(
+                outfile, store, err))
 
     return outfile
 
@@ -261,6 +300,276 @@ def write_qa_multiexp(outroot, mdict, indent=True):
     return outfile
 
 
+#- Columns of the rows of the QA store which are not metrics
+_qa_store_keys = ('NIGHT', 'EXPID', 'CAMERA', 'QATYPE', 'FLAVOR', 'PARAMS')
+
+
+def _qa_store_connect(filename):
+    """Open a QA store, creating its tables if needed
+    """
+    import sqlite3
+    # Frames of a night may be written at the same time by several processes
+    conn = sqlite3.connect(filename, timeout=60.)
+    conn.execute('CREATE TABLE IF NOT EXISTS frames (NIGHT TEXT, EXPID INTEGER, '
+                 'CAMERA TEXT, QATYPE TEXT, FLAVOR TEXT, PARAMS TEXT, '
+                 'PRIMARY KEY (NIGHT, EXPID, CAMERA, QATYPE))')
+    conn.execute('CREATE TABLE IF NOT EXISTS exposures (NIGHT TEXT, EXPID INTEGER, '
+                 'FLAVOR TEXT, META TEXT, PRIMARY KEY (NIGHT, EXPID))')
+    return conn
+
+
+def _qa_store_column(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _qa_store_columns(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+
+
+def _qa_store_value(value):
+    # Scalars are stored as is, lists and dicts as JSON strings
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value)
+    return value
+
+
+def _qa_store_decode(value):
+    if isinstance(value, str) and value[:1] in ('[', '{'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _qa_store_insert(conn, table, rows):
+    """Insert or replace rows (list of dict) in a table of the QA store,
+    adding the missing columns
+    """
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    # Column names are case insensitive in SQLite
+    existing = set(name.upper() for name in _qa_store_columns(conn, table))
+    for key in columns:
+        if key.upper() not in existing:
+            conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(table, _qa_store_column(key)))
+            existing.add(key.upper())
+    query = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join(_qa_store_column(key) for key in columns),
+        ', '.join('?'*len(columns)))
+    conn.executemany(query, [tuple(row.get(key) for key in columns) for row in rows])
+
+
+def write_qa_store(filename, mdict):
+    """Write QA into the QA store of a night
+
+    The store is a SQLite file with a table of frames, with one row
+    per NIGHT, EXPID, CAMERA and QATYPE and one column per metric, and
+    a table of exposures, with one column per meta data.  Rows already
+    in the store are replaced.
+
+    Args:
+        filename : str
+        mdict : dict or list of dict
+          QA as {night: {expid: {'flavor': str, 'meta': dict,
+          camera: {qatype: {'PARAMS': dict, 'METRICS': dict}}}}},
+          e.g. from write_qa_exposure(ret_dict=True), read_qa_data()
+          or load_qa_multiexp().  'meta' is optional.  The dicts of
+          a list are written in order, in a single transaction.
+
+    Returns:
+        filename : str
+    """
+    log = get_logger()
+    filename = makepath(filename, 'qa')
+
+    if isinstance(mdict, dict):
+        mdict = [mdict]
+    frame_rows = []
+    exp_rows = []
+    for ydict in yamlify(mdict):
+        for night in ydict:
+            for expid in ydict[night]:
+                edict = ydict[night][expid]
+                flavor = edict.get('flavor')
+                if 'meta' in edict:
+                    row = dict((key, _qa_store_value(value)) for key, value in edict['meta'].items())
+                    row.setdefault('FLAVOR', flavor)
+                    row.update(NIGHT=str(night), EXPID=int(expid), META=json.dumps(edict['meta']))
+                    exp_rows.append(row)
+                for camera in edict:
+                    if camera in ['flavor', 'meta']:
+                        continue
+                    for qatype, qadict in edict[camera].items():
+                        row = dict(NIGHT=str(night), EXPID=int(expid), CAMERA=camera,
+                                   QATYPE=qatype, FLAVOR=flavor)
+                        if 'PARAMS' in qadict:
+                            row['PARAMS'] = json.dumps(qadict['PARAMS'])
+                        for metric, value in qadict.get('METRICS', {}).items():
+                            if metric.upper() in _qa_store_keys:
+                                log.warning("Metric {} of {} not stored, its name is a key of the QA store".format(metric, qatype))
+                                continue
+                            row[metric] = _qa_store_value(value)
+                        frame_rows.append(row)
+
+    conn = _qa_store_connect(filename)
+    try:
+        with conn:
+            if len(frame_rows) > 0:
+                _qa_store_insert(conn, 'frames', frame_rows)
+            if len(exp_rows) > 0:
+                _qa_store_insert(conn, 'exposures', exp_rows)
+    finally:
+        conn.close()
+    log.debug("Wrote {:d} rows of QA in {:s}".format(len(frame_rows)+len(exp_rows), filename))
+
+    return filename
+
+
+def read_qa_store(filenames):
+    """Read QA stores back into a dict
+
+    Args:
+        filenames : str or list of str
+
+    Returns:
+        mdict : dict
+          Same format as load_qa_multiexp(), with str expid keys
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    mdict = {}
+    for filename in filenames:
+        conn = _qa_store_connect(filename)
+        try:
+            cursor = conn.execute('SELECT * FROM frames')
+            columns = [item[0] for item in cursor.description]
+            metrics = [(i, name) for i, name in enumerate(columns) if name not in _qa_store_keys]
+            for values in cursor:
+                row = dict(zip(columns, values))
+                edict = mdict.setdefault(row['NIGHT'], {}).setdefault(str(row['EXPID']), {})
+                edict['flavor'] = row['FLAVOR']
+                qadict = dict(METRICS=dict((name, _qa_store_decode(values[i]))
+                                           for i, name in metrics if values[i] is not None))
+                if row['PARAMS'] is not None:
+                    qadict['PARAMS'] = json.loads(row['PARAMS'])
+                edict.setdefault(row['CAMERA'], {})[row['QATYPE']] = qadict
+            for night, expid, flavor, meta in conn.execute('SELECT NIGHT, EXPID, FLAVOR, META FROM exposures'):
+                edict = mdict.setdefault(night, {}).setdefault(str(expid), {})
+                edict.setdefault('flavor', flavor)
+                edict['meta'] = json.loads(meta)
+        finally:
+            conn.close()
+    return mdict
+
+
+def query_qa_store(filenames, qatype, metric, nights='all', channels='all'):
+    """Read the values of one QA metric from QA stores
+
+    Args:
+        filenames : str or list of str
+        qatype : str
+          FIBERFLAT, SKYSUB, ...
+        metric : str
+        nights : str or list of str, optional
+        channels : str or list of str, optional
+          'b', 'r', 'z'
+
+    Returns:
+        qa_tbl : Table
+          Same as QA_MultiExp.get_qa_table(), with columns metric,
+          EXPID, CAMERA, NIGHT and the exposure meta data.
+          Empty if none of the QA matches.
+    """
+    from astropy.table import Table
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    #- Columns of the table, filled file by file
+    columns = {}
+    nrows = 0
+    for filename in filenames:
+        conn = _qa_store_connect(filename)
+        try:
+            frame_columns = [name.upper() for name in _qa_store_columns(conn, 'frames')]
+            if (metric.upper() not in frame_columns) or (metric.upper() in _qa_store_keys):
+                continue
+            exp_columns = [name for name in _qa_store_columns(conn, 'exposures')
+                           if name not in ['NIGHT', 'EXPID', 'META']]
+            query = ('SELECT f.{}, f.EXPID, f.CAMERA, f.NIGHT{} FROM frames f '
+                     'LEFT JOIN exposures e ON f.NIGHT = e.NIGHT AND f.EXPID = e.EXPID '
+                     'WHERE f.QATYPE = ? AND f.{} IS NOT NULL').format(
+                _qa_store_column(metric),
+                ''.join(', e.'+_qa_store_column(name) for name in exp_columns),
+                _qa_store_column(metric))
+            args = [qatype]
+            if nights != 'all':
+                query += ' AND f.NIGHT IN ({})'.format(', '.join('?'*len(nights)))
+                args += list(nights)
+            if channels != 'all':
+                query += ' AND substr(f.CAMERA, 1, 1) IN ({})'.format(', '.join('?'*len(channels)))
+                args += list(channels)
+            query += ' ORDER BY f.NIGHT, f.EXPID, f.CAMERA'
+            values = conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+        if len(values) == 0:
+            continue
+        for name, column in zip([metric, 'EXPID', 'CAMERA', 'NIGHT']+exp_columns, zip(*values)):
+            # Columns missing in the previous files
+            columns.setdefault(name, [None]*nrows).extend(column)
+        nrows += len(values)
+        for column in columns.values():
+            if len(column) < nrows:
+                column.extend([None]*(nrows-len(column)))
+
+    qa_tbl = Table()
+    if nrows == 0:  # Empty?
+        return qa_tbl
+    for name, column in columns.items():
+        column = [_qa_store_decode(val) for val in column]
+        if name == metric:
+            column = [(val[0] if isinstance(val, list) else val) for val in column]
+        qa_tbl[name] = column
+    return qa_tbl
+
+
+def convert_qa_yaml(qaprod_dir, night, outfile=None):
+    """Write the QA files of a night (slurped JSON file, exposure and
+    frame YAML files) into the QA store of the night
+
+    Args:
+        qaprod_dir : str
+        night : str
+        outfile : str, optional
+          Over-ride the default QA store filename
+
+    Returns:
+        outfile : str, or None if the night has no QA file
+    """
+    import glob
+    log = get_logger()
+    if outfile is None:
+        outfile = findfile('qa_store', night=night, qaprod_dir=qaprod_dir)
+    # The frame files are more recent than the slurped file, if any
+    qafiles = sorted(glob.glob(os.path.join(qaprod_dir, 'exposures', night, '*', 'qa-*.yaml')))
+    qafiles += sorted(glob.glob(os.path.join(qaprod_dir, 'calib2d', night, 'qa-*.yaml')))
+    mdicts = []
+    slurp_root = os.path.join(qaprod_dir, night+'_qa')
+    if os.path.isfile(slurp_root+'.json'):
+        mdicts.append(load_qa_multiexp(slurp_root))
+    for qafile in qafiles:
+        mdicts.append(read_qa_data(qafile))
+    if len(mdicts) == 0:
+        log.info("No QA file for night {}".format(night))
+        return None
+    write_qa_store(outfile, mdicts)
+    log.info("Wrote {:d} QA files of night {} in {:s}".format(len(mdicts), night, outfile))
+    return outfile
+
+
 def write_qa_ql(outfile, qaresult):
     """Write QL output files
 
@@ -18,7 +18,7 @@ from desiutil.log import get_logger
 from desispec.calibfinder import parse_date_obs, CalibFinder 
 import desispec.maskbits as maskbits
 
-def read_raw(filename, camera, fibermapfile=None, **kwargs):
+def read_raw(filename, camera, fibermapfile=None, fibermap=None, rawdata=None, **kwargs):
     '''
     Returns preprocessed raw data from `camera` extension of `filename`
 
@@ -28,6 +28,12 @@ def read_raw(filename, camera, fibermapfile=None, **kwargs):
 
     Options:
         fibermapfile : read fibermap from this file; if None create blank fm
+        fibermap : fibermap table of all cameras to use instead of reading
+            fibermapfile, e.g. to read it only once for all cameras
+        rawdata : (rawimage, header, primary_header) of `camera` returned by
+            read_raw_data, to use instead of reading filename
+        fill_header : add the header keywords of these HDUs to the camera
+            header, see read_raw_data; if not set, no keyword is added
         Other keyword arguments are passed to desispec.preproc.preproc(),
         e.g. bias, pixflat, mask.  See preproc() documentation for details.
 
@@ -35,66 +41,25 @@ def read_raw(filename, camera, fibermapfile=None, **kwargs):
     '''
     
     log = get_logger()
-    
-    fx = fits.open(filename, memmap=False)
-    if camera.upper() not in fx:
-        raise IOError('Camera {} not in {}'.format(camera, filename))
-
-    rawimage = fx[camera.upper()].data
-    header = fx[camera.upper()].header
-    hdu=0
-    while True :
-        primary_header= fx[hdu].header
-        if "EXPTIME" in primary_header : break
-
-        if len(fx)>hdu+1 :
-            log.warning("Did not find header keyword EXPTIME in hdu {}, moving to the next".format(hdu))
-            hdu +=1 
-        else :
-            log.error("Did not find header keyword EXPTIME in any HDU of {}".format(filename))
-            raise KeyError("Did not find header keyword EXPTIME in any HDU of {}".format(filename))
-    
-    blacklist = ["EXTEND","SIMPLE","NAXIS1","NAXIS2","CHECKSUM","DATASUM","XTENSION","EXTNAME","COMMENT"]
-    if 'INHERIT' in header and header['INHERIT']:
-        h0 = fx[0].header
-        for key in h0:
-            if ( key not in blacklist ) and ( key not in header ):
-                header[key] = h0[key]
 
     if "fill_header" in kwargs :
-        hdus = kwargs["fill_header"]
-
-        if hdus is None :
-            hdus=[0,]
-            if "PLC" in fx :
-                hdus.append("PLC")
-        
-        if hdus is not None :
-            log.info("will add header keywords from hdus %s"%str(hdus))
-            for hdu in hdus :
-                try :
-                    ihdu = int(hdu)
-                    hdu = ihdu
-                except ValueError:
-                    pass
-                if hdu in fx :
-                    hdu_header = fx[hdu].header
-                    for key in hdu_header:
-                        if ( key not in blacklist ) and ( key not in header ) :
-                            log.debug("adding {} = {}".format(key,hdu_header[key]))
-                            header[key] = hdu_header[key]                        
-                        else :
-                            log.debug("key %s already in header or blacklisted"%key)
-                else :
-                    log.warning("warning HDU %s not in fits file"%str(hdu))
+        fill_header = kwargs.pop("fill_header")
+    else :
+        fill_header = False
 
-        kwargs.pop("fill_header")
+    if rawdata is None :
+        rawdata = read_raw_data(filename, [camera,], fill_header=fill_header)
+        if camera.upper() not in rawdata :
+            raise IOError('Camera {} not in {}'.format(camera, filename))
+        rawdata = rawdata[camera.upper()]
 
-    fx.close()
+    rawimage, header, primary_header = rawdata
 
     img = desispec.preproc.preproc(rawimage, header, primary_header, **kwargs)
 
-    if fibermapfile is not None and os.path.exists(fibermapfile):
+    if fibermap is not None:
+        pass
+    elif fibermapfile is not None and os.path.exists(fibermapfile):
         fibermap = desispec.io.read_fibermap(fibermapfile)
     else:
         log.warning('creating blank fibermap')
@@ -174,6 +139,101 @@ def read_raw(filename, camera, fibermapfile=None, **kwargs):
 
     return img
 
+def read_raw_data(filename, cameras, fill_header=False, nthreads=1):
+    '''
+    Returns the raw images and headers of `cameras` in `filename`, opening
+    the file only once for all of them
+
+    Args:
+        filename : input fits filename with DESI raw data
+        cameras : list of camera names (B0,R1, .. Z9) or FITS extension names
+
+    Options:
+        fill_header : add the header keywords of these HDUs (names or numbers)
+            to the camera headers; None for the primary and PLC HDUs, False
+            to not add any keyword
+        nthreads : number of threads decompressing the camera HDUs
+
+    Returns dict of (rawimage, header, primary_header) keyed by upper case
+    camera name, for the cameras found in the file
+    '''
+
+    log = get_logger()
+
+    fx = fits.open(filename, memmap=False)
+    hdu=0
+    while True :
+        primary_header= fx[hdu].header
+        if "EXPTIME" in primary_header : break
+
+        if len(fx)>hdu+1 :
+            log.warning("Did not find header keyword EXPTIME in hdu {}, moving to the next".format(hdu))
+            hdu +=1 
+        else :
+            log.error("Did not find header keyword EXPTIME in any HDU of {}".format(filename))
+            raise KeyError("Did not find header keyword EXPTIME in any HDU of {}".format(filename))
+
+    #- plain Headers instead of CompImageHeaders, to send them to other processes
+    primary_header = fits.Header(primary_header.cards)
+
+    cameras = [camera.upper() for camera in cameras if camera.upper() in fx]
+
+    blacklist = ["EXTEND","SIMPLE","NAXIS1","NAXIS2","CHECKSUM","DATASUM","XTENSION","EXTNAME","COMMENT"]
+    if fill_header is None :
+        fill_header=[0,]
+        if "PLC" in fx :
+            fill_header.append("PLC")
+    if fill_header is not False :
+        log.info("will add header keywords from hdus %s"%str(fill_header))
+
+    headers = dict()
+    for camera in cameras :
+        header = fits.Header(fx[camera].header.cards)
+        if 'INHERIT' in header and header['INHERIT']:
+            h0 = fx[0].header
+            for key in h0:
+                if ( key not in blacklist ) and ( key not in header ):
+                    header[key] = h0[key]
+
+        if fill_header is not False :
+            for hdu in fill_header :
+                try :
+                    ihdu = int(hdu)
+                    hdu = ihdu
+                except ValueError:
+                    pass
+                if hdu in fx :
+                    hdu_header = fx[hdu].header
+                    for key in hdu_header:
+                        if ( key not in blacklist ) and ( key not in header ) :
+                            log.debug("adding {} = {}".format(key,hdu_header[key]))
+                            header[key] = hdu_header[key]                        
+                        else :
+                            log.debug("key %s already in header or blacklisted"%key)
+                else :
+                    log.warning("warning HDU %s not in fits file"%str(hdu))
+        headers[camera] = header
+
+    if nthreads > 1 and len(cameras) > 1 :
+        #- decompress the images in threads, each with its own file handle
+        def read_image(camera):
+            with fits.open(filename, memmap=False) as cfx:
+                return cfx[camera].data
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(nthreads) as executor:
+            images = list(executor.map(read_image, cameras))
+    else :
+        images = [fx[camera].data for camera in cameras]
+
+    fx.close()
+
+    rawdata = dict()
+    for camera, image in zip(cameras, images) :
+        rawdata[camera] = (image, headers[camera], primary_header)
+
+    return rawdata
+
 def write_raw(filename, rawdata, header, camera=None, primary_header=None):
     '''
     Write raw pixel data to a DESI raw data file
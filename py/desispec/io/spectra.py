@@ -17,19 +17,20 @@ import time
 import numpy as np
 import astropy.units as u
 import astropy.io.fits as fits
-from astropy.table import Table
+from astropy.table import Table, vstack
 
 from desiutil.depend import add_dependencies
 from desiutil.io import encode_table
 
 from .util import fitsheader, native_endian, add_columns
+from .util import append_fits_extensions, appended_extensions
 
 from .frame import read_frame
 from .fibermap import fibermap_comments
 
 from ..spectra import Spectra
 
-def write_spectra(outfile, spec, units=None):
+def write_spectra(outfile, spec, units=None, append=False):
     """
     Write Spectra object to FITS file.
 
@@ -44,6 +45,13 @@ def write_spectra(outfile, spec, units=None):
         spec (Spectra): the object containing the data
         units (str): optional string to use for the BUNIT key of the flux
             HDUs for each band.
+        append (bool): if True and outfile exists, add the spectra as new
+            rows of its HDUs instead of overwriting it, see
+            :func:`desispec.io.util.append_fits_extensions`.  The bands,
+            wavelengths and HDUs must match the existing file, whose
+            header is kept.  Only desispec readers combine the appended
+            rows; ``write_spectra(outfile, read_spectra(outfile))``
+            rewrites the file with a single HDU per EXTNAME.
 
     Returns:
         The absolute path to the file that was written.
@@ -52,6 +60,10 @@ def write_spectra(outfile, spec, units=None):
 
     outfile = os.path.abspath(outfile)
 
+    if append and os.path.exists(outfile):
+        _append_spectra(outfile, spec)
+        return outfile
+
     # Create the parent directory, if necessary.
     dir, base = os.path.split(outfile)
     if not os.path.exists(dir):
@@ -63,6 +75,7 @@ def write_spectra(outfile, spec, units=None):
     # metadata goes in empty primary HDU
     hdr = fitsheader(spec.meta)
     add_dependencies(hdr)
+    hdr["NAPPEND"] = (0, "Number of appends to the HDUs")
 
     all_hdus.append(fits.PrimaryHDU(header=hdr))
 
@@ -148,19 +161,141 @@ def write_spectra(outfile, spec, units=None):
     return outfile
 
 
-def read_spectra(infile, single=False):
+def _append_spectra(outfile, spec):
+    """
+    Append the spectra of a Spectra object to an existing spectra file.
+
+    The new rows are written at the end of the file as extensions with the
+    next EXTVER, without reading or moving the existing spectra.
+
+    Args:
+        outfile (str): path of existing file written by write_spectra
+        spec (Spectra): the object containing the new spectra
+
+    Raises:
+        ValueError: if the HDUs or wavelengths of outfile do not match spec.
+    """
+    rows = dict()
+    rows["FIBERMAP"] = encode_table(Table(spec.fibermap)).as_array()
+    for band in spec.bands:
+        upperband = band.upper()
+        rows[upperband+"_FLUX"] = spec.flux[band].astype("f4")
+        rows[upperband+"_IVAR"] = spec.ivar[band].astype("f4")
+        if spec.mask is not None:
+            rows[upperband+"_MASK"] = spec.mask[band].astype(np.uint32)
+        if spec.resolution_data is not None:
+            rows[upperband+"_RESOLUTION"] = spec.resolution_data[band].astype("f4")
+        if spec.extra is not None:
+            for key, value in spec.extra[band].items():
+                rows["{}_{}".format(upperband, key)] = value.astype("f4")
+    if spec.scores is not None:
+        rows["SCORES"] = encode_table(spec.scores).as_array()
+
+    with fits.open(outfile, mode="readonly") as hdus:
+        extnames = list(_get_extensions(hdus).keys())
+        wave = dict()
+        for band in spec.bands:
+            name = band.upper()+"_WAVELENGTH"
+            if name in extnames:
+                wave[band] = hdus[name].data
+    expected = list(rows.keys()) + [band.upper()+"_WAVELENGTH" for band in spec.bands]
+    if sorted(extnames) != sorted(expected):
+        raise ValueError("Cannot append to {} with HDUs {} instead of {}".format(
+            outfile, sorted(extnames), sorted(expected)))
+    for band in spec.bands:
+        if not np.array_equal(wave[band], spec.wave[band].astype("f8")):
+            raise ValueError("Cannot append to {} with different {} wavelengths".format(
+                outfile, band))
+
+    append_fits_extensions(outfile, rows)
+
+
+def _get_extensions(hdus):
+    """
+    Group the HDUs of a spectra file with the HDUs of their appended rows.
+
+    Args:
+        hdus: astropy.io.fits HDUList
+
+    Returns (OrderedDict):
+        the list of HDUs for each extension name, in disk order.
+    """
+    nappend = hdus[0].header.get("NAPPEND", 0)
+    extensions = [(hdu.header.get("EXTNAME", ""), hdu.header.get("EXTVER", 1))
+        for hdu in hdus]
+    groups = appended_extensions(extensions, nappend)
+    for name in groups:
+        groups[name] = [hdus[i] for i in groups[name]]
+    return groups
+
+
+def _read_image_rows(hdus, rows=None):
+    """
+    Read the rows of FITS image HDUs concatenated along their first axis,
+    reading only the contiguous ranges of rows from disk instead of the full
+    images.
+
+    Args:
+        hdus: list of astropy.io.fits ImageHDU, an image and its appended rows
+        rows: sorted array of indices of the rows (first axis) to read,
+            or None to read all of them.
+
+    Returns (array):
+        the image data for these rows.
+    """
+    if rows is None:
+        if len(hdus) == 1:
+            return hdus[0].data
+        return np.concatenate([hdu.data for hdu in hdus])
+    data = list()
+    offset = 0
+    for hdu in hdus:
+        nrows = hdu.shape[0]
+        hdurows = rows[(rows >= offset) & (rows < offset + nrows)] - offset
+        offset += nrows
+        if len(hdurows) == 0:
+            continue
+        #- split in ranges of contiguous rows
+        breaks = np.where(np.diff(hdurows) != 1)[0] + 1
+        starts = np.append(0, breaks)
+        stops = np.append(breaks, len(hdurows))
+        data.extend([hdu.section[hdurows[i]:hdurows[j-1]+1] for i, j in zip(starts, stops)])
+    return np.concatenate(data)
+
+
+def _read_table(hdus):
+    """
+    Read a FITS table and its appended rows as a single Table.
+    """
+    if len(hdus) == 1:
+        return Table(hdus[0].data, copy=True)
+    return vstack([Table(hdu.data) for hdu in hdus])
+
+def read_spectra(infile, single=False, targets=None, fibers=None, rows=None,
+                 bands=None, skip_hdus=None):
     """
     Read Spectra object from FITS file.
 
     This reads data written by the write_spectra function.  A new Spectra
     object is instantiated and returned.
 
+    The fibermap is read first to select the requested spectra; only these
+    rows and bands are then read from the other HDUs.
+
     Args:
         infile (str): path to read
         single (bool): if True, keep spectra as single precision in memory.
+        targets (list): optional list of target IDs to read.
+        fibers (list): optional list of fibers to read.
+        rows (list): optional list of row indices (spectra) to read.
+        bands (list): optional list of bands to read.
+        skip_hdus (list): optional list of HDUs not to read, either as
+            extension names (e.g. "B_RESOLUTION") or for all bands
+            (e.g. "RESOLUTION", "MASK", "SCORES").
 
     Returns (Spectra):
-        The object containing the data read from disk.
+        The object containing the data read from disk, with the selected
+        spectra in the same order as in the file.
 
     """
 
@@ -172,17 +307,51 @@ def read_spectra(infile, single=False):
     if not os.path.isfile(infile):
         raise IOError("{} is not a file".format(infile))
 
+    if skip_hdus is None:
+        skip_hdus = []
+    skip_hdus = [x.upper() for x in skip_hdus]
+    for required in ["FIBERMAP", "WAVELENGTH", "FLUX", "IVAR"]:
+        for x in skip_hdus:
+            if x == required or x.endswith("_" + required):
+                raise ValueError("Cannot skip required HDU {}".format(x))
+    if bands is not None:
+        bands = [x.lower() for x in bands]
+
     hdus = fits.open(infile, mode="readonly")
-    nhdu = len(hdus)
+    extensions = _get_extensions(hdus)
 
     # load the metadata.
 
     meta = dict(hdus[0].header)
 
+    # read the fibermap first to select the rows
+
+    if "FIBERMAP" in extensions:
+        fmap = encode_table(_read_table(extensions["FIBERMAP"]).as_array())
+    else:
+        fmap = None
+    if targets is not None or fibers is not None or rows is not None:
+        if fmap is None:
+            hdus.close()
+            raise RuntimeError("cannot select spectra without a fibermap in {}".format(infile))
+        keep = np.ones(len(fmap), dtype=bool)
+        if targets is not None:
+            keep &= np.isin(fmap["TARGETID"], targets)
+        if fibers is not None:
+            keep &= np.isin(fmap["FIBER"], fibers)
+        if rows is not None:
+            keep_rows = np.zeros(len(fmap), dtype=bool)
+            keep_rows[rows] = True
+            keep &= keep_rows
+        rows = np.where(keep)[0]
+        if len(rows) == 0:
+            hdus.close()
+            raise RuntimeError("selection has no spectra")
+        fmap = fmap[rows]
+
     # initialize data objects
 
-    bands = []
-    fmap = None
+    readbands = []
     wave = None
     flux = None
     ivar = None
@@ -196,12 +365,14 @@ def read_spectra(infile, single=False):
     # explicitly copy the data, since that will be done when constructing
     # the Spectra object.
 
-    for h in range(1, nhdu):
-        name = hdus[h].header["EXTNAME"]
-        if name == "FIBERMAP":
-            fmap = encode_table(Table(hdus[h].data, copy=True).as_array())
+    for name, namehdus in extensions.items():
+        if name == "FIBERMAP" or name in skip_hdus:
+            continue
         elif name == "SCORES":
-            scores = encode_table(Table(hdus[h].data, copy=True).as_array())
+            scores = _read_table(namehdus)
+            if rows is not None:
+                scores = scores[rows]
+            scores = encode_table(scores.as_array())
         else:
             # Find the band based on the name
             mat = re.match(r"(.*)_(.*)", name)
@@ -209,45 +380,54 @@ def read_spectra(infile, single=False):
                 raise RuntimeError("FITS extension name {} does not contain the band".format(name))
             band = mat.group(1).lower()
             type = mat.group(2)
-            if band not in bands:
-                bands.append(band)
+            if bands is not None and band not in bands:
+                continue
+            if type in skip_hdus:
+                continue
+            if band not in readbands:
+                readbands.append(band)
             if type == "WAVELENGTH":
                 if wave is None:
                     wave = {}
-                wave[band] = native_endian(hdus[h].data.astype(ftype))
+                wave[band] = native_endian(namehdus[0].data.astype(ftype))
             elif type == "FLUX":
                 if flux is None:
                     flux = {}
-                flux[band] = native_endian(hdus[h].data.astype(ftype))
+                flux[band] = native_endian(_read_image_rows(namehdus, rows).astype(ftype))
             elif type == "IVAR":
                 if ivar is None:
                     ivar = {}
-                ivar[band] = native_endian(hdus[h].data.astype(ftype))
+                ivar[band] = native_endian(_read_image_rows(namehdus, rows).astype(ftype))
             elif type == "MASK":
                 if mask is None:
                     mask = {}
-                mask[band] = native_endian(hdus[h].data.astype(np.uint32))
+                mask[band] = native_endian(_read_image_rows(namehdus, rows).astype(np.uint32))
             elif type == "RESOLUTION":
                 if res is None:
                     res = {}
-                res[band] = native_endian(hdus[h].data.astype(ftype))
+                res[band] = native_endian(_read_image_rows(namehdus, rows).astype(ftype))
             else:
                 # this must be an "extra" HDU
                 if extra is None:
                     extra = {}
                 if band not in extra:
                     extra[band] = {}
-                extra[band][type] = native_endian(hdus[h].data.astype(ftype))
+                extra[band][type] = native_endian(_read_image_rows(namehdus, rows).astype(ftype))
+
+    hdus.close()
+
+    if bands is not None:
+        for band in bands:
+            if band not in readbands:
+                raise RuntimeError("band {} not in {}".format(band, infile))
 
     # Construct the Spectra object from the data.  If there are any
     # inconsistencies in the sizes of the arrays read from the file,
     # they will be caught by the constructor.
 
-    spec = Spectra(bands, wave, flux, ivar, mask=mask, resolution_data=res,
+    spec = Spectra(readbands, wave, flux, ivar, mask=mask, resolution_data=res,
         fibermap=fmap, meta=meta, extra=extra, single=single, scores=scores)
 
-    hdus.close()
-
     return spec
 
 def read_frame_as_spectra(filename, night=None, expid=None, band=None, single=False):
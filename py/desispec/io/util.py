@@ -5,9 +5,7 @@ desispec.io.util
 Utility functions for desispec IO.
 """
 import os
-import astropy.io
 import numpy as np
-from astropy.table import Table
 from desiutil.log import get_logger
 
 from ..util import healpix_degrade_fixed
@@ -46,6 +44,7 @@ def fitsheader(header):
 
     Returns fits.Header object
     """
+    import astropy.io.fits
     if header is None:
         return astropy.io.fits.Header()
 
@@ -104,6 +103,8 @@ def add_columns(data, colnames, colvals):
         it also accepts astropy Tables as the `data` input, and accepts
         scalar values to expand as entries in `colvals`.
     '''
+    import numpy.lib.recfunctions
+    from astropy.table import Table
     if isinstance(data, Table):
         data = data.copy()
         for key, value in zip(colnames, colvals):
@@ -151,6 +152,7 @@ def write_bintable(filename, data, header=None, comments=None, units=None,
     comments and units in the FITS header too.  DATA can either be
     dictionary, an Astropy Table, a numpy.recarray or a numpy.ndarray.
     """
+    import astropy.io.fits
     from astropy.table import Table
     from desiutil.io import encode_table
 
@@ -248,6 +250,86 @@ def write_bintable(filename, data, header=None, comments=None, units=None,
     return
 
 
+def append_fits_extensions(filename, data, header=None, compress=None):
+    """Append rows to the HDUs of an existing FITS file as new extensions.
+
+    Args:
+        filename (str): FITS file to update in place.
+        data (dict): arrays of new rows keyed by EXTNAME, structured arrays
+            for table HDUs.
+        header (dict-like, optional): keywords to update in the primary
+            header.
+        compress (dict, optional): compression of the new image HDUs keyed
+            by EXTNAME, e.g. "gzip".
+
+    The rows are written at the end of the file as new HDUs with the EXTNAME
+    of the HDU that they extend and the next EXTVER, so that the existing
+    HDUs are neither read nor moved.  The NAPPEND keyword of the primary
+    header, the number of appends, is updated last; readers only use the
+    EXTVER up to NAPPEND+1 (see :func:`appended_extensions`), so they never
+    see a partial append.  Appends are serialized with an exclusive lock of
+    the file, and the HDUs left by an interrupted append are removed.
+
+    Readers that select HDUs by EXTNAME only (e.g. ``fits.getdata(filename,
+    'FIBERMAP')``) get the first EXTVER and miss the appended rows: files
+    with NAPPEND > 0 are only meant for the desispec readers, and are
+    compacted by reading and rewriting them without append.
+    """
+    import fcntl
+    import fitsio
+    log = get_logger()
+    if compress is None:
+        compress = dict()
+
+    with open(filename, 'rb+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        with fitsio.FITS(filename) as fx:
+            nappend = fx[0].read_header().get('NAPPEND', 0)
+            end = fx[-1].get_offsets()['data_end']
+            for i in range(1, len(fx)):
+                if fx[i].get_extver() > nappend + 1:
+                    end = fx[i].get_offsets()['header_start']
+                    break
+        if os.path.getsize(filename) > end:
+            log.warning('Removing an interrupted append from {}'.format(filename))
+            os.truncate(filename, end)
+
+        with fitsio.FITS(filename, 'rw') as fx:
+            for extname, rows in data.items():
+                fx.write(rows, extname=extname, extver=nappend + 2,
+                         compress=compress.get(extname))
+                fx[-1].write_checksum()
+
+        with fitsio.FITS(filename, 'rw') as fx:
+            if header is not None:
+                fx[0].write_keys(dict(fitsheader(header)))
+            fx[0].write_key('NAPPEND', nappend + 1, 'Number of appends to the HDUs')
+            if 'CHECKSUM' in fx[0].read_header():
+                fx[0].write_checksum()
+
+
+def appended_extensions(extensions, nappend):
+    """Group the HDUs of a file written with :func:`append_fits_extensions`.
+
+    Args:
+        extensions (list): (EXTNAME, EXTVER) of the HDUs of the file, in
+            order, including the primary HDU.  EXTVER is 0 or 1 for the HDUs
+            written with the file.
+        nappend (int): NAPPEND keyword of the primary header, 0 if missing.
+
+    Returns:
+        OrderedDict: for each EXTNAME, the list of indices of the HDUs whose
+        rows are concatenated, skipping any interrupted append.
+    """
+    from collections import OrderedDict
+    groups = OrderedDict()
+    for i, (extname, extver) in enumerate(extensions):
+        if i > 0 and extver <= nappend + 1:
+            groups.setdefault(extname, list()).append(i)
+    return groups
+
+
 def _supports_memmap(filename):
     """Returns ``True`` if the filesystem containing `filename` supports
     opening memory-mapped files in update mode.
@@ -0,0 +1,132 @@
+"""
+desispec.kernels
+================
+
+Registry of the numba kernels used by desispec.
+
+Kernels are declared with :func:`jit` instead of ``numba.jit``; they are
+compiled in nopython mode with on-disk caching, so that only the first
+process using a given version of desispec pays the LLVM compilation time,
+and every other process (e.g. MPI ranks) loads the machine code from the
+cache.
+
+The cache is written next to the source files when possible (in the
+``__pycache__`` directories), otherwise in the user cache directory.
+Set ``$NUMBA_CACHE_DIR`` before running, or call :func:`set_cache_dir`,
+to use another directory (e.g. in the production run directory).
+
+The signatures given to :func:`jit` are the argument types used by
+desispec; they are compiled ahead of time by :func:`compile_kernels`
+(``desi_compile_kernels``), for instance at install time.  Other argument
+types are still compiled on first use.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import importlib
+from collections import OrderedDict
+
+import numba
+from numba.core import sigutils
+
+from desiutil.log import get_logger
+
+#- modules declaring kernels, imported by compile_kernels
+_kernel_modules = ('desispec.cosmics', 'desispec.trace_shifts',
+                   'desispec.qproc.qextract', 'desispec.maskedmedian')
+
+#- full name -> (dispatcher, signatures)
+_registry = OrderedDict()
+
+
+def jit(*signatures, **options):
+    """Decorator declaring a numba kernel.
+
+    Args:
+        signatures: numba signatures (str or tuple of types) of the arguments,
+            compiled ahead of time by :func:`compile_kernels`.
+
+    Options:
+        options: passed to ``numba.jit``; ``nopython=True`` and
+            ``cache=True`` by default.
+
+    Returns:
+        decorator returning the numba dispatcher.
+    """
+    options.setdefault('nopython', True)
+    options.setdefault('cache', True)
+
+    def decorator(func):
+        dispatcher = numba.jit(**options)(func)
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+        _registry[name] = (dispatcher, signatures)
+        return dispatcher
+
+    return decorator
+
+
+def registered_kernels():
+    """Return dict of kernel full name -> list of signatures to compile."""
+    return OrderedDict((name, list(sigs)) for name, (dispatcher, sigs) in _registry.items())
+
+
+def set_cache_dir(cache_dir):
+    """Use cache_dir for the on-disk cache of the kernels.
+
+    Args:
+        cache_dir: directory path, created if needed; None restores the
+            default location next to the source files.
+
+    This applies to the kernels already declared and to the ones declared
+    afterwards.
+    """
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        numba.config.CACHE_DIR = cache_dir
+    else:
+        numba.config.CACHE_DIR = ''
+
+    for dispatcher, sigs in _registry.values():
+        if dispatcher._cache.__class__.__name__ != 'NullCache':
+            dispatcher.enable_caching()
+
+
+def compile_kernels(cache_dir=None):
+    """Compile all the kernels for their declared signatures, or load them
+    from the cache.
+
+    Options:
+        cache_dir: directory for the on-disk cache (see :func:`set_cache_dir`)
+
+    Returns:
+        dict of kernel full name -> compilation (or cache loading) time in sec.
+    """
+    log = get_logger()
+    for module in _kernel_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as err:
+            log.warning('Not compiling the kernels of {}: {}'.format(module, err))
+    if cache_dir is not None:
+        set_cache_dir(cache_dir)
+
+    timing = OrderedDict()
+    for name, (dispatcher, sigs) in _registry.items():
+        t0 = time.time()
+        for sig in sigs:
+            #- the disk cache is indexed by the signature as given, so use
+            #- the tuple of argument types, as in calls to the kernel
+            args, return_type = sigutils.normalize_signature(sig)
+            args = tuple(args)
+            if args not in dispatcher.overloads:
+                dispatcher.compile(args)
+            elif dispatcher._cache.load_overload(args, dispatcher.targetctx) is None:
+                #- already compiled in this process, or loaded from another
+                #- cache directory: compile again to fill this cache
+                dispatcher.recompile()
+        timing[name] = time.time() - t0
+        log.debug('{} {} signature(s) in {:.2f} sec'.format(name, len(sigs), timing[name]))
+    return timing
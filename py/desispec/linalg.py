@@ -65,6 +65,95 @@ def cholesky_invert(A) :
     inv = scipy.linalg.cho_solve((UorL,lower),np.eye(A.shape[0]))
     return inv
 
+def cholesky_solve_banded(Ab,B,overwrite=False) :
+    """Returns the solution X of the linear system A.X=B
+    assuming A is a banded positive definite matrix
+
+    Args :
+         Ab : 2D (ndiag,n) lower diagonals of the (real symmetric) positive
+              definite matrix A, with Ab[d,j] = A[j+d,j] (LAPACK lower band storage)
+         B : 1D vector, must have dimension n  (numpy.ndarray)
+
+    Options :
+        overwrite: replace Ab data by cholesky decomposition (faster)
+
+    Returns :
+         X : 1D vector, same dimension as B  (numpy.ndarray)
+
+    """
+    L = scipy.linalg.cholesky_banded(Ab, lower=True, overwrite_ab=overwrite)
+    X = scipy.linalg.cho_solve_banded((L,True),B)
+    return X
+
+def cholesky_invert_banded(Ab,ndiag=None) :
+    """
+    returns the diagonals of the inverse of a banded positive definite matrix
+
+    Only the elements of the inverse within the band are computed,
+    using the recursion of Takahashi et al. (1973) on the cholesky
+    factor, in O(n*ndiag**2) operations instead of O(n**3).
+
+    Args :
+         Ab : 2D (ndiag,n) lower diagonals of the (real symmetric) positive
+              definite matrix A, with Ab[d,j] = A[j+d,j] (LAPACK lower band storage)
+
+    Options :
+         ndiag : number of lower diagonals of the inverse to return (default and
+                 maximum is Ab.shape[0])
+
+    Returns:
+         covb : 2D (ndiag,n) lower diagonals of the inverse of A,
+                with covb[d,j] = inv(A)[j+d,j]
+    """
+    L = scipy.linalg.cholesky_banded(Ab, lower=True)
+    nd,n = L.shape
+    b = nd-1
+    if ndiag is None :
+        ndiag = nd
+    ndiag = min(ndiag,nd)
+
+    # pad the factor with zeros so that L[j+d,j] is defined for j+d >= n
+    Lpad = np.zeros((nd,n+b))
+    Lpad[:,:n] = L
+
+    covb = np.zeros((nd,n))
+    # dense (b+1)x(b+1) window of the inverse, window[i,k] = inv(A)[j+i,j+k]
+    window = np.zeros((nd,nd))
+    for j in range(n-1,-1,-1) :
+        window[1:,1:] = window[:-1,:-1]
+        l   = Lpad[1:,j]
+        col = -window[1:,1:].dot(l)/Lpad[0,j]
+        window[1:,0] = col
+        window[0,1:] = col
+        window[0,0]  = 1./Lpad[0,j]**2 - l.dot(col)/Lpad[0,j]
+        covb[:,j] = window[:,0]
+
+    # zero the entries that fall outside of the matrix
+    for d in range(1,nd) :
+        covb[d,n-d:] = 0.
+
+    return covb[:ndiag]
+
+def banded_to_sparse(Ab) :
+    """
+    converts a symmetric matrix in lower band storage to a scipy.sparse matrix
+
+    Args :
+         Ab : 2D (ndiag,n) lower diagonals of a symmetric matrix A,
+              with Ab[d,j] = A[j+d,j] (LAPACK lower band storage)
+
+    Returns:
+         A : scipy.sparse.dia_matrix (n,n)
+    """
+    nd,n = Ab.shape
+    offsets = np.arange(-(nd-1),nd)
+    data = np.zeros((2*nd-1,n))
+    for d in range(nd) :
+        # dia_matrix convention : data[k,j] = A[j-offsets[k],j]
+        data[nd-1-d] = Ab[d]                 # lower diagonal -d , A[j+d,j]
+        data[nd-1+d,d:] = Ab[d,:n-d]         # upper diagonal +d , A[j,j+d]
+    return scipy.sparse.dia_matrix((data,offsets),shape=(n,n))
+
 
 def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=None,order=3,max_resolution=None):
     """Performs spline fit of input_flux vs. input_wave and resamples at output_wave
@@ -2,10 +2,72 @@
 Utility function to perform a median of images with masks
 '''
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from desiutil.log import get_logger
 import numpy as np
+import scipy.ndimage
+
+from desispec.kernels import jit
+
+#- maximum size in bytes of the block of pixels of all images processed at once
+_max_block_bytes = 64*1024**2
+
+def _nthreads_default() :
+    if "OMP_NUM_THREADS" in os.environ :
+        return int(os.environ["OMP_NUM_THREADS"])
+    from desispec.parallel import default_nproc
+    return default_nproc
+
+def _map_pixel_blocks(func, arrays, npix, chunksize, nthreads) :
+    '''
+    Applies func to blocks of columns of 2D[nimages, npix] arrays
+    (or None) and returns the concatenated 1D[npix] results.
+    Blocks are processed in nthreads threads; numpy releases the GIL
+    when sorting, so that the threads run concurrently.
+    '''
+    bounds = list(range(0,npix,chunksize))+[npix]
+    def _run(b) :
+        s = slice(bounds[b],bounds[b+1])
+        return func(*[(None if x is None else np.asarray(x[:,s])) for x in arrays])
+    nblocks = len(bounds)-1
+    nthreads = max(1,min(nthreads,nblocks))
+    if nthreads == 1 :
+        results = [_run(b) for b in range(nblocks)]
+    else :
+        with ThreadPoolExecutor(nthreads) as pool :
+            results = list(pool.map(_run,range(nblocks)))
+    return np.concatenate(results)
+
+def _chunksize(nimages, chunksize) :
+    if chunksize is None :
+        chunksize = max(1024,_max_block_bytes//(8*max(1,nimages)))
+    return chunksize
+
+def _masked_median_block(images, masks) :
+    '''
+    Median of a block 2D[nimages, npix] of images, ignoring pixels with masks!=0.
+    Same as np.ma.median(...,axis=0).data, which is 0 for fully masked pixels.
+    '''
+    if masks is None :
+        return np.median(images,axis=0)
+    if np.issubdtype(images.dtype,np.floating) :
+        data = np.array(images.T)
+    else :
+        data = np.array(images.T,dtype=float)
+    bad = (masks.T!=0)
+    data[bad] = np.nan
+    # nan are sorted at the end
+    data.sort(axis=1)
+    nvalid = data.shape[1]-np.sum(bad,axis=1)
+    rows = np.arange(data.shape[0])
+    median = 0.5*(data[rows,np.maximum((nvalid-1)//2,0)]+data[rows,nvalid//2])
+    median[nvalid==0] = 0.
+    return median
 
-def masked_median(images,masks=None) :
+def masked_median(images,masks=None,nthreads=1,chunksize=None) :
     '''
     Perfomes a median of an list of input images. If a list of mask is provided,
     the median is performed only on unmasked pixels.
@@ -14,14 +76,246 @@ def masked_median(images,masks=None) :
        images : 3D numpy array : list of images of same shape
     Options:
        masks : list of mask images of same shape as the images. Only pixels with mask==0 are considered in the median.
+       nthreads : number of threads (None for $OMP_NUM_THREADS or desispec.parallel.default_nproc)
+       chunksize : number of pixels of the images processed at once
 
-    Returns : median image
+    The images and masks can be memory mapped arrays (see ImageStack), since
+    only chunksize pixels of each image are read at once.
+
+    Returns : median image (0 for pixels masked in all images)
     '''
     log = get_logger()
 
+    if nthreads is None :
+        nthreads = _nthreads_default()
+    # asanyarray does not read memory mapped arrays
+    images = np.asanyarray(images)
+    nimages = len(images)
+    shape = images.shape[1:]
+    images = images.reshape(nimages,-1)
     if masks is None :
-        log.info("simple median of %d images"%len(images))
-        return np.median(images,axis=0)
+        log.info("simple median of %d images"%nimages)
+    else :
+        log.info("masked array median of %d images"%nimages)
+        masks = np.asanyarray(masks).reshape(nimages,-1)
+    median = _map_pixel_blocks(_masked_median_block,[images,masks],images.shape[1],_chunksize(nimages,chunksize),nthreads)
+    return median.reshape(shape)
+
+def _clipped_mean_block(images, center, nsig) :
+    ares = np.abs(images-center)
+    mask = (ares<nsig*1.4826*np.median(ares,axis=0))
+    with np.errstate(invalid='ignore') :
+        return np.sum(images*mask,axis=0)/np.sum(mask,axis=0)
+
+def clipped_mean(images,center,nsig=4.,nthreads=1,chunksize=None) :
+    '''
+    Mean of the images, ignoring the pixels deviating from a center image
+    by more than nsig times the scaled median absolute deviation.
+
+    Args:
+       images : 3D numpy array : list of images of same shape (can be memory mapped)
+       center : image of same shape, usually the median of the images
+    Options:
+       nsig : clipping threshold
+       nthreads : number of threads (None for $OMP_NUM_THREADS or desispec.parallel.default_nproc)
+       chunksize : number of pixels of the images processed at once
+
+    Returns : mean image (nan for pixels clipped in all images)
+    '''
+    if nthreads is None :
+        nthreads = _nthreads_default()
+    images = np.asanyarray(images)
+    nimages = len(images)
+    shape = images.shape[1:]
+    images = images.reshape(nimages,-1)
+    center = np.asarray(center).reshape(1,-1)
+    def _func(block, center_block) :
+        return _clipped_mean_block(block, center_block, nsig)
+    mean = _map_pixel_blocks(_func,[images,center],images.shape[1],_chunksize(nimages,chunksize),nthreads)
+    return mean.reshape(shape)
+
+class ImageStack(object) :
+    '''
+    Stack of images (and optional masks) of same shape in temporary
+    memory mapped files, to compute medians and means of many images
+    with a bounded memory.
+
+    Args:
+       nimages : number of images
+       shape : shape of each image
+    Options:
+       masks : also store a mask per image
+       dtype : data type of the images
+       dirname : directory of the temporary files (default is the system one)
+    '''
+    def __init__(self, nimages, shape, masks=False, dtype=np.float64, dirname=None) :
+        self.nimages = nimages
+        self.shape = tuple(np.atleast_1d(shape))
+        self._files = []
+        self.images = self._memmap(dtype, dirname)
+        self.masks = None
+        if masks :
+            self.masks = self._memmap(np.uint8, dirname)
+        self.size = 0
+
+    def _memmap(self, dtype, dirname) :
+        # the temporary file is deleted when closed
+        f = tempfile.TemporaryFile(dir=dirname)
+        self._files.append(f)
+        return np.memmap(f,dtype=dtype,mode="w+",shape=(self.nimages,)+self.shape)
+
+    def add(self, image, mask=None) :
+        '''
+        Writes the next image (and its mask, non zero for masked pixels) in the stack.
+        '''
+        if self.size >= self.nimages :
+            raise ValueError("Stack already has {} images".format(self.nimages))
+        self.images[self.size] = np.asarray(image).reshape(self.shape)
+        if self.masks is not None :
+            if mask is None :
+                raise ValueError("Stack with masks needs a mask for each image")
+            self.masks[self.size] = (np.asarray(mask).reshape(self.shape)!=0)
+        self.size += 1
+
+    def median(self, nthreads=1, chunksize=None) :
+        '''
+        Returns the (masked) median of the images, see masked_median.
+        '''
+        masks = None if self.masks is None else self.masks[:self.size]
+        return masked_median(self.images[:self.size],masks,nthreads=nthreads,chunksize=chunksize)
+
+    def clipped_mean(self, center, nsig=4., nthreads=1, chunksize=None) :
+        '''
+        Returns the clipped mean of the images, see clipped_mean.
+        '''
+        return clipped_mean(self.images[:self.size],center,nsig=nsig,nthreads=nthreads,chunksize=chunksize)
+
+    def close(self) :
+        '''
+        Deletes the temporary files.
+        '''
+        self.images = None
+        self.masks = None
+        for f in self._files :
+            f.close()
+        self._files = []
+
+@jit()
+def _reflect(index, n) :
+    # same boundary condition as scipy.ndimage mode='reflect' (d c b a | a b c d | d c b a)
+    index = index % (2*n)
+    if index >= n :
+        index = 2*n-1-index
+    return index
+
+@jit()
+def _window_insert(window, nw, value) :
+    # insert value in the sorted window[:nw]
+    k = np.searchsorted(window[:nw],value)
+    for i in range(nw,k,-1) :
+        window[i] = window[i-1]
+    window[k] = value
+    return nw+1
+
+@jit()
+def _window_remove(window, nw, value) :
+    # remove one occurrence of value from the sorted window[:nw]
+    k = np.searchsorted(window[:nw],value)
+    for i in range(k,nw-1) :
+        window[i] = window[i+1]
+    return nw-1
+
+@jit('(float64[:,::1],float64[:,::1],int64,int64,int64,int64)',nogil=True)
+def _masked_median_filter_rows(image, out, h, w, rbegin, rend) :
+    """
+    Masked median filter of the rows rbegin to rend of an image, with a window
+    of h rows and w columns, ignoring zeros. A sorted list of the non zero
+    values of the window is updated when the window slides along the row,
+    so that it is faster with w >= h.
+    """
+    n0 = image.shape[0]
+    n1 = image.shape[1]
+    window = np.zeros(h*w)
+    for i in range(rbegin,rend) :
+        nw = 0
+        for a in range(h) :
+            ii = _reflect(i-h//2+a,n0)
+            for b in range(w) :
+                value = image[ii,_reflect(b-w//2,n1)]
+                if value != 0 :
+                    nw = _window_insert(window,nw,value)
+        for j in range(n1) :
+            if j > 0 :
+                jold = _reflect(j-1-w//2,n1)
+                jnew = _reflect(j-w//2+w-1,n1)
+                for a in range(h) :
+                    ii = _reflect(i-h//2+a,n0)
+                    value = image[ii,jold]
+                    if value != 0 :
+                        nw = _window_remove(window,nw,value)
+                    value = image[ii,jnew]
+                    if value != 0 :
+                        nw = _window_insert(window,nw,value)
+            if nw == 0 :
+                out[i,j] = 0.
+            elif nw%2 == 1 :
+                out[i,j] = window[nw//2]
+            else :
+                out[i,j] = 0.5*(window[nw//2-1]+window[nw//2])
+
+def masked_median_filter(image, shape, nthreads=None) :
+    """ Returns a masked sliding median filtering of the input image.
+        Zero values in the input image are ignored in the median.
+
+    Same as scipy.ndimage.generic_filter(image, func, size=shape) with
+    mode='reflect' and func returning the median of the non zero values
+    (or zero), but with a sorted window updated as it slides, and in
+    row stripes processed in nthreads threads.
+
+    Args:
+        image : 2D np.array
+        shape : tuple of length 2 giving the shape of the filtering window.
+
+    Options:
+        nthreads : number of threads (None for $OMP_NUM_THREADS or desispec.parallel.default_nproc)
+
+    Returns:
+        2D np.array of same shape as input image
+    """
+    if nthreads is None :
+        nthreads = _nthreads_default()
+    h, w = int(shape[0]), int(shape[1])
+    # slide the window along its largest dimension
+    transpose = (h > w)
+    if transpose :
+        image = image.T
+        h, w = w, h
+    image = np.ascontiguousarray(image,dtype=np.float64)
+    out = np.zeros(image.shape)
+    nrows = image.shape[0]
+    nthreads = max(1,min(nthreads,nrows))
+    bounds = np.linspace(0,nrows,nthreads+1).astype(int)
+    def _run(stripe) :
+        _masked_median_filter_rows(image,out,h,w,bounds[stripe],bounds[stripe+1])
+    if nthreads == 1 :
+        _run(0)
     else :
-        log.info("masked array median of %d images"%len(images))
-        return np.ma.median(np.ma.masked_array(data=images,mask=(masks!=0)),axis=0).data
+        with ThreadPoolExecutor(nthreads) as pool :
+            list(pool.map(_run,range(nthreads)))
+    if transpose :
+        out = out.T.copy()
+    return out
+
+def dilate_mask(mask, d0=1, d1=1) :
+    """ Increases the size of a masked area by d0 pixels along the first axis and d1 along the second
+
+    Args:
+        mask : 2D np.array, non zero for masked pixels
+        d0, d1 : number of pixels added on each side along each axis
+
+    Returns:
+        2D np.array of same shape and type as mask, where each pixel has the
+        maximum value of the mask within the (2*d0+1, 2*d1+1) box around it
+    """
+    omask = scipy.ndimage.maximum_filter1d(mask,size=2*d0+1,axis=0,mode='constant',cval=0)
+    return scipy.ndimage.maximum_filter1d(omask,size=2*d1+1,axis=1,mode='constant',cval=0)
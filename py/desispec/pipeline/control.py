@@ -32,6 +32,7 @@ from .defs import (task_states, prod_options_name,
 
 from . import prod as pipeprod
 from . import db as pipedb
+from . import fsindex as pipefsindex
 from . import run as piperun
 from . import tasks as pipetasks
 from . import scriptgen as scriptgen
@@ -55,7 +56,7 @@ class clr:
 
 def create(root=None, data=None, redux=None, prod=None, force=False,
     basis=None, calib=None, db_sqlite=False, db_sqlite_path=None,
-    db_postgres=False, db_postgres_host="nerscdb03.nersc.gov",
+    db_sqlite_wal=False, db_postgres=False, db_postgres_host="nerscdb03.nersc.gov",
     db_postgres_port=5432, db_postgres_name="desidev",
     db_postgres_user="desidev_admin", db_postgres_authorized="desidev_ro",
     nside=64 ):
@@ -71,6 +72,8 @@ def create(root=None, data=None, redux=None, prod=None, force=False,
         calib (str): value to use for DESI_SPECTRO_CALIB.
         db_sqlite (bool): if True, use SQLite for the DB.
         db_sqlite_path (str): override path to SQLite DB.
+        db_sqlite_wal (bool): if True, use write-ahead logging for the
+            SQLite DB.
         db_postgres (bool): if True, use PostgreSQL for the DB.
         db_postgres_host (str): PostgreSQL hostname.
         db_postgres_port (int): PostgreSQL connection port number.
@@ -201,7 +204,7 @@ def create(root=None, data=None, redux=None, prod=None, force=False,
                 os.makedirs(proddir)
 
         # Create the database
-        db = pipedb.DataBaseSqlite(dbpath, "w")
+        db = pipedb.DataBaseSqlite(dbpath, "w", wal=db_sqlite_wal)
 
         os.environ["DESI_SPECTRO_DB"] = dbpath
 
@@ -428,7 +431,7 @@ def check_tasks(tasks, db=None):
     return tskstate
 
 
-def sync(db, nightstr=None, specdone=False):
+def sync(db, nightstr=None, specdone=False, index_cache=None):
     """Synchronize DB state based on the filesystem.
 
     This scans the filesystem for all tasks for the specified nights,
@@ -438,12 +441,17 @@ def sync(db, nightstr=None, specdone=False):
         db (DataBase): the production DB.
         nightstr (list): comma separated (YYYYMMDD) or regex pattern.
         specdone: If true, set spectra to done if files exist.
+        index_cache (str): file of directory listings, reused for the
+            unchanged directories and updated.
     """
     allnights = io.get_nights(strip_path=True)
     nights = pipeprod.select_nights(allnights, nightstr)
 
+    index = pipefsindex.FileIndex(index_cache)
     for nt in nights:
-        db.sync(nt,specdone=specdone)
+        db.sync(nt, specdone=specdone, index=index)
+    if index_cache is not None:
+        index.save(index_cache)
     return
 
 
@@ -12,6 +12,7 @@ Pipeline processing database
 from __future__ import absolute_import, division, print_function
 
 import os
+import time
 
 import re
 from collections import OrderedDict
@@ -28,6 +29,8 @@ import fitsio
 
 from .defs import (task_states, task_int_to_state, task_state_to_int, task_name_sep)
 
+from .fsindex import FileIndex
+
 
 def all_task_types():
     """Get the list of possible task types that are supported.
@@ -304,7 +307,7 @@ def all_tasks(night, nside, expid=None):
     return full , healpix_frames
 
 
-def check_tasks(tasklist, db=None, inputs=None):
+def check_tasks(tasklist, db=None, inputs=None, index=None):
     """Check a list of tasks and return their state.
 
     If the database is specified, it is used to check the state of the tasks
@@ -315,6 +318,8 @@ def check_tasks(tasklist, db=None, inputs=None):
         db (pipeline.db.DB): The optional database to use.
         inputs (dict): optional dictionary containing the only input
             dependencies that should be considered.
+        index (FileIndex): the snapshot of the filesystem to check, if
+            not using the database.  By default, a new one.
 
     Returns:
         dict: The current state of all tasks.
@@ -327,6 +332,8 @@ def check_tasks(tasklist, db=None, inputs=None):
         # Check the filesystem to see which tasks are done.  Since we don't
         # have a DB, we can only distinguish between "waiting", "ready", and
         # "done" states.
+        if index is None:
+            index = FileIndex()
         for tsk in tasklist:
             tasktype = task_type(tsk)
             st = "waiting"
@@ -346,7 +353,7 @@ def check_tasks(tasklist, db=None, inputs=None):
                         deptype = task_type(dp)
                         depfiles = task_classes[deptype].paths(dp)
                         for odep in depfiles:
-                            if not os.path.isfile(odep):
+                            if not index.isfile(odep):
                                 ready = False
                                 break
                 if ready:
@@ -356,7 +363,7 @@ def check_tasks(tasklist, db=None, inputs=None):
             # Check outputs
             outfiles = task_classes[tasktype].paths(tsk)
             for out in outfiles:
-                if not os.path.isfile(out):
+                if not index.isfile(out):
                     done = False
                     break
             if done:
@@ -372,11 +379,42 @@ def check_tasks(tasklist, db=None, inputs=None):
 class DataBase:
     """Class for tracking pipeline processing objects and state.
     """
+
+    placeholder = "?"
+    """Placeholder of bound parameters in SQL commands for this backend."""
+
+    _max_params = 500
+    """Maximum number of bound parameters in a single "in (...)" clause."""
+
     def __init__(self):
         self._conn = None
         return
 
 
+    def _select_in(self, cur, cmd, values):
+        """Execute a select command with a "where ... in (...)" clause
+        for many values, using bound parameters.
+
+        Args:
+            cur (DB cursor): the database cursor of an open connection.
+            cmd (str): the select command, with a "{}" in place of the
+                comma separated list of placeholders.
+            values (list): the values of the "in" clause.
+
+        Returns:
+            list: all the selected rows.
+
+        """
+        values = list(values)
+        rows = list()
+        for first in range(0, len(values), self._max_params):
+            chunk = values[first:first+self._max_params]
+            cur.execute(cmd.format(",".join([self.placeholder]*len(chunk))),
+                chunk)
+            rows.extend(cur.fetchall())
+        return rows
+
+
     def get_states_type(self, tasktype, tasks):
         """Efficiently get the state of many tasks of a single type.
 
@@ -389,17 +427,15 @@ class DataBase:
 
         """
         states = None
-        namelist = ",".join([ "'{}'".format(x) for x in tasks ])
 
         log = get_logger()
         log.debug("opening db")
 
         with self.cursor() as cur:
             log.debug("selecting in db")
-            cur.execute(\
-                'select name, state from {} where name in ({})'.format(tasktype,
-                namelist))
-            st = cur.fetchall()
+            st = self._select_in(cur,
+                'select name, state from {} where name in ({{}})'.format(
+                tasktype), tasks)
             log.debug("done")
             states = { x[0] : task_int_to_state[x[1]] for x in st }
         return states
@@ -468,20 +504,26 @@ class DataBase:
 
         with self.cursor() as cur:
             log.debug("updating in db")
-            for tsk in tasks:
-                cur.execute("update {} set state = {} where name = '{}'".format(tasktype, task_state_to_int[tsk[1]], tsk[0]))
-                if postprocessing and tsk[1]=="done" :
-                    task_classes[tasktype].postprocessing(db=self,name=tsk[0],cur=cur)
+            cur.executemany("update {} set state = {} where name = {}".format(
+                tasktype, self.placeholder, self.placeholder),
+                [ (task_state_to_int[tsk[1]], tsk[0]) for tsk in tasks ])
+            if postprocessing:
+                for tsk in tasks:
+                    if tsk[1] == "done":
+                        task_classes[tasktype].postprocessing(db=self,
+                            name=tsk[0], cur=cur)
             log.debug("done")
         return
 
 
-    def set_states(self, tasks):
+    def set_states(self, tasks, postprocessing=True):
         """Efficiently set the state of many tasks at once.
 
         Args:
             tasks (list): list of tuples containing the task name and the
                 state to set.
+            postprocessing (bool): if True, run the postprocessing of the
+                tasks set to "done".
 
         Returns:
             Nothing.
@@ -503,7 +545,7 @@ class DataBase:
         # Process each type
         for t, tlist in taskbytype.items():
             if len(tlist) > 0:
-                self.set_states_type(t, tlist)
+                self.set_states_type(t, tlist, postprocessing=postprocessing)
         return
 
 
@@ -527,11 +569,10 @@ class DataBase:
         for t, tlist in taskbytype.items():
             if (t == "spectra") or (t == "redshift"):
                 raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            namelist = ",".join([ "'{}'".format(x) for x in tlist ])
             with self.cursor() as cur:
-                cur.execute(\
-                    'select name, submitted from {} where name in ({})'.format(t, namelist))
-                sb = cur.fetchall()
+                sb = self._select_in(cur,
+                    'select name, submitted from {} where name in ({{}})'\
+                    .format(t), tlist)
                 submitted.update({ x[0] : x[1] for x in sb })
         return submitted
 
@@ -553,8 +594,9 @@ class DataBase:
         if unset:
             val = 0
         with self.cursor() as cur:
-            for tsk in tasks:
-                cur.execute("update {} set submitted = {} where name = '{}'".format(tasktype, val, tsk))
+            cur.executemany("update {} set submitted = {} where name = {}"\
+                .format(tasktype, val, self.placeholder),
+                [ (tsk,) for tsk in tasks ])
         return
 
 
@@ -578,7 +620,7 @@ class DataBase:
         for t, tlist in taskbytype.items():
             if (t == "spectra") or (t == "redshift"):
                 raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            self.set_submitted_type(tlist, unset=unset)
+            self.set_submitted_type(t, tlist, unset=unset)
         return
 
 
@@ -630,7 +672,7 @@ class DataBase:
         return
 
 
-    def sync(self, night, specdone=False):
+    def sync(self, night, specdone=False, index=None):
         """Update states of tasks based on filesystem.
 
         Go through all tasks in the DB for the given night and determine their
@@ -639,10 +681,15 @@ class DataBase:
         Args:
             night (str): The night to scan for updates.
             specdone: If true, set spectra to done if files exist.
+            index (FileIndex): the snapshot of the filesystem to check.  By
+                default, a new one.
         """
         from .tasks.base import task_classes
         log = get_logger()
 
+        if index is None:
+            index = FileIndex()
+
         # Get the list of task types excluding spectra and redshifts,
         # which will be handled separately.
         ttypes = [ t for t in all_task_types() if (t != "spectra") \
@@ -661,7 +708,7 @@ class DataBase:
         # Save out the cframe states for later use with the healpix_frame table
         cfstates = None
         for tt in ttypes:
-            tstates = check_tasks(tasks_in_db[tt], db=None)
+            tstates = check_tasks(tasks_in_db[tt], db=None, index=index)
             st = [ (x, tstates[x]) for x in tasks_in_db[tt] ]
             self.set_states_type(tt, st)
             if tt == "cframe":
@@ -686,7 +733,7 @@ class DataBase:
             outfiles = task_classes["spectra"].paths(spec_name)
             spec_exists[row["pixel"]] = True
             for out in outfiles:
-                if not os.path.isfile(out):
+                if not index.isfile(out):
                     spec_exists[row["pixel"]] = False
                     break
 
@@ -694,7 +741,7 @@ class DataBase:
             outfiles = task_classes["redshift"].paths(red_name)
             red_exists[row["pixel"]] = True
             for out in outfiles:
-                if not os.path.isfile(out):
+                if not index.isfile(out):
                     red_exists[row["pixel"]] = False
                     break
 
@@ -967,6 +1014,70 @@ class DataBase:
         return
 
 
+    _task_timing_cols = ["name", "tasktype", "procs", "runtime", "estimate",
+        "timefactor", "maxmem", "stamp"]
+
+
+    def create_task_timing_table(self, cur=None):
+        """Create the table of the measured run times of the tasks, if it
+        does not exist.
+        """
+        cmd = "create table if not exists task_timing (name text, tasktype text, procs integer, runtime real, estimate real, timefactor real, maxmem real, stamp real)"
+        if cur is None :
+            with self.cursor() as cur:
+                cur.execute(cmd)
+        else :
+            cur.execute(cmd)
+        return
+
+
+    def insert_task_timing(self, timings):
+        """Record the measured run times of tasks.
+
+        Args:
+            timings (list): list of dictionaries with the task "name", the
+                number of processes "procs", the measured "runtime" in
+                minutes, the "estimate" of the task class in minutes, the
+                "timefactor" of the job, and the memory used by the task
+                "maxmem" in GB, the increase of the resident memory from
+                the start of the task to its peak (maximum over its
+                processes; see run._task_memory).
+
+        """
+        from .tasks.base import task_type
+        rows = list()
+        for tim in timings:
+            row = dict(tim)
+            row["tasktype"] = task_type(row["name"])
+            row.setdefault("stamp", time.time())
+            rows.append(tuple([ row[x] for x in self._task_timing_cols ]))
+        with self.cursor() as cur:
+            self.create_task_timing_table(cur)
+            cur.executemany("insert into task_timing values ({})".format(
+                ",".join([self.placeholder]*len(self._task_timing_cols))),
+                rows)
+        return
+
+
+    def select_task_timing(self, tasktype):
+        """Get the measured run times of the tasks of a type.
+
+        Args:
+            tasktype (str): the type of the tasks.
+
+        Returns:
+            list: a dictionary for each run, see insert_task_timing.
+
+        """
+        with self.cursor() as cur:
+            if not self._have_table(cur, "task_timing"):
+                return list()
+            cur.execute("select * from task_timing where tasktype = {}"\
+                .format(self.placeholder), (tasktype,))
+            entries = cur.fetchall()
+        return [ dict(zip(self._task_timing_cols, x)) for x in entries ]
+
+
 class DataBaseSqlite(DataBase):
     """Pipeline database using sqlite3 as the backend.
 
@@ -975,9 +1086,15 @@ class DataBaseSqlite(DataBase):
             a temporary database is created in memory.
         mode (str): if "r", the database is open in read-only mode.  If "w",
             the database is open in read-write mode and created if necessary.
+        wal (bool): if True, use write-ahead logging, so that readers are not
+            blocked by a writer.  A database already using write-ahead logging
+            keeps it.
+
+    The connection is opened on first use and kept open by each process for
+    the life of the object.
 
     """
-    def __init__(self, path, mode):
+    def __init__(self, path, mode, wal=False):
         super(DataBaseSqlite, self).__init__()
 
         self._path = path
@@ -998,16 +1115,33 @@ class DataBaseSqlite(DataBase):
 
         # Journaling options
         self._journalmode = "persist"
+        if wal:
+            self._journalmode = "wal"
         self._syncmode = "normal"
 
+        # Process owning the open connection
+        self._pid = None
+
         if create:
             self.initdb()
         return
 
 
+    def __getstate__(self):
+        # The connection is not shared with other processes
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+
     def _open(self):
         import sqlite3
 
+        if (self._conn is not None) and (self._pid == os.getpid()):
+            return
+        self._pid = os.getpid()
+
         if self._path is None:
             # We are opening an in-memory DB
             self._conn = sqlite3.connect(":memory:")
@@ -1023,9 +1157,12 @@ class DataBaseSqlite(DataBase):
             except:
                 self._conn = sqlite3.connect(self._path, timeout=self._busytime)
         if self._mode == 'w':
-            # In read-write mode, set the journaling
-            self._conn.execute("pragma journal_mode={}"\
-                .format(self._journalmode))
+            # In read-write mode, set the journaling, without switching a
+            # database out of write-ahead logging.
+            current = self._conn.execute("pragma journal_mode").fetchone()[0]
+            if current != "wal":
+                self._conn.execute("pragma journal_mode={}"\
+                    .format(self._journalmode))
             self._conn.execute("pragma synchronous={}".format(self._syncmode))
             # Other tuning options
             self._conn.execute("pragma temp_store=memory")
@@ -1035,8 +1172,10 @@ class DataBaseSqlite(DataBase):
 
 
     def _close(self):
-        del self._conn
+        if (self._conn is not None) and (self._pid == os.getpid()):
+            self._conn.close()
         self._conn = None
+        self._pid = None
         return
 
 
@@ -1045,23 +1184,34 @@ class DataBaseSqlite(DataBase):
         import sqlite3
         self._open()
         cur = self._conn.cursor()
-        cur.execute("begin transaction")
+        # A cursor opened while another one is in use joins its transaction
+        nested = self._conn.in_transaction
+        if not nested:
+            cur.execute("begin transaction")
         try:
             yield cur
-        except sqlite3.DatabaseError as err:
-            log = get_logger()
-            log.error(err)
-            cur.execute("rollback")
-            raise err
+        except Exception as err:
+            if isinstance(err, sqlite3.DatabaseError):
+                log = get_logger()
+                log.error(err)
+            if (not nested) and self._conn.in_transaction:
+                cur.execute("rollback")
+            raise
         else:
-            try:
-                cur.execute("commit")
-            except sqlite3.OperationalError:
-                #- sqlite3 in py3.5 can't commit a read-only finished transaction
-                pass
+            if not nested:
+                try:
+                    cur.execute("commit")
+                except sqlite3.OperationalError:
+                    #- sqlite3 in py3.5 can't commit a read-only finished transaction
+                    pass
         finally:
-            del cur
-            self._close()
+            cur.close()
+
+
+    def _have_table(self, cur, table):
+        cur.execute("select name from sqlite_master where type = 'table' "
+            "and name = ?", (table,))
+        return cur.fetchone() is not None
 
 
     def initdb(self):
@@ -1081,6 +1231,9 @@ class DataBaseSqlite(DataBase):
 
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
+
+        if "task_timing" not in tables_in_db:
+            self.create_task_timing_table()
         return
 
 
@@ -1101,6 +1254,9 @@ class DataBasePostgres(DataBase):
             additional roles that should be granted access.
 
     """
+
+    placeholder = "%s"
+
     def __init__(self, host, port, dbname, user, schema=None, authorize=None):
         super(DataBasePostgres, self).__init__()
 
@@ -1176,6 +1332,12 @@ class DataBasePostgres(DataBase):
         return cur.fetchone()[0]
 
 
+    def _have_table(self, cur, table):
+        cur.execute("select exists(select 1 from pg_tables where "
+            "schemaname = %s and tablename = %s)", (self._schema, table))
+        return cur.fetchone()[0]
+
+
     @contextmanager
     def cursor(self, skipcheck=False):
         import psycopg2
@@ -1275,6 +1437,9 @@ class DataBasePostgres(DataBase):
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
 
+        if "task_timing" not in tables_in_db:
+            self.create_task_timing_table()
+
         return
 
 
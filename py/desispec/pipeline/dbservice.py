@@ -0,0 +1,287 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+desispec.pipeline.dbservice
+===========================
+
+Aggregation of the task states of a job on the process owning the database.
+
+When many process groups run tasks, every state change is a separate
+transaction on the production database, and with SQLite all the processes
+wait for the lock of a single file on a shared filesystem.  Instead, one
+process owns the database through a :class:`StateService`, and the other
+processes use a :class:`StateClient` in place of the database.  The service
+keeps the state of the tasks in memory, answers the queries of the clients
+from this copy, and writes the state changes to the database in bulk, with
+the postprocessing of the finished tasks and the measured run times of the
+tasks.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+from collections import OrderedDict
+
+from desiutil.log import get_logger
+
+
+#- MPI tags of the requests to the service and of its replies
+_tag_request = 4201
+_tag_reply = 4202
+
+#- requests answered by the service
+_replied = ("get", "get_timing")
+
+
+class StateService:
+    """Owner of the production database for the processes of a job.
+
+    Args:
+        db (pipeline.db.DB): the production database.
+        tasks (list): the names of the tasks of the job, whose states are
+            read at once.  Other tasks are read from the DB when requested.
+        interval (float): maximum time in seconds between writes of the
+            state changes to the DB.
+        maxbuffer (int): maximum number of state changes waiting to be
+            written to the DB.
+
+    """
+    def __init__(self, db, tasks=None, interval=10.0, maxbuffer=1000):
+        self._db = db
+        self._interval = interval
+        self._maxbuffer = maxbuffer
+        self._states = dict()
+        if (tasks is not None) and (len(tasks) > 0):
+            self._states.update(db.get_states(tasks))
+        self._pending = OrderedDict()
+        self._timing = list()
+        self._flushtime = time.time()
+        self.nupdate = 0
+        self.nflush = 0
+
+
+    def get_states(self, tasks):
+        """Get the state of many tasks.
+
+        Args:
+            tasks (list): list of task names.
+
+        Returns:
+            dict: the state of each task found in the DB.
+
+        """
+        missing = [ x for x in tasks if x not in self._states ]
+        if len(missing) > 0:
+            self._states.update(self._db.get_states(missing))
+        return { x : self._states[x] for x in tasks if x in self._states }
+
+
+    def set_states(self, tasks):
+        """Set the state of many tasks.
+
+        The states are written to the DB by the next :meth:`flush`, which
+        happens when too many changes are waiting.
+
+        Args:
+            tasks (list): list of tuples containing the task name and the
+                state to set.
+
+        """
+        for name, state in tasks:
+            self._states[name] = state
+            self._pending[name] = state
+            self.nupdate += 1
+        if len(self._pending) >= self._maxbuffer:
+            self.flush()
+        return
+
+
+    def insert_task_timing(self, timings):
+        """Record the measured run times of tasks, written to the DB by the
+        next :meth:`flush`.
+
+        Args:
+            timings (list): see DataBase.insert_task_timing.
+
+        """
+        self._timing.extend(timings)
+        return
+
+
+    def select_task_timing(self, tasktype):
+        """See DataBase.select_task_timing.
+        """
+        return self._db.select_task_timing(tasktype)
+
+
+    def flush(self):
+        """Write the waiting state changes to the DB in one transaction per
+        task type, and the measured run times in one transaction.
+
+        As with DataBase.set_states, the postprocessing of the tasks set to
+        "done" runs in the same transactions, so that the tasks depending on
+        them become ready during the job.  It may change the state of other
+        tasks, which are then read again from the DB.
+        """
+        log = get_logger()
+        if len(self._pending) > 0:
+            ndone = sum([ x == "done" for x in self._pending.values() ])
+            log.debug("writing {} task states, postprocessing {} tasks"\
+                .format(len(self._pending), ndone))
+            self._db.set_states(list(self._pending.items()),
+                postprocessing=True)
+            self._pending.clear()
+            self.nflush += 1
+            if ndone > 0:
+                self._states.update(self._db.get_states(list(self._states)))
+        if len(self._timing) > 0:
+            self._db.insert_task_timing(self._timing)
+            self._timing = list()
+        self._flushtime = time.time()
+        return
+
+
+    def request(self, cmd, data):
+        """Answer a request of a client.
+
+        Args:
+            cmd (str): "get", "set", "timing" or "get_timing".
+            data: the argument of :meth:`get_states`, :meth:`set_states`,
+                :meth:`insert_task_timing` or :meth:`select_task_timing`.
+
+        Returns:
+            the return value of the method.
+
+        """
+        if cmd == "get":
+            return self.get_states(data)
+        elif cmd == "set":
+            return self.set_states(data)
+        elif cmd == "timing":
+            return self.insert_task_timing(data)
+        elif cmd == "get_timing":
+            return self.select_task_timing(data)
+        else:
+            raise ValueError("unknown state service request {}".format(cmd))
+
+
+    def serve(self, comm, nclient, poll=0.01):
+        """Answer the requests of the clients until they all close.
+
+        The state changes are written to the DB at least every interval
+        seconds.
+
+        Args:
+            comm (mpi4py.MPI.Comm): the communicator of the service and of
+                its clients.
+            nclient (int): the number of clients.
+            poll (float): time in seconds to wait when there is no request.
+
+        """
+        import mpi4py.MPI as MPI
+        status = MPI.Status()
+        nclosed = 0
+        while nclosed < nclient:
+            if comm.Iprobe(source=MPI.ANY_SOURCE, tag=_tag_request,
+                status=status):
+                source = status.Get_source()
+                cmd, data = comm.recv(source=source, tag=_tag_request)
+                if cmd == "close":
+                    nclosed += 1
+                else:
+                    reply = self.request(cmd, data)
+                    if cmd in _replied:
+                        comm.send(reply, dest=source, tag=_tag_reply)
+            else:
+                time.sleep(poll)
+            if time.time() - self._flushtime > self._interval:
+                self.flush()
+        return
+
+
+    def close(self):
+        """Write the waiting state changes.
+        """
+        self.flush()
+        return
+
+
+class StateClient:
+    """Stand-in for the production database on the processes not owning it.
+
+    Only the task states and run times are available, see
+    :class:`StateService`.
+
+    Args:
+        service (StateService): the service, if in the same process.
+        comm (mpi4py.MPI.Comm): otherwise, a communicator including the
+            process of the service.
+        root (int): the rank of the service process in comm.
+
+    """
+    def __init__(self, service=None, comm=None, root=0):
+        if (service is None) == (comm is None):
+            raise ValueError("A StateClient needs either a service or a "
+                "communicator")
+        self._service = service
+        self._comm = comm
+        self._root = root
+
+
+    def _request(self, cmd, data):
+        if self._comm is None:
+            return self._service.request(cmd, data)
+        self._comm.send((cmd, data), dest=self._root, tag=_tag_request)
+        if cmd in _replied:
+            return self._comm.recv(source=self._root, tag=_tag_reply)
+        return None
+
+
+    def get_states(self, tasks):
+        """See DataBase.get_states.
+        """
+        return self._request("get", list(tasks))
+
+
+    def get_states_type(self, tasktype, tasks):
+        """See DataBase.get_states_type.
+        """
+        return self.get_states(tasks)
+
+
+    def set_states(self, tasks):
+        """See DataBase.set_states.
+        """
+        self._request("set", list(tasks))
+        return
+
+
+    def set_states_type(self, tasktype, tasks):
+        """See DataBase.set_states_type.
+        """
+        self.set_states(tasks)
+        return
+
+
+    def insert_task_timing(self, timings):
+        """See DataBase.insert_task_timing.
+        """
+        self._request("timing", list(timings))
+        return
+
+
+    def select_task_timing(self, tasktype):
+        """See DataBase.select_task_timing.
+        """
+        return self._request("get_timing", tasktype)
+
+
+    def close(self):
+        """Tell the service that this client is done.
+        """
+        if self._comm is not None:
+            self._comm.send(("close", None), dest=self._root,
+                tag=_tag_request)
+        return
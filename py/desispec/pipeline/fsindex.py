@@ -0,0 +1,131 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+desispec.pipeline.fsindex
+=========================
+
+Snapshot of the files of a production, to check the outputs of many tasks
+without one filesystem query per file.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+
+from desiutil.log import get_logger
+
+
+class FileIndex:
+    """Index of the files in the directories of a production.
+
+    Each directory is listed once with os.scandir, on the first check of a
+    file in it, and all the other checks are answered from this listing.
+    The listings can be saved to a file and reused by a later index, for
+    the directories whose modification time did not change.
+
+    Args:
+        path (str): optional file of listings written by :meth:`save`.
+
+    """
+    def __init__(self, path=None):
+        # directory -> file names
+        self._files = dict()
+        # directory -> (modification time in ns, time of listing in ns)
+        self._times = dict()
+        # directory -> (modification time in ns, file names) read from a
+        # file, not yet compared to the directory
+        self._saved = dict()
+        self.nscan = 0
+        if (path is not None) and os.path.isfile(path):
+            self.load(path)
+
+
+    def _listdir(self, dirname):
+        try:
+            mtime = os.stat(dirname).st_mtime_ns
+        except OSError:
+            # Missing directory
+            self._files[dirname] = frozenset()
+            return self._files[dirname]
+        saved = self._saved.pop(dirname, None)
+        if (saved is not None) and (saved[0] == mtime):
+            files = saved[1]
+        else:
+            with os.scandir(dirname) as entries:
+                files = frozenset([ x.name for x in entries if x.is_file() ])
+            self.nscan += 1
+        self._files[dirname] = files
+        self._times[dirname] = (mtime, time.time_ns())
+        return files
+
+
+    def listdir(self, dirname):
+        """Get the names of the files in a directory.
+
+        Args:
+            dirname (str): the directory.
+
+        Returns:
+            frozenset: the file names, empty if the directory does not exist.
+
+        """
+        if dirname in self._files:
+            return self._files[dirname]
+        return self._listdir(dirname)
+
+
+    def isfile(self, path):
+        """Check if a file exists, like os.path.isfile.
+
+        Args:
+            path (str): the file path.
+
+        Returns:
+            bool: True if the file exists.
+
+        """
+        dirname, filename = os.path.split(path)
+        return filename in self.listdir(dirname)
+
+
+    def load(self, path):
+        """Load the listings saved in a file.
+
+        Args:
+            path (str): the file written by :meth:`save`.
+
+        """
+        with open(path, "r") as f:
+            saved = json.load(f)
+        for dirname, (mtime, files) in saved.items():
+            if dirname not in self._files:
+                self._saved[dirname] = (mtime, frozenset(files))
+        return
+
+
+    def save(self, path):
+        """Save the listings to a file.
+
+        Directories modified in the last seconds before their listing
+        are not saved, since further changes may not modify their time.
+
+        Args:
+            path (str): the output file.
+
+        """
+        log = get_logger()
+        saved = { x : (y[0], sorted(y[1])) for x, y in self._saved.items() }
+        for dirname, (mtime, listtime) in self._times.items():
+            if listtime - mtime > 2e9:
+                saved[dirname] = (mtime, sorted(self._files[dirname]))
+        tmppath = "{}.tmp".format(path)
+        with open(tmppath, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmppath, path)
+        log.debug("saved the listings of {} directories to {}".format(
+            len(saved), path))
+        return
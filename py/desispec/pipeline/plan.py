@@ -27,6 +27,8 @@ from ..parallel import (dist_uniform, dist_discrete, dist_discrete_all,
 
 from .prod import task_read, task_write
 
+from .timing import runtime_model
+
 
 def nersc_machine(name, queue):
     """Return the properties of the specified NERSC host.
@@ -145,7 +147,8 @@ def compute_worker_tasks(tasktype, tasklist, tfactor, nworker,
         workersize (int):  The number of processes in each worker.
         startup (float):  Startup overhead in minutes for each worker.
         db (DataBase): the database to pass to the task runtime
-            calculation.
+            calculation.  If it contains measured run times of this task
+            type, the run times are predicted by the model fitted to them.
 
     Returns:
         (tuple):  The (sorted tasks, sorted runtime weights, dist) results
@@ -158,8 +161,15 @@ def compute_worker_tasks(tasktype, tasklist, tfactor, nworker,
     log = get_logger()
 
     # Run times for each task at this concurrency
-    tasktimes = [(x, tfactor * task_classes[tasktype].run_time(
-                    x, workersize, db=db)) for x in tasklist]
+    model = None
+    if db is not None:
+        model = runtime_model(db, tasktype)
+    if model is None:
+        run_time = task_classes[tasktype].run_time
+    else:
+        run_time = model.run_time
+    tasktimes = [(x, tfactor * run_time(x, workersize, db=db))
+                 for x in tasklist]
 
     # Sort the tasks by runtime to improve the partitioning
     tasktimes = list(sorted(tasktimes, key=lambda x: x[1]))[::-1]
@@ -16,6 +16,7 @@ import sys
 import time
 import random
 import signal
+import resource
 
 import numpy as np
 
@@ -30,6 +31,10 @@ from .prod import load_prod
 
 from .db import check_tasks
 
+from .dbservice import StateService, StateClient
+
+from .taskqueue import TaskQueue, MPITaskQueue, FileTaskQueue
+
 from .scriptgen import parse_job_env
 
 from .plan import compute_worker_tasks, worker_times
@@ -42,12 +47,90 @@ class TimeoutError(Exception):
 def _timeout_handler(signum, frame):
     raise TimeoutError('Timeout at {}'.format(time.asctime()))
 
+def _reset_peak_memory():
+    """Reset the peak resident memory of this process, so that it only
+    covers what runs next (Linux >= 4.0).
+
+    Returns:
+        bool: True if the peak was reset.
+
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _memory_peaks():
+    """Peak and current resident memory in kB of this process (VmHWM,
+    which can be reset, or the peak over its lifetime, and VmRSS) and the
+    peak of its terminated children.
+    """
+    peak = None
+    rss = None
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = float(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = float(line.split()[1])
+    except (IOError, OSError):
+        pass
+    if peak is None:
+        # Linux reports kB
+        peak = float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    if rss is None:
+        rss = peak
+    children = float(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak, rss, children
+
+
+def _task_memory(start, reset, comm=None):
+    """Peak memory in GB used by a task on the processes of comm.
+
+    This is the increase of the resident memory of the process during the
+    task, from its value at the start of the task (after the interpreter,
+    imports and caches of the previous tasks) to its peak, so that it is
+    comparable between hosts.
+
+    Args:
+        start (tuple): the _memory_peaks() at the start of the task, right
+            after _reset_peak_memory().
+        reset (bool): whether _reset_peak_memory() succeeded, in which case
+            the peak of the process only covers the task.  Otherwise the
+            peak of the task is only known if it exceeds the peak of the
+            process lifetime, and the increase of the current resident
+            memory is used as a lower bound.
+
+    Returns:
+        float: the maximum over the processes of comm of the increase of
+            the resident memory during the task.  Subprocesses count by
+            the increase of the peak of the terminated children.
+
+    """
+    peak, rss, children = _memory_peaks()
+    if reset or (peak > start[0]):
+        used = peak - start[1]
+    else:
+        used = rss - start[1]
+    used = max(0.0, used, children - start[2])
+    used /= 1024.0**2
+    if comm is not None:
+        import mpi4py.MPI as MPI
+        used = comm.allreduce(used, op=MPI.MAX)
+    return used
+
+
 def run_task(name, opts, comm=None, logfile=None, db=None):
     """Run a single task.
 
     Based on the name of the task, call the appropriate run function for that
     task.  Log output to the specified file.  Run using the specified MPI
     communicator and optionally update state to the specified database.
+    The run time of the successful tasks is recorded in the database.
 
     Note:  This function DOES NOT check the database or filesystem to see if
     the task has been completed or if its dependencies exist.  It assumes that
@@ -87,17 +170,22 @@ def run_task(name, opts, comm=None, logfile=None, db=None):
 
     #- Set timeout alarm to avoid runaway tasks
     old_sighandler = signal.signal(signal.SIGALRM, _timeout_handler)
-    expected_run_time = task_classes[ttype].run_time(name, procs=nproc, db=db)
+    estimated_run_time = task_classes[ttype].run_time(name, procs=nproc,
+        db=db)
 
     # Are we running on a slower/faster node than default timing?
     timefactor = float(os.getenv("DESI_PIPE_RUN_TIMEFACTOR", default=1.0))
-    expected_run_time *= timefactor
+    expected_run_time = estimated_run_time * timefactor
 
     signal.alarm(int(expected_run_time * 60))
     if rank == 0:
         log.info("Running {} with timeout {:.1f} min".format(
             name, expected_run_time))
 
+    #- Measure the memory of this task only
+    memory_reset = _reset_peak_memory()
+    memory_start = _memory_peaks()
+
     task_start_time = time.time()
     try:
         if logfile is None:
@@ -128,8 +216,18 @@ def run_task(name, opts, comm=None, logfile=None, db=None):
         #- Reset timeout alarm whether we finished cleanly or not
         signal.alarm(0)
 
+    task_run_time = (time.time() - task_start_time) / 60.0
+
     #- Restore previous signal handler
     signal.signal(signal.SIGALRM, old_sighandler)
+
+    #- Record the run time of the task for the planning of the next jobs
+    if db is not None:
+        maxmem = _task_memory(memory_start, memory_reset, comm)
+        if rank == 0 and failcount == 0:
+            db.insert_task_timing([dict(name=name, procs=nproc,
+                runtime=task_run_time, estimate=estimated_run_time,
+                timefactor=timefactor, maxmem=maxmem, stamp=time.time())])
     if rank == 0:
         log.debug("Finished with task {} sigalarm reset".format(name))
         log.debug("Task {} returning failcount {}".format(name, failcount))
@@ -309,7 +407,65 @@ def run_dist(tasktype, tasklist, db, nproc, procs_per_node, force=False):
     return worker_size, groups, worktasks, dist
 
 
-def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
+def _task_logfile(name, logdir):
+    """Get the log file of a task.
+
+    If the task has the "night" key in its name, then use that subdirectory.
+    Otherwise, if it has the "pixel" key, use the appropriate subdirectory.
+
+    """
+    from .tasks.base import task_classes, task_type
+
+    fields = task_classes[task_type(name)].name_split(name)
+
+    tasklog = None
+    if "night" in fields:
+        tasklogdir = os.path.join(logdir, io.get_pipe_nightdir(),
+                                  "{:08d}".format(fields["night"]))
+        # (this directory should have been made during the prod update)
+        tasklog = os.path.join(tasklogdir, "{}.log".format(name))
+    elif "pixel" in fields:
+        tasklogdir = os.path.join(logdir, "healpix",
+            io.healpix_subdirectory(fields["nside"],fields["pixel"]))
+        # When creating this directory, there MIGHT be conflicts from
+        # multiple processes working on pixels in the same
+        # sub-directories...
+        try :
+            if not os.path.isdir(os.path.dirname(tasklogdir)):
+                os.makedirs(os.path.dirname(tasklogdir))
+        except FileExistsError:
+            pass
+        try :
+            if not os.path.isdir(tasklogdir):
+                os.makedirs(tasklogdir)
+        except FileExistsError:
+            pass
+        tasklog = os.path.join(tasklogdir, "{}.log".format(name))
+    return tasklog
+
+
+def _queue_tasks(queue, comm_group, active):
+    """Iterate over the tasks taken from the queue by a process group.
+
+    The first process of the group takes the tasks and sends them to the
+    others.
+
+    """
+    if not active:
+        return
+    while True:
+        name = None
+        if queue is not None:
+            name = queue.next_task()
+        if comm_group is not None:
+            name = comm_group.bcast(name, root=0)
+        if name is None:
+            return
+        yield name
+
+
+def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False,
+    state_service=False, scheduler=None, queue_file=None):
     """Run a collection of tasks of the same type.
 
     This function requires that the DESI environment variables are set to
@@ -319,7 +475,9 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     per task to split the communicator and form groups of processes of
     the desired size.  It then takes the list of tasks and uses their relative
     run time estimates to assign tasks to the process groups.  Each process
-    group loops over its assigned tasks.
+    group loops over its assigned tasks.  With the "dynamic" scheduler, the
+    process groups instead take the next task from a shared queue, in order
+    of decreasing run time estimates, whenever they finish a task.
 
     If the database is not specified, no state tracking will be done and the
     filesystem will be checked as needed to determine the current state.
@@ -337,13 +495,27 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
         db (pipeline.db.DB): The optional database to update.
         force (bool): If True, ignore database and filesystem state and just
             run the tasks regardless.
+        state_service (bool): If True, the first process owns the database
+            and runs no task; the other processes send it the task states
+            (see desispec.pipeline.dbservice).  This requires more than one
+            process, and only applies to the task types not updating other
+            tables of the database.
+        scheduler (str): "static" to assign the tasks to the process groups
+            in advance, or "dynamic" to use a shared queue.  By default,
+            $DESI_PIPE_RUN_SCHEDULER or "static".
+        queue_file (str): with the dynamic scheduler, share the queue
+            through this file, for instance with other jobs.  The file is
+            removed when the last job is done with it.  By default, the
+            queue is in the memory of the first process, which requires
+            the asynchronous progress of MPI one-sided operations (see
+            desispec.pipeline.taskqueue.MPITaskQueue).
 
     Returns:
         tuple: the number of ready tasks, number that are done, and the number
             that failed.
 
     """
-    from .tasks.base import task_classes, task_type
+    from .tasks.base import task_classes, task_type, BaseTask
     log = get_logger()
 
     nproc = 1
@@ -352,6 +524,20 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
         nproc = comm.size
         rank = comm.rank
 
+    if scheduler is None:
+        scheduler = parse_job_env().get("scheduler", "static")
+    if scheduler not in ("static", "dynamic"):
+        raise ValueError("unknown scheduler '{}'".format(scheduler))
+
+    if state_service and (db is not None) and (nproc > 1):
+        if type(task_classes[tasktype]).run_and_update \
+            is BaseTask.run_and_update:
+            return _run_task_list_service(tasktype, tasklist, opts, comm, db,
+                force, scheduler, queue_file)
+        if rank == 0:
+            log.warning("{} tasks update the database directly".format(
+                tasktype))
+
     # Compute the number of processes that share a node.
 
     procs_per_node = 1
@@ -409,57 +595,51 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     failcount = 0
     group_failcount = 0
 
+    queue = None
+    if scheduler == "dynamic":
+        # The groups take the tasks (sorted by decreasing run time) one at
+        # a time from a shared queue.
+        if group_rank == 0:
+            if queue_file is not None:
+                queue = FileTaskQueue(queue_file, worktasks)
+                if comm_rank is not None:
+                    # all groups use the file before any of them closes it
+                    comm_rank.Barrier()
+            elif comm_rank is not None:
+                queue = MPITaskQueue(comm_rank, worktasks)
+            else:
+                queue = TaskQueue(worktasks)
+        grouptasks = _queue_tasks(queue, comm_group, group_ntask > 0)
+    else:
+        grouptasks = worktasks[group_firsttask:group_firsttask + group_ntask]
+
     if group_ntask > 0:
         if group_rank == 0:
-            log.debug(
-                "Group {}, running tasks {} to {}".format(
-                    group,
-                    group_firsttask,
-                    (group_firsttask + group_ntask - 1)
+            if queue is None:
+                log.debug(
+                    "Group {}, running tasks {} to {}".format(
+                        group,
+                        group_firsttask,
+                        (group_firsttask + group_ntask - 1)
+                    )
                 )
-            )
+            else:
+                log.debug("Group {}, running tasks from the queue".format(
+                    group))
 
-        for t in range(group_firsttask, group_firsttask + group_ntask):
-            # For this task, determine the output log file.  If the task has
-            # the "night" key in its name, then use that subdirectory.
-            # Otherwise, if it has the "pixel" key, use the appropriate
-            # subdirectory.
-            tt = task_type(worktasks[t])
-            fields = task_classes[tt].name_split(worktasks[t])
+        for name in grouptasks:
+            tasklog = _task_logfile(name, logdir)
 
-            tasklog = None
-            if "night" in fields:
-                tasklogdir = os.path.join(logdir, io.get_pipe_nightdir(),
-                                          "{:08d}".format(fields["night"]))
-                # (this directory should have been made during the prod update)
-                tasklog = os.path.join(tasklogdir,
-                    "{}.log".format(worktasks[t]))
-            elif "pixel" in fields:
-                tasklogdir = os.path.join(logdir, "healpix",
-                    io.healpix_subdirectory(fields["nside"],fields["pixel"]))
-                # When creating this directory, there MIGHT be conflicts from
-                # multiple processes working on pixels in the same
-                # sub-directories...
-                try :
-                    if not os.path.isdir(os.path.dirname(tasklogdir)):
-                        os.makedirs(os.path.dirname(tasklogdir))
-                except FileExistsError:
-                    pass
-                try :
-                    if not os.path.isdir(tasklogdir):
-                        os.makedirs(tasklogdir)
-                except FileExistsError:
-                    pass
-                tasklog = os.path.join(tasklogdir,
-                    "{}.log".format(worktasks[t]))
-
-            failedprocs = run_task(worktasks[t], options, comm=comm_group,
+            failedprocs = run_task(name, options, comm=comm_group,
                 logfile=tasklog, db=db)
 
             if failedprocs > 0:
                 group_failcount += 1
                 log.debug("{} failed; group_failcount now {}".format(
-                    worktasks[t], group_failcount))
+                    name, group_failcount))
+
+    if queue is not None:
+        queue.close()
 
     failcount = group_failcount
 
@@ -473,8 +653,9 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     if rank == 0:
         log.debug("Tasks done; {} failed".format(failcount))
 
-    if db is not None and rank == 0 :
-        # postprocess the successful tasks
+    if db is not None and rank == 0 and not isinstance(db, StateClient):
+        # postprocess the successful tasks (the state service does it for
+        # its clients)
 
         log.debug("postprocess the successful tasks")
 
@@ -492,6 +673,43 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     return ntask, ndone, failcount
 
 
+def _run_task_list_service(tasktype, tasklist, opts, comm, db, force,
+    scheduler, queue_file):
+    """Run a collection of tasks with the first process owning the database.
+
+    See run_task_list.  The other processes run the tasks with a StateClient
+    in place of the database.
+
+    Returns:
+        tuple: the number of ready tasks, number that are done, and the number
+            that failed.
+
+    """
+    import mpi4py.MPI as MPI
+    log = get_logger()
+
+    result = None
+    if comm.rank == 0:
+        comm.Split(color=MPI.UNDEFINED, key=comm.rank)
+        service = StateService(db, tasklist)
+        service.serve(comm, comm.size - 1)
+        service.close()
+        log.info("State service wrote {} task states in {} transactions"\
+            .format(service.nupdate, service.nflush))
+    else:
+        comm_work = comm.Split(color=0, key=comm.rank)
+        client = StateClient(comm=comm, root=0)
+        try:
+            result = run_task_list(tasktype, tasklist, opts, comm=comm_work,
+                db=client, force=force, scheduler=scheduler,
+                queue_file=queue_file)
+        finally:
+            client.close()
+
+    # The first worker process has the results
+    return comm.bcast(result, root=1)
+
+
 def run_task_list_db(tasktype, tasklist, comm=None):
     """Run a list of tasks using the pipeline DB and options.
 
@@ -52,6 +52,8 @@ def parse_job_env():
         par["workers"] = int(os.environ["DESI_PIPE_RUN_WORKERS"])
     if "DESI_PIPE_RUN_WORKER_SIZE" in os.environ:
         par["workersize"] = int(os.environ["DESI_PIPE_RUN_WORKER_SIZE"])
+    if "DESI_PIPE_RUN_SCHEDULER" in os.environ:
+        par["scheduler"] = os.environ["DESI_PIPE_RUN_SCHEDULER"]
     return par
 
 
@@ -0,0 +1,222 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+desispec.pipeline.taskqueue
+===========================
+
+Queues of tasks shared by the process groups of a job.
+
+With the dynamic scheduler, each process group takes the next task of the
+queue when it is done with the previous one, instead of running a list of
+tasks assigned in advance from their expected run times.  The tasks are
+taken in order, so they should be sorted by decreasing expected run time.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import fcntl
+
+import numpy as np
+
+from desiutil.log import get_logger
+
+
+class TaskQueue:
+    """Queue of tasks used by a single process.
+
+    Args:
+        tasks (list): the task names, in the order they should run.
+
+    """
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self._next = 0
+
+
+    def _next_index(self):
+        index = self._next
+        self._next += 1
+        return index
+
+
+    def next_task(self):
+        """Take the next task of the queue.
+
+        Returns:
+            str: the task name, or None if the queue is empty.
+
+        """
+        index = self._next_index()
+        if index < len(self.tasks):
+            return self.tasks[index]
+        return None
+
+
+    def close(self):
+        """Release the resources of the queue.
+        """
+        return
+
+
+class MPITaskQueue(TaskQueue):
+    """Queue of tasks shared by the processes of a communicator.
+
+    The index of the next task is a counter in the memory of the first
+    process, incremented with atomic one-sided MPI operations.  The creation
+    and the :meth:`close` of the queue are collective over the communicator.
+
+    The first process also runs tasks, so it does not call MPI while the
+    others take tasks from its counter.  Unless the network supports atomic
+    operations in hardware, the MPI library must then progress the
+    one-sided operations in the background, for instance with
+    MPICH_ASYNC_PROGRESS=1 with MPICH and Cray MPI.  Otherwise the processes taking a task may wait until
+    the first process is done with its own task; use a
+    :class:`FileTaskQueue` in that case.
+
+    Args:
+        comm (mpi4py.MPI.Comm): the communicator of the processes taking
+            tasks, usually the first process of each group.
+        tasks (list): the task names, the same on all processes.
+
+    """
+    def __init__(self, comm, tasks):
+        import mpi4py.MPI as MPI
+        super(MPITaskQueue, self).__init__(tasks)
+        self._comm = comm
+        self._one = np.ones(1, dtype=np.int64)
+        self._index = np.zeros(1, dtype=np.int64)
+        if comm.rank == 0:
+            self._counter = np.zeros(1, dtype=np.int64)
+            self._win = MPI.Win.Create(self._counter, comm=comm)
+        else:
+            self._counter = None
+            self._win = MPI.Win.Create(None, comm=comm)
+        comm.Barrier()
+
+
+    def _next_index(self):
+        import mpi4py.MPI as MPI
+        self._win.Lock(0, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(self._one, self._index, 0, 0, MPI.SUM)
+        self._win.Unlock(0)
+        return int(self._index[0])
+
+
+    def close(self):
+        """Free the MPI window of the counter (collective).
+        """
+        self._comm.Barrier()
+        self._win.Free()
+        return
+
+
+class FileTaskQueue(TaskQueue):
+    """Queue of tasks in a file, shared by independent processes.
+
+    The first process creates the file with its list of tasks, and the
+    others use the list in the file.  The first line of the file has the
+    index of the next task, updated under an exclusive lock of the file.
+    Each process holds a shared lock of a second file, the path with a
+    ".users" suffix, until it calls :meth:`close`; the last process to
+    close the queue removes both files.
+
+    A file left by a previous run is stale if no process holds the lock of
+    the users file (the locks of a process that crashed are released by
+    the system).  It is then reset with the tasks of the new process, so
+    that a rerun with the same file runs the tasks that are not done yet.
+    If all the tasks of the file were taken by processes that still use
+    it, the tasks of the new process are added at the end of the file.
+
+    Args:
+        path (str): the queue file.
+        tasks (list): the task names, used if the file does not exist or
+            is stale.
+
+    """
+    _width = 12
+
+    def __init__(self, path, tasks):
+        self._path = path
+        with self._locked() as f:
+            #- under the lock of the queue file, no other process takes or
+            #- releases the lock of the users file
+            self._users = open(self._users_path(), "a")
+            try:
+                fcntl.flock(self._users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                alone = True
+            except BlockingIOError:
+                alone = False
+            lines = f.read().splitlines()
+            if (len(lines) > 0) and alone:
+                log = get_logger()
+                log.info("Resetting the stale queue file {}".format(path))
+                lines = []
+            if len(lines) == 0:
+                lines = [self._format(0),] + list(tasks)
+                f.seek(0)
+                f.truncate()
+                f.write("\n".join(lines) + "\n")
+            elif int(lines[0]) >= len(lines) - 1:
+                #- all the tasks of the processes still using the file were
+                #- taken: add our tasks after them, the other processes do
+                #- not take tasks beyond their own list
+                lines[0] = self._format(len(lines) - 1)
+                lines.extend(tasks)
+                f.seek(0)
+                f.truncate()
+                f.write("\n".join(lines) + "\n")
+            fcntl.flock(self._users, fcntl.LOCK_SH)
+        super(FileTaskQueue, self).__init__(lines[1:])
+
+
+    def _users_path(self):
+        return self._path + ".users"
+
+
+    def _locked(self):
+        """Open the queue file with an exclusive lock.
+
+        The file may be removed by another process while we wait for the
+        lock, in which case we lock the new file.
+        """
+        while True:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o664)
+            f = os.fdopen(fd, "r+")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(self._path).st_ino == os.fstat(fd).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+
+    def _format(self, index):
+        return "{:0{}d}".format(index, self._width)
+
+
+    def _next_index(self):
+        with self._locked() as f:
+            index = int(f.readline())
+            f.seek(0)
+            f.write(self._format(index + 1))
+        return index
+
+
+    def close(self):
+        """Stop using the queue, and remove the files if no other process
+        uses it.
+        """
+        with self._locked():
+            self._users.close()
+            with open(self._users_path(), "a") as users:
+                try:
+                    fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                os.remove(self._users_path())
+                os.remove(self._path)
+        return
@@ -18,6 +18,7 @@ import time
 import socket
 import traceback
 from ..defs import (task_name_sep, task_state_to_int, task_int_to_state)
+from ..dbservice import StateClient
 
 from desiutil.log import get_logger
 
@@ -217,7 +218,8 @@ class BaseTask(object):
         ret = dict()
         with db.cursor() as cur:
             cur.execute(\
-                "select * from {} where name = '{}'".format(self._type,name))
+                "select * from {} where name = {}".format(self._type,
+                db.placeholder), (name,))
             row = cur.fetchone()
             if row is None:
                 raise RuntimeError("task {} not in database".format(name))
@@ -252,14 +254,14 @@ class BaseTask(object):
         """
         start = time.time()
 
-        cmd="update {} set state = {} where name = '{}'"\
-            .format(self._type, task_state_to_int[state], name)
+        cmd="update {} set state = {} where name = {}"\
+            .format(self._type, task_state_to_int[state], db.placeholder)
 
         if cur is None :
             with db.cursor() as cur:
-                cur.execute(cmd)
+                cur.execute(cmd, (name,))
         else :
-            cur.execute(cmd)
+            cur.execute(cmd, (name,))
 
         stop = time.time()
         log  = get_logger()
@@ -272,14 +274,14 @@ class BaseTask(object):
         """
 
         st = None
-        cmd = "select state from {} where name = '{}'"\
-            .format(self._type,name)
+        cmd = "select state from {} where name = {}"\
+            .format(self._type, db.placeholder)
         if cur is None :
             with db.cursor() as cur:
-                cur.execute(cmd)
+                cur.execute(cmd, (name,))
                 row = cur.fetchone()
         else :
-            cur.execute(cmd)
+            cur.execute(cmd, (name,))
             row = cur.fetchone()
 
         if row is None:
@@ -299,7 +301,10 @@ class BaseTask(object):
             name (str): the task name.
 
         """
-        self._state_set(db, name, state, cur)
+        if isinstance(db, StateClient):
+            db.set_states([(name, state)])
+        else:
+            self._state_set(db, name, state, cur)
         return
 
 
@@ -317,6 +322,11 @@ class BaseTask(object):
             str: the state.
 
         """
+        if isinstance(db, StateClient):
+            states = db.get_states([name])
+            if name not in states:
+                raise RuntimeError("task {} not in database".format(name))
+            return states[name]
         return self._state_get(db, name, cur)
 
 
@@ -0,0 +1,106 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+desispec.pipeline.timing
+========================
+
+Model of the run time of the pipeline tasks, fitted to the run times
+measured in previous jobs of the production.
+
+Each task class estimates the run time of a task from its properties and
+number of processes (``run_time()``).  The model corrects these estimates
+for each task type, with a power law fitted to the measured run times:
+``log(t) = a + b log(t_estimate)``, in minutes for a time factor of one.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from desiutil.log import get_logger
+
+
+class RuntimeModel:
+    """Run time model of a task type.
+
+    Args:
+        tasktype (str): the task type.
+        estimates (array): the run time estimates of the task class for
+            the measured runs, in minutes.
+        runtimes (array): the measured run times in minutes, divided by
+            the time factor of the job.
+        minfit (int): the minimum number of runs with different estimates
+            to fit the power law index; with fewer runs, only the scale of
+            the estimates is fitted.
+
+    """
+    def __init__(self, tasktype, estimates, runtimes, minfit=10):
+        self.tasktype = tasktype
+        x = np.log(np.asarray(estimates, dtype=np.float64))
+        y = np.log(np.asarray(runtimes, dtype=np.float64))
+        self.nrun = len(x)
+        if (self.nrun >= minfit) and (np.ptp(x) > 0.1):
+            self.slope, self.intercept = np.polyfit(x, y, 1)
+        else:
+            self.slope = 1.0
+            self.intercept = np.median(y - x)
+
+
+    def predict(self, estimates):
+        """Predict run times from the estimates of the task class.
+
+        Args:
+            estimates (float or array): the estimates in minutes.
+
+        Returns:
+            float or array: the run times in minutes.
+
+        """
+        return np.exp(self.intercept) * np.power(estimates, self.slope)
+
+
+    def run_time(self, name, procs, db=None):
+        """Predict the run time of a task, like the task class run_time().
+
+        Args:
+            name (str): the name of the task.
+            procs (int): the number of processes used by the task.
+            db (pipeline.db.DB): the optional database instance.
+
+        Returns:
+            float: the run time in minutes.
+
+        """
+        from .tasks.base import task_classes
+        return float(self.predict(
+            task_classes[self.tasktype].run_time(name, procs, db=db)))
+
+
+def runtime_model(db, tasktype, minrun=3):
+    """Fit the run time model of a task type to the runs recorded in the
+    production database.
+
+    Args:
+        db (pipeline.db.DB): the database.
+        tasktype (str): the task type.
+        minrun (int): the minimum number of recorded runs.
+
+    Returns:
+        RuntimeModel: the model, or None if there are not enough runs.
+
+    """
+    log = get_logger()
+    runs = [ x for x in db.select_task_timing(tasktype)
+             if (x["runtime"] > 0) and (x["estimate"] > 0)
+             and (x["timefactor"] > 0) ]
+    if len(runs) < minrun:
+        return None
+    estimates = [ x["estimate"] for x in runs ]
+    runtimes = [ x["runtime"] / x["timefactor"] for x in runs ]
+    model = RuntimeModel(tasktype, estimates, runtimes)
+    log.debug("{} run time model from {} runs: log(t) = {:.3f} + {:.3f} "
+        "log(t_estimate)".format(tasktype, model.nrun, model.intercept,
+        model.slope))
+    return model
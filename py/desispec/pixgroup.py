@@ -17,9 +17,61 @@ from desiutil.log import get_logger
 import desiutil.depend
 
 from . import io
+from .io.util import append_fits_extensions, appended_extensions
 from .maskbits import specmask
 
-def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
+_exp2healpix_index_dtype = [
+    ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
+    ('HEALPIX', 'i8'), ('NTARGETS', 'i8'), ('CAMERA', 'S2'), ('MTIME', 'f8')]
+
+def read_exp2healpix_index(filename, nside=64):
+    '''
+    Returns exp2healpix index table from filename, or None if missing
+
+    Args:
+        filename: path to exp2healpix index file
+        nside: healpix nside; returns None if the index used a different nside
+
+    The index has the columns of :func:`get_exp2healpix_map` plus CAMERA and
+    MTIME of the cframe file that was scanned. Spectrograph exposures without
+    any valid target coordinates have a single row with HEALPIX=-1.
+    '''
+    log = get_logger()
+    if not os.path.exists(filename):
+        return None
+
+    index, header = fitsio.read(filename, 'EXP2HEALPIX', header=True)
+    if header['HPXNSIDE'] != nside:
+        log.warning('Ignoring {} with nside={} instead of {}'.format(
+            filename, header['HPXNSIDE'], nside))
+        return None
+
+    return index.astype(_exp2healpix_index_dtype)
+
+def write_exp2healpix_index(filename, index, nside=64):
+    '''
+    Writes exp2healpix index table to filename
+
+    Args:
+        filename: path to output exp2healpix index file
+        index: table from :func:`read_exp2healpix_index`
+        nside: healpix nside used for the HEALPIX column
+
+    The file is written to a temporary file and then renamed so that
+    concurrent readers never see a partially written index.
+    '''
+    outdir = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(outdir, exist_ok=True)
+    header = fitsio.FITSHDR()
+    header['HPXNSIDE'] = nside
+    header['HPXNEST'] = True
+    tmpfile = filename + '.tmp'
+    fitsio.write(tmpfile, index, extname='EXP2HEALPIX', header=header,
+                 clobber=True)
+    os.rename(tmpfile, filename)
+
+def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None,
+                        indexfile=None, use_index=True):
     '''
     Returns table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS
 
@@ -28,6 +80,12 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
         specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
         nside: healpix nside, must be power of 2
         comm: MPI communicator
+        indexfile: override exp2healpix index file location
+        use_index: if False, do not read or update the index file
+
+    The healpix of previously scanned cframe files are read from the
+    exp2healpix index file; only new or modified cframe files are read
+    and added to the index.
 
     Note: This could be replaced by a DB query when the production DB exists.
     '''
@@ -40,11 +98,30 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
     if specprod_dir is None:
         specprod_dir = io.specprod_root()
 
+    if indexfile is None:
+        indexfile = io.findfile('exp2healpix', nside=nside,
+                                specprod_dir=specprod_dir)
+
     if nights is None and rank == 0:
         nights = io.get_nights(specprod_dir=specprod_dir)
 
+    index = None
+    if use_index and rank == 0:
+        index = read_exp2healpix_index(indexfile, nside=nside)
+
     if comm:
         nights = comm.bcast(nights, root=0)
+        index = comm.bcast(index, root=0)
+
+    nights = [int(night) for night in nights]
+    if index is None:
+        index = np.zeros(0, dtype=_exp2healpix_index_dtype)
+
+    #- Rows of previous scans, keyed by (night, expid, spectro)
+    indexed = dict()
+    for i in np.where(np.isin(index['NIGHT'], nights[rank::size]))[0]:
+        key = (index['NIGHT'][i], index['EXPID'][i], index['SPECTRO'][i])
+        indexed.setdefault(key, list()).append(tuple(index[i]))
 
     #-----
     #- Distribute nights over ranks, scanning their exposures to build
@@ -52,14 +129,13 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
 
     #- Rows to add to the output table
     rows = list()
+    nscanned = 0
 
     #- for tracking exposures that we've already mapped in a different band
     night_expid_spectro = set()
 
     for night in nights[rank::size]:
-        night = str(night)
-        nightdir = os.path.join(specprod_dir, 'exposures', night)
-        for expid in io.get_exposures(night, specprod_dir=specprod_dir,
+        for expid in io.get_exposures(str(night), specprod_dir=specprod_dir,
                                       raw=False):
             tmpframe = io.findfile('cframe', night, expid, 'r0',
                                    specprod_dir=specprod_dir)
@@ -76,9 +152,18 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
                 else:
                     night_expid_spectro.add((night, expid, spectro))
 
+                #- reuse the index if this file was already scanned
+                mtime = os.path.getmtime(filename)
+                previous = indexed.get((night, expid, spectro), [])
+                if len(previous) > 0 and \
+                   previous[0][5].decode() == camera and previous[0][6] == mtime:
+                    rows.extend(previous)
+                    continue
+
                 log.debug('Rank {} mapping {} {}'.format(rank, night,
                     os.path.basename(filename)))
                 sys.stdout.flush()
+                nscanned += 1
 
                 #- Determine healpix, allowing for NaN
                 columns = ['TARGET_RA', 'TARGET_DEC']
@@ -88,13 +173,19 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
                 ra, dec = ra[ok], dec[ok]
                 allpix = desimodel.footprint.radec2pix(nside, ra, dec)
 
-                #- Add rows for final output
-                for pix, ntargets in sorted(Counter(allpix).items()):
-                    rows.append((night, expid, spectro, pix, ntargets))
+                #- Add rows for final output; -1 placeholder if no targets
+                #- so that the index remembers that this file was scanned
+                counts = sorted(Counter(allpix).items())
+                if len(counts) == 0:
+                    counts = [(-1, 0)]
+                for pix, ntargets in counts:
+                    rows.append((night, expid, spectro, pix, ntargets,
+                                 camera, mtime))
 
     #- Collect rows from individual ranks back to rank 0
     if comm:
         rank_rows = comm.gather(rows, root=0)
+        nscanned = comm.allreduce(nscanned)
         if rank == 0:
             rows = list()
             for r in rank_rows:
@@ -104,10 +195,27 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
 
         rows = comm.bcast(rows, root=0)
 
+    rows = np.array(rows, dtype=_exp2healpix_index_dtype)
+
+    #- Update index with new scans, also dropping exposures that are gone
+    if use_index and rank == 0:
+        keep = ~np.isin(index['NIGHT'], nights)
+        if nscanned > 0 or np.count_nonzero(~keep) != len(rows):
+            index = np.concatenate([index[keep], rows])
+            try:
+                write_exp2healpix_index(indexfile, index, nside=nside)
+                log.info('Updated {} with {} new cframe files'.format(
+                    indexfile, nscanned))
+            except OSError as err:
+                log.warning('Unable to update {}: {}'.format(indexfile, err))
+
     #- Create the final output table
-    exp2healpix = np.array(rows, dtype=[
+    rows = rows[rows['HEALPIX'] >= 0]
+    exp2healpix = np.zeros(len(rows), dtype=[
         ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
         ('HEALPIX', 'i8'), ('NTARGETS', 'i8')])
+    for name in exp2healpix.dtype.names:
+        exp2healpix[name] = rows[name]
 
     return exp2healpix
 
@@ -145,6 +253,12 @@ class FrameLite(object):
         self.meta = header  #- for compatibility with Frame objects
         self.scores = scores
 
+    @property
+    def nbytes(self):
+        '''Total number of bytes of the wave, flux, ivar, mask and resolution arrays'''
+        return self.wave.nbytes + self.flux.nbytes + self.ivar.nbytes + \
+            self.mask.nbytes + self.resolution_data.nbytes
+
     def __getitem__(self, index):
         '''Return a subset of the original FrameLight'''
         if not isinstance(index, slice):
@@ -264,7 +378,7 @@ class SpectraLite(object):
         '''
         concatenate two SpectraLite objects into one
         '''
-        assert self.bands == other.bands
+        assert sorted(self.bands) == sorted(other.bands)
         for band in self.bands:
             assert np.all(self.wave[band] == other.wave[band])
         if self.scores is not None:
@@ -291,9 +405,18 @@ class SpectraLite(object):
 
         return SpectraLite(bands, wave, flux, ivar, mask, resolution_data, fibermap, scores)
 
-    def write(self, filename, header=None):
+    def write(self, filename, header=None, append=False):
         '''
         Write this SpectraLite object to `filename`
+
+        Options:
+            header: dict-like header keywords for the primary HDU
+            append: if True and `filename` exists, add these spectra as new
+                rows of its HDUs instead of overwriting it, see
+                :func:`desispec.io.util.append_fits_extensions`; only
+                desispec readers combine the appended rows, and
+                ``SpectraLite.read(filename).write(filename)`` rewrites
+                the file with a single HDU per EXTNAME
         '''
 
         #- create directory if missing
@@ -301,6 +424,10 @@ class SpectraLite(object):
         if dirname != '':
             os.makedirs(dirname, exist_ok=True)
 
+        if append and os.path.exists(filename):
+            self._append(filename, header)
+            return
+
         tmpout = filename + '.tmp'
 
         #- work around c/fitsio bug that appends spaces to string column values
@@ -312,6 +439,7 @@ class SpectraLite(object):
 
         header = io.fitsheader(header)
         desiutil.depend.add_dependencies(header)
+        header['NAPPEND'] = (0, 'Number of appends to the HDUs')
         hdus = fits.HDUList()
         hdus.append(fits.PrimaryHDU(None, header))
         hdus.append(fits.convenience.table_to_hdu(fm))
@@ -335,20 +463,51 @@ class SpectraLite(object):
 
         os.rename(tmpout, filename)
 
+    def _append(self, filename, header=None):
+        '''
+        Add the spectra of this object to the existing file `filename`
+        '''
+        bands = sorted(self.bands)
+        with fitsio.FITS(filename) as fx:
+            for band in bands:
+                wave = fx[band.upper()+'_WAVELENGTH'].read()
+                assert np.all(wave == self.wave[band])
+            assert ('SCORES' in fx) == (self.scores is not None)
+
+        rows = dict(FIBERMAP=self.fibermap)
+        if self.scores is not None:
+            rows['SCORES'] = self.scores
+        compress = dict()
+        for band in bands:
+            upperband = band.upper()
+            rows[upperband+'_FLUX'] = self.flux[band]
+            rows[upperband+'_IVAR'] = self.ivar[band]
+            rows[upperband+'_MASK'] = self.mask[band]
+            rows[upperband+'_RESOLUTION'] = self.resolution_data[band]
+            compress[upperband+'_MASK'] = 'gzip'
+        append_fits_extensions(filename, rows, header=header, compress=compress)
+
     @classmethod
     def read(cls, filename):
         '''
         Return a SpectraLite object read from `filename`
         '''
         with fitsio.FITS(filename) as fx:
+            #- concatenate the rows added with write(append=True)
+            extensions = appended_extensions(
+                [(hdu.get_extname(), hdu.get_extver()) for hdu in fx],
+                fx[0].read_header().get('NAPPEND', 0))
+            def read_rows(extname):
+                return np.concatenate([fx[i].read() for i in extensions[extname]])
+
             wave = dict()
             flux = dict()
             ivar = dict()
             mask = dict()
             resolution_data = dict()
-            fibermap = fx['FIBERMAP'].read()
-            if 'SCORES' in fx:
-                scores = fx['SCORES'].read()
+            fibermap = read_rows('FIBERMAP')
+            if 'SCORES' in extensions:
+                scores = read_rows('SCORES')
             else:
                 scores = None
 
@@ -356,10 +515,10 @@ class SpectraLite(object):
             for band in bands:
                 upperband = band.upper()
                 wave[band] = fx[upperband+'_WAVELENGTH'].read()
-                flux[band] = fx[upperband+'_FLUX'].read()
-                ivar[band] = fx[upperband+'_IVAR'].read()
-                mask[band] = fx[upperband+'_MASK'].read()
-                resolution_data[band] = fx[upperband+'_RESOLUTION'].read()
+                flux[band] = read_rows(upperband+'_FLUX')
+                ivar[band] = read_rows(upperband+'_IVAR')
+                mask[band] = read_rows(upperband+'_MASK')
+                resolution_data[band] = read_rows(upperband+'_RESOLUTION')
 
         return SpectraLite(bands, wave, flux, ivar, mask, resolution_data, fibermap, scores)
 
@@ -561,7 +720,7 @@ def frames2spectra(frames, pix=None, nside=64):
 
     return SpectraLite(bands, wave, flux, ivar, mask, resolution_data, fibermap, scores)
 
-def update_frame_cache(frames, framekeys, specprod_dir=None):
+def update_frame_cache(frames, framekeys, specprod_dir=None, max_memory=None):
     '''
     Update a cache of FrameLite objects to match requested frameskeys
 
@@ -569,21 +728,35 @@ def update_frame_cache(frames, framekeys, specprod_dir=None):
         frames: dict of FrameLite objects, keyed by (night, expid, camera)
         framekeys: list of desired (night, expid, camera)
 
+    Options:
+        specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
+        max_memory: memory budget of the cache in bytes; if None, only
+            keep the frames in `framekeys`
+
     Updates `frames` in-place
 
     Notes:
         `frames` is dictionary, `framekeys` is list.
-        When finished, the keys of `frames` match the entries in `framekeys`
+        When finished, `frames` contains all entries in `framekeys`.
+        If `max_memory` is None, the keys of `frames` match the entries in
+        `framekeys`; otherwise other frames are kept in least recently used
+        order and the oldest ones are dropped until the cache fits in
+        `max_memory` bytes (or only has frames in `framekeys`).
     '''
 
     log = get_logger()
 
-    #- Drop frames that we no longer need
+    #- Drop frames that we no longer need, or mark the frames that we
+    #- need as most recently used
     ndrop = 0
+    wanted = set(framekeys)
     for key in list(frames.keys()):
-        if key not in framekeys:
-            ndrop += 1
-            del frames[key]
+        if key not in wanted:
+            if max_memory is None:
+                ndrop += 1
+                del frames[key]
+        else:
+            frames[key] = frames.pop(key)
 
     nkeep = len(frames)
 
@@ -598,5 +771,64 @@ def update_frame_cache(frames, framekeys, specprod_dir=None):
             nadd += 1
             frames[key] = FrameLite.read(framefile)
 
+    #- Drop least recently used frames until we fit in the memory budget
+    if max_memory is not None:
+        nbytes = sum([frame.nbytes for frame in frames.values()])
+        for key in list(frames.keys()):
+            if nbytes <= max_memory:
+                break
+            if key not in wanted:
+                nbytes -= frames[key].nbytes
+                ndrop += 1
+                del frames[key]
+
     log.debug('Frame cache: {} kept, {} added, {} dropped, now have {}'.format(
          nkeep, nadd, ndrop, len(frames)))
+
+def order_healpix_by_overlap(exp2pix):
+    '''
+    Returns healpix pixels ordered so that consecutive pixels share frames
+
+    Args:
+        exp2pix: table with columns NIGHT EXPID SPECTRO HEALPIX,
+            e.g. from :func:`get_exp2healpix_map`
+
+    Returns (pixels, nframes) arrays, where nframes is the number of
+    spectrograph exposures contributing to each pixel
+
+    Starting from the lowest pixel number, the next pixel is the pixel
+    sharing the most spectrograph exposures with the current one, or the
+    lowest remaining pixel number if none of them share any.
+    '''
+    pix2exp = dict()
+    exp2pixset = dict()
+    for night, expid, spectro, pix in zip(exp2pix['NIGHT'], exp2pix['EXPID'],
+            exp2pix['SPECTRO'], exp2pix['HEALPIX']):
+        key = (night, expid, spectro)
+        pix2exp.setdefault(pix, set()).add(key)
+        exp2pixset.setdefault(key, set()).add(pix)
+
+    allpix = sorted(pix2exp.keys())
+    done = set()
+    pixels = list()
+    nextlowest = 0
+    while len(pixels) < len(allpix):
+        #- Count exposures shared with the unprocessed pixels
+        overlap = Counter()
+        if len(pixels) > 0:
+            for key in pix2exp[pixels[-1]]:
+                overlap.update(exp2pixset[key] - done)
+
+        if len(overlap) > 0:
+            pix = max(overlap.items(), key=lambda x: (x[1], -x[0]))[0]
+        else:
+            while allpix[nextlowest] in done:
+                nextlowest += 1
+            pix = allpix[nextlowest]
+
+        pixels.append(pix)
+        done.add(pix)
+
+    nframes = [len(pix2exp[pix]) for pix in pixels]
+
+    return np.array(pixels, dtype=np.int64), np.array(nframes, dtype=np.int64)
@@ -4,6 +4,8 @@ Preprocess raw DESI exposures
 
 import re
 import os
+import threading
+from collections import OrderedDict
 import numpy as np
 import scipy.interpolate
 from pkg_resources import resource_exists, resource_filename
@@ -128,6 +130,61 @@ def _overscan(pix, nsigma=5, niter=3):
     return overscan, readnoise
 
 
+def _overscan_per_row(pix, nsigma=5, niter=3):
+    """
+    Calculates overscan, readnoise for each row of overscan image pixels
+
+    This is a vectorized version of calling :func:`_overscan` on each row,
+    with identical results.
+
+    Args:
+        pix (ndarray) : 2D[nrows, ncols] overscan pixels from CCD image
+
+    Optional:
+        nsigma (float) : number of standard deviations for sigma clipping
+        niter (int) : number of iterative refits
+
+    Returns:
+        overscan (ndarray): 1D[nrows] mean, sigma-clipped value of each row
+        readnoise (ndarray): 1D[nrows] readnoise of each row
+
+    """
+    log=get_logger()
+    #- normalized median absolute deviation as robust version of RMS
+    overscan = np.median(pix, axis=1)
+    absdiff = np.abs(pix - overscan[:, np.newaxis])
+    readnoise = 1.4826*np.median(absdiff, axis=1)
+
+    #- rows with less than 5 pixels left after clipping keep these values
+    median_overscan = overscan.copy()
+    median_readnoise = readnoise.copy()
+    failed = np.zeros(pix.shape[0], dtype=bool)
+
+    #- input pixels are integers, so iteratively refit
+    for i in range(niter):
+        absdiff = np.abs(pix - overscan[:, np.newaxis])
+        good = absdiff < nsigma*readnoise[:, np.newaxis]
+        ngood = np.sum(good, axis=1)
+        newfailed = (ngood < 5) & ~failed
+        if np.any(newfailed):
+            log.error("error in sigma clipping for overscan measurement of {} rows, return result without clipping".format(np.sum(newfailed)))
+            overscan[newfailed] = median_overscan[newfailed]
+            readnoise[newfailed] = median_readnoise[newfailed]
+            failed |= newfailed
+
+        #- rows with the same number of good pixels are stacked together so
+        #- that the means are computed exactly as with 1D arrays
+        for n in np.unique(ngood[~failed]):
+            rows = np.where((ngood == n) & ~failed)[0]
+            goodpix = pix[rows][good[rows]].reshape(rows.size, n)
+            overscan[rows] = np.mean(goodpix, axis=1)
+            readnoise[rows] = np.std(goodpix, axis=1)
+
+    #- correct for bias from sigma clipping
+    readnoise[~failed] /= _clipped_std_bias(nsigma)
+
+    return overscan, readnoise
+
 def _savgol_clipped(data, window=15, polyorder=5, niter=0, threshold=3.):
     """
     Simple method to iteratively do a SavGol filter
@@ -285,6 +342,69 @@ def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
     log.info("done")
     return bkg
 
+#- calibration images read by get_calibration_image, keyed by
+#- (keyword, filename, modification time, size), least recently used first;
+#- disabled unless enabled with set_calibration_cache
+_calibration_images = OrderedDict()
+_calibration_images_lock = threading.Lock()
+_calibration_images_max_bytes = 0
+
+def set_calibration_cache(max_bytes):
+    """
+    Keep up to `max_bytes` of calibration images in memory, so that a process
+    preprocessing several exposures of the same camera reads them only once.
+
+    Args:
+        max_bytes: maximum size of the cached images; 0 disables the cache
+    """
+    global _calibration_images_max_bytes
+    with _calibration_images_lock:
+        _calibration_images_max_bytes = max_bytes
+        _trim_calibration_images()
+
+def _trim_calibration_images():
+    """
+    Drop the least recently used calibration images beyond the cache size;
+    the caller holds _calibration_images_lock.
+    """
+    nbytes = sum([x.nbytes for x in _calibration_images.values()])
+    while nbytes > _calibration_images_max_bytes and len(_calibration_images) > 0:
+        key, oldimage = _calibration_images.popitem(last=False)
+        nbytes -= oldimage.nbytes
+
+def _read_calibration_image(keyword, filename):
+    """
+    Returns a copy of calibration image `keyword` read from `filename`,
+    keeping recently used images in memory if enabled with
+    set_calibration_cache.
+    """
+    stat = os.stat(filename)
+    key = (keyword, os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    with _calibration_images_lock:
+        if key in _calibration_images:
+            _calibration_images.move_to_end(key)
+            return _calibration_images[key].copy()
+
+    if keyword == "BIAS" :
+        image = read_bias(filename=filename)
+    elif keyword == "MASK" :
+        image = read_mask(filename=filename)
+    elif keyword == "DARK" :
+        image = read_dark(filename=filename)
+    elif keyword == "PIXFLAT" :
+        image = read_pixflat(filename=filename)
+    else :
+        raise ValueError("Don't known how to read %s in %s"%(keyword,filename))
+
+    if _calibration_images_max_bytes <= 0 :
+        return image
+
+    with _calibration_images_lock:
+        _calibration_images[key] = image
+        _trim_calibration_images()
+
+    return image.copy()
+
 def get_calibration_image(cfinder,keyword,entry) :
     """Please provide documentation for this function!
     """
@@ -310,18 +430,11 @@ def get_calibration_image(cfinder,keyword,entry) :
 
 
     log.info("Using %s %s"%(keyword,filename))
-    if keyword == "BIAS" :
-        return read_bias(filename=filename)
-    elif keyword == "MASK" :
-        return read_mask(filename=filename)
-    elif keyword == "DARK" :
-        return read_dark(filename=filename)
-    elif keyword == "PIXFLAT" :
-        return read_pixflat(filename=filename)
-    else :
-        log.error("Don't known how to read %s in %s"%(keyword,path))
-        raise ValueError("Don't known how to read %s in %s"%(keyword,path))
-    return False
+    if keyword not in ("BIAS", "MASK", "DARK", "PIXFLAT") :
+        log.error("Don't known how to read %s in %s"%(keyword,filename))
+        raise ValueError("Don't known how to read %s in %s"%(keyword,filename))
+
+    return _read_calibration_image(keyword, filename)
 
 def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True, mask=True,
             bkgsub=False, nocosmic=False, cosmics_nsig=6, cosmics_cfudge=3., cosmics_c2fudge=0.5,
@@ -534,13 +647,11 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
 
         if use_overscan_row:
             raw_overscan_row = rawimage[ov_row].copy()
-            overscan_row = np.zeros_like(raw_overscan_row)
 
             # Remove overscan_col from overscan_row
             raw_overscan_squared = rawimage[ov_row[0], ov_col[1]].copy()
-            for row in range(raw_overscan_row.shape[0]):
-                o,r = _overscan(raw_overscan_squared[row])
-                overscan_row[row] = raw_overscan_row[row] - o
+            o,r = _overscan_per_row(raw_overscan_squared)
+            overscan_row = raw_overscan_row - o[:, np.newaxis]
 
         # Now remove the overscan_col
         nrows=raw_overscan_col.shape[0]
@@ -549,14 +660,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         rdnoise  = np.zeros(nrows)
         if (cfinder and cfinder.haskey('OVERSCAN'+amp) and cfinder.value("OVERSCAN"+amp).upper()=="PER_ROW") or overscan_per_row:
             log.info("Subtracting overscan per row for amplifier %s of camera %s"%(amp,camera))
-            for j in range(nrows) :
-                if np.isnan(np.sum(overscan_col[j])) :
-                    log.warning("NaN values in row %d of overscan of amplifier %s of camera %s"%(j,amp,camera))
-                    continue
-                o,r =  _overscan(raw_overscan_col[j])
-                #log.info("%d %f %f"%(j,o,r))
-                overscan_col[j]=o
-                rdnoise[j]=r
+            overscan_col, rdnoise = _overscan_per_row(raw_overscan_col)
         else :
             log.info("Subtracting average overscan for amplifier %s of camera %s"%(amp,camera))
             o,r =  _overscan(raw_overscan_col)
@@ -569,8 +673,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         log.info("Median rdnoise and overscan= %f %f"%(median_rdnoise,median_overscan))
 
         kk = parse_sec_keyword(header['CCDSEC'+amp])
-        for j in range(nrows) :
-            readnoise[kk][j] = rdnoise[j]
+        readnoise[kk][0:nrows] = rdnoise[:, np.newaxis]
 
         header['OVERSCN'+amp] = (median_overscan,'ADUs (gain not applied)')
         if gain != 1 :
@@ -607,17 +710,13 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
 
         data = rawimage[jj].copy()
         # Subtract columns
-        for k in range(nrows):
-            data[k] -= overscan_col[k]
+        data[0:nrows] -= overscan_col[:, np.newaxis]
         # And now the rows
         if use_overscan_row:
             # Savgol?
             if use_savgol:
                 log.info("Using savgol")
-                collapse_oscan_row = np.zeros(overscan_row.shape[1])
-                for col in range(overscan_row.shape[1]):
-                    o, _ = _overscan(overscan_row[:,col])
-                    collapse_oscan_row[col] = o
+                collapse_oscan_row, _ = _overscan_per_row(overscan_row.T)
                 oscan_row = _savgol_clipped(collapse_oscan_row, niter=0)
                 oimg_row = np.outer(np.ones(data.shape[0]), oscan_row)
                 data -= oimg_row
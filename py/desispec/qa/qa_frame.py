@@ -410,5 +410,10 @@ def qaframe_from_frame(frame_file, specprod_dir=None, make_plots=False, qaprod_d
                     qa_plots.frame_fluxcalib(qafig, qaframe, frame, fluxcalib)  # , model_tuple)
     # Write
     if write:
-        write_qa_frame(qafile, qaframe, verbose=True)
+        # Also in the QA store of the night, unless the QA goes elsewhere
+        store = None
+        if output_dir is None:
+            store = meta.findfile('qa_store', night=night, specprod_dir=specprod_dir,
+                                  qaprod_dir=qaprod_dir)
+        write_qa_frame(qafile, qaframe, verbose=True, store=store)
     return qaframe
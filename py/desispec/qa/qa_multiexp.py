@@ -20,6 +20,33 @@ from desiutil.log import get_logger
 # log = get_logger()
 
 
+def _init_frameqa_worker():
+    """ Use the Agg backend for the plots of the worker processes
+    """
+    from desispec.util import set_backend
+    set_backend('agg')
+
+
+def _frameqa_worker(args):
+    """ Run qaframe_from_frame in a worker process
+
+    Args:
+        args: tuple (frame_file, kwargs of qaframe_from_frame)
+
+    Returns:
+        tuple (frame_file, error message or None)
+    """
+    import traceback
+    from desispec.qa.qa_frame import qaframe_from_frame
+    frame_fil, kwargs = args
+    try:
+        qaframe_from_frame(frame_fil, **kwargs)
+    except Exception:
+        return frame_fil, traceback.format_exc()
+    # Do not send the QA_Frame back to the parent
+    return frame_fil, None
+
+
 class QA_MultiExp(object):
     def __init__(self, specprod_dir=None, qaprod_dir=None):
         """ Class to organize and execute QA for a DESI production
@@ -52,6 +79,8 @@ class QA_MultiExp(object):
         # dict to hold QA data
         #  Data Model :  key1 = Night(s);  key2 = Expids
         self.data = {}
+        # QA store files, when the QA is queried from them (see load_store)
+        self.qa_store = None
         #
         self.qaexp_outroot = None
 
@@ -81,9 +110,12 @@ class QA_MultiExp(object):
             self.qa_exps holds QA_Exposure objects
 
         """
+        from desispec.io import read_qa_store
         # Already loaded?  Should check for the table
         if (len(self.qa_exps) > 0) and (not redo):
             return
+        if (len(self.data) == 0) and (self.qa_store is not None):
+            self.data = read_qa_store(self.qa_store)
         # Nights
         for night in self.data:
             if (night not in nights) and (nights != 'all'):
@@ -117,6 +149,10 @@ class QA_MultiExp(object):
                Will be empty if none of the QA matches
         """
         from astropy.table import Table
+        from desispec.io import query_qa_store
+        # Single query of the QA stores?
+        if self.qa_store is not None:
+            return query_qa_store(self.qa_store, qatype, metric, nights=nights, channels=channels)
         out_list = []
         out_expid = []
         out_expmeta = []
@@ -173,37 +209,159 @@ class QA_MultiExp(object):
         # Load
         self.data = load_qa_multiexp(inroot)
 
-    def make_frameqa(self, make_plots=False, clobber=False, restrict_nights=None):
-        """ Work through the exposures and make QA for all frames
+    def load_store(self, restrict_nights=None):
+        """ Use the QA stores of the nights for get_qa_table()
+        and load_exposure_s2n(), instead of the data dict
+
+        Args:
+            restrict_nights: list, optional
+              Only use the QA of the input list of nights
+        """
+        from desispec.io import findfile
+        log = get_logger()
+        self.qa_store = []
+        for night in self.mexp_dict.keys():
+            if (restrict_nights is not None) and (night not in restrict_nights):
+                continue
+            filename = findfile('qa_store', night=night, qaprod_dir=self.qaprod_dir)
+            if os.path.isfile(filename):
+                self.qa_store.append(filename)
+            else:
+                log.warning("No QA store for night {}; generate it with desi_qa_prod --make_store".format(night))
+        self.data = {}
+
+    def make_store(self, restrict_nights=None):
+        """ Convert the QA files (YAML and slurped JSON) of the nights
+        into QA stores
+
+        Args:
+            restrict_nights: list, optional
+              Only convert the QA of the input list of nights
+        Returns:
+            files: list of str, the QA stores written
+        """
+        from desispec.io import convert_qa_yaml
+        files = []
+        for night in self.mexp_dict.keys():
+            if (restrict_nights is not None) and (night not in restrict_nights):
+                continue
+            filename = convert_qa_yaml(self.qaprod_dir, night)
+            if filename is not None:
+                files.append(filename)
+        return files
+
+    def frameqa_units(self, make_plots=False, clobber=False, restrict_nights=None):
+        """ List the frames whose QA needs to be (re)generated
+
+        The QA of a frame is up-to-date if its QA file is more recent
+        than the frame and the sky, flux calibration and cframe files
+        (fiberflat for a flat) it is derived from.
 
         Parameters:
             make_plots: bool, optional
-              Remake the plots too?
+              All the frames are listed, for their plots
             clobber: bool, optional
+              All the frames are listed
             restrict_nights: list, optional
-              Only perform QA on the input list of nights
+              Only list the frames of the input list of nights
         Returns:
-
+            units: list of (frame_file, clobber, weight) tuples, from the
+              largest weight (number of input files) to the smallest,
+              where clobber is True if the QA file is out-of-date
         """
-        # imports
-        from desispec.qa.qa_frame import qaframe_from_frame
+        from desispec.io import findfile
         from desispec.io.qa import qafile_from_framefile
 
-        # Loop on nights
+        units = []
         for night in self.mexp_dict.keys():
             if restrict_nights is not None:
                 if night not in restrict_nights:
                     continue
             for exposure in self.mexp_dict[night]:
-                # Object only??
                 for camera,frame_fil in self.mexp_dict[night][exposure].items():
                     # QA filename
-                    qafile, _ = qafile_from_framefile(frame_fil, qaprod_dir=self.qaprod_dir)
-                    if os.path.isfile(qafile) and (not clobber) and (not make_plots):
-                        continue
-                    # Make QA
-                    qaframe_from_frame(frame_fil, make_plots=make_plots, qaprod_dir=self.qaprod_dir,
-                                       clobber=clobber, specprod_dir=self.specprod_dir)
+                    qafile, qatype = qafile_from_framefile(frame_fil, qaprod_dir=self.qaprod_dir)
+                    # Input files
+                    if qatype == 'qa_data':
+                        filetypes = ['sky', 'fluxcalib', 'cframe']
+                    else:
+                        filetypes = ['fiberflat']
+                    inputs = [frame_fil]
+                    for filetype in filetypes:
+                        filename = findfile(filetype, night=night, expid=exposure, camera=camera,
+                                            specprod_dir=self.specprod_dir)
+                        if os.path.isfile(filename):
+                            inputs.append(filename)
+                    stale = False
+                    if os.path.isfile(qafile):
+                        qatime = os.path.getmtime(qafile)
+                        stale = any(os.path.getmtime(filename) > qatime for filename in inputs)
+                        if (not stale) and (not clobber) and (not make_plots):
+                            continue
+                    units.append((frame_fil, clobber or stale, len(inputs)))
+        # Largest first, for the load balancing
+        units.sort(key=lambda unit: -unit[2])
+        return units
+
+    def make_frameqa(self, make_plots=False, clobber=False, restrict_nights=None,
+                     nproc=1, comm=None):
+        """ Work through the exposures and make QA for all frames
+
+        The frames are distributed among the MPI processes of comm, if
+        provided, and each process runs the QA of its frames in a pool
+        of nproc worker processes, which render the plots with the Agg
+        backend.
+
+        Parameters:
+            make_plots: bool, optional
+              Remake the plots too?
+            clobber: bool, optional
+            restrict_nights: list, optional
+              Only perform QA on the input list of nights
+            nproc: int, optional
+              Number of worker processes (of each MPI process)
+            comm: mpi4py.MPI.Comm, optional
+        Returns:
+            failed: list of str, the frame files whose QA failed in
+              worker processes (the errors of a single process are raised)
+
+        """
+        from desispec.parallel import dist_discrete_all
+        log = get_logger()
+
+        if (comm is None) or (comm.rank == 0):
+            units = self.frameqa_units(make_plots=make_plots, clobber=clobber,
+                                       restrict_nights=restrict_nights)
+        else:
+            units = None
+        if comm is not None:
+            units = comm.bcast(units, root=0)
+            if len(units) > 0:
+                first, nunit = dist_discrete_all([unit[2] for unit in units], comm.size)[comm.rank]
+                units = units[first:first+nunit]
+
+        kwargs = dict(make_plots=make_plots, qaprod_dir=self.qaprod_dir,
+                      specprod_dir=self.specprod_dir)
+        failed = []
+        nproc = max(1, min(nproc, len(units)))
+        if nproc == 1:
+            from desispec.qa.qa_frame import qaframe_from_frame
+            for frame_fil, unit_clobber, _ in units:
+                qaframe_from_frame(frame_fil, clobber=unit_clobber, **kwargs)
+        else:
+            import multiprocessing
+            log.info("Frame QA of {} frames with {} processes".format(len(units), nproc))
+            args = [(frame_fil, dict(kwargs, clobber=unit_clobber)) for frame_fil, unit_clobber, _ in units]
+            with multiprocessing.Pool(nproc, initializer=_init_frameqa_worker) as pool:
+                # one frame at a time, for the load balancing
+                for frame_fil, error in pool.imap_unordered(_frameqa_worker, args, chunksize=1):
+                    if error is not None:
+                        log.error("Frame QA of {} failed: {}".format(frame_fil, error))
+                        failed.append(frame_fil)
+
+        if comm is not None:
+            failed = [frame_fil for rank_failed in comm.allgather(failed) for frame_fil in rank_failed]
+        return failed
 
     def slurp(self, make_frameqa=False, remove=True, **kwargs):
         """ Slurp all the individual QA files to generate
@@ -260,6 +418,24 @@ class QA_MultiExp(object):
         # Do it
         return write_qa_multiexp(outroot, self.data, **kwargs)
 
+    def write_qa_store(self):
+        """  Write the QA Exposures in the QA stores of their nights
+
+        Returns:
+            files : list of str
+
+        """
+        from desispec.io import findfile, write_qa_store
+        # Group by night
+        mdicts = {}
+        for qaexp in self.qa_exps:
+            mdicts.setdefault(qaexp.night, []).append(write_qa_exposure('foo', qaexp, ret_dict=True))
+        files = []
+        for night, mdict in mdicts.items():
+            filename = findfile('qa_store', night=night, qaprod_dir=self.qaprod_dir)
+            files.append(write_qa_store(filename, mdict))
+        return files
+
     def __repr__(self):
         """ Print formatting
         """
@@ -115,3 +115,4 @@ class QA_Prod(qa_multiexp.QA_MultiExp):
             # Write?
             if write_nights:
                 qaNight.write_qa_exposures()
+                qaNight.write_qa_store()
@@ -5,16 +5,15 @@ desispec.qproc.qextract
 import time
 import numpy as np
 from numpy.polynomial.legendre import legval
-import numba
-
 from desiutil.log import get_logger
 from desispec.xytraceset import XYTraceSet
 from desispec.image import Image
 from desispec.io.fibermap import empty_fibermap
 from desispec.qproc.qframe import QFrame
+from desispec.kernels import jit
 
 
-@numba.jit
+@jit('(float64[:,::1],float64[:,::1],float64[::1],int64)')
 def numba_extract(image_flux,image_var,x,hw=3) :
     n0=image_flux.shape[0]
     flux=np.zeros(n0)
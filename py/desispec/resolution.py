@@ -9,6 +9,7 @@ Use ``python -m desispec.resolution`` to run unit tests.
 
 from __future__ import division, absolute_import
 
+import numbers
 import numpy as np
 import scipy.sparse
 import scipy.special
@@ -153,6 +154,128 @@ class Resolution(scipy.sparse.dia_matrix):
         """
         return self.data
 
+
+class ResolutionStack(object):
+    """Resolution matrices of a set of spectra on a common wavelength grid.
+
+    Wraps the 3D resolution_data[nspec, ndiag, nwave] array (without copy)
+    and applies all the resolution matrices at once, with vectorized
+    shifted multiply-adds over the diagonals, instead of looping over
+    per-spectrum sparse Resolution objects.
+
+    Args:
+        data: 3D array[nspec, ndiag, nwave] of the diagonals of each
+            resolution matrix, in the same format as
+            scipy.sparse.dia_matrix.data, i.e. data[i,k,j] = R_i[j-offsets[k],j]
+
+    Options:
+        offsets: list of diagonals that the data represents. Default is
+            [ndiag//2, ..., -ndiag//2], the one used in FITS files.
+
+    Raises:
+        ValueError: Invalid input for initializing a resolution stack.
+    """
+    def __init__(self, data, offsets=None):
+        data = np.asarray(data)
+        if data.ndim != 3:
+            raise ValueError('Need resolution data with shape [nspec, ndiag, nwave], got {}'.format(data.shape))
+        nspec, ndiag, nwave = data.shape
+        if offsets is None:
+            if ndiag%2 == 0:
+                raise ValueError("Number of diagonals ({}) should be odd if offsets aren't included".format(ndiag))
+            offsets = np.arange(ndiag//2,-(ndiag//2)-1,-1)
+        offsets = np.asarray(offsets)
+        if offsets.size != ndiag:
+            raise ValueError('Number of offsets ({}) != number of diagonals ({})'.format(offsets.size, ndiag))
+
+        self.data = data
+        self.offsets = offsets
+        self.nspec = nspec
+        self.ndiag = ndiag
+        self.nwave = nwave
+
+    @property
+    def shape(self):
+        """(nspec, nwave, nwave) shape of the stack of matrices"""
+        return (self.nspec, self.nwave, self.nwave)
+
+    def __len__(self):
+        return self.nspec
+
+    def __getitem__(self, index):
+        """
+        Return a single Resolution if index is an integer,
+        otherwise a ResolutionStack with the selected spectra
+        """
+        if isinstance(index, numbers.Integral):
+            return self.to_sparse(index)
+        if not isinstance(index, slice):
+            index = np.atleast_1d(index)
+        return ResolutionStack(self.data[index], offsets=self.offsets)
+
+    def __iter__(self):
+        for i in range(self.nspec):
+            yield self.to_sparse(i)
+
+    def to_sparse(self, i):
+        """Returns the Resolution matrix of spectrum i"""
+        return Resolution(self.data[i], offsets=self.offsets)
+
+    def _broadcast(self, x):
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[np.newaxis, :]
+        if x.shape[-1] != self.nwave or x.shape[0] not in (1, self.nspec):
+            raise ValueError('Cannot apply resolution of shape {} to array of shape {}'.format(self.shape, x.shape))
+        return x
+
+    def dot(self, x):
+        """Apply the resolution matrices, y[i] = R_i.x[i]
+
+        Args:
+            x: 1D[nwave] array, convolved with all the resolution matrices,
+               or 2D[nspec, nwave] array, one row per spectrum
+
+        Returns:
+            2D[nspec, nwave] array
+        """
+        x = self._broadcast(x)
+        n = self.nwave
+        result = np.zeros((self.nspec, n), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            #- y[:,j] += R[:,j,j+offset]*x[:,j+offset]
+            #- with R[:,j,j+offset] = data[:,k,j+offset]
+            if offset >= 0:
+                result[:, :n-offset] += self.data[:, k, offset:] * x[:, offset:]
+            else:
+                result[:, -offset:] += self.data[:, k, :n+offset] * x[:, :n+offset]
+        return result
+
+    def transpose_dot(self, x):
+        """Apply the transposed resolution matrices, y[i] = R_i^T.x[i]
+
+        Args:
+            x: 1D[nwave] array or 2D[nspec, nwave] array, one row per spectrum
+
+        Returns:
+            2D[nspec, nwave] array
+        """
+        x = self._broadcast(x)
+        n = self.nwave
+        result = np.zeros((self.nspec, n), dtype=np.result_type(self.data, x))
+        for k, offset in enumerate(self.offsets):
+            #- y[:,j] += R[:,j-offset,j]*x[:,j-offset]
+            #- with R[:,j-offset,j] = data[:,k,j]
+            if offset >= 0:
+                result[:, offset:] += self.data[:, k, offset:] * x[:, :n-offset]
+            else:
+                result[:, :n+offset] += self.data[:, k, :n+offset] * x[:, -offset:]
+        return result
+
+    def mean(self):
+        """Returns the Resolution matrix with the average of the diagonals of all spectra"""
+        return Resolution(np.mean(self.data, axis=0), offsets=self.offsets)
+
 def _gauss_pix(x, mean=0.0, sigma=1.0):
     """
     Utility function to integrate Gaussian density within pixels
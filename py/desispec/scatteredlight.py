@@ -2,16 +2,166 @@
 Try to model and remove the scattered light
 '''
 import time
+import threading
+from collections import OrderedDict
 import numpy as np
+import scipy.fft
 import scipy.interpolate
 import astropy.io.fits as pyfits
-from scipy.signal import fftconvolve
-from scipy.interpolate import interp1d
 from desispec.image import Image
 from desiutil.log import get_logger
 from desispec.qproc.qextract import numba_extract
 
-def model_scattered_light(image,xyset) :
+#- convolution kernel shape found by fitting
+#- one arc lamp image, preproc-z0-00043688.fits
+#- with the code desi_fit_scattered_light_kernel
+#- (kernel value as a function of the radius in pixels)
+_kernel_nodes=np.array([0,5,10,20,30,40,50,100,150,200,300])
+_kernel_params=dict()
+_kernel_params['b0']=np.array([1.0000,0.5112,1.1413,0.6052,0.3623,0.3427,0.2278,0.0841,0.0352,0.0431,0.0000,])
+_kernel_params['b1']=np.array([1.0000,0.5314,1.3406,0.6678,0.2432,0.1110,0.0370,0.0202,0.0254,0.0284,0.0000,])
+_kernel_params['b2']=np.array([1.0000,0.8836,1.0667,1.3196,0.6735,0.2275,0.1053,0.1047,0.0521,0.0229,0.0000,])
+_kernel_params['b3']=np.array([1.0000,0.6919,1.0962,0.7958,0.5117,0.3656,0.1786,0.0596,0.0365,0.0188,0.0000,])
+_kernel_params['b4']=np.array([1.0000,0.2730,1.0030,0.4884,0.1662,0.1428,0.0620,0.0190,0.0353,0.0266,0.0000,])
+_kernel_params['b5']=np.array([1.0000,0.5347,1.1061,0.6693,0.4260,0.3748,0.2058,0.0450,0.0230,0.0192,0.0000,])
+_kernel_params['b6']=np.array([1.0000,0.7443,1.0783,0.8645,0.5807,0.4181,0.1993,0.0539,0.0317,0.0186,0.0000,])
+_kernel_params['b7']=np.array([1.0000,0.2317,1.0386,0.3037,0.1214,0.0642,0.0330,0.0143,0.0328,0.0236,0.0000,])
+_kernel_params['b8']=np.array([1.0000,0.4321,1.2369,0.4828,0.2282,0.1275,0.0506,0.0209,0.0423,0.0342,0.0000,])
+_kernel_params['b9']=np.array([1.0000,0.7482,1.1079,0.9641,0.4154,0.2291,0.0711,0.0611,0.0352,0.0175,0.0000,])
+_kernel_params['r0']=np.array([1.0000,1.0634,1.1767,0.9618,0.5883,0.6366,0.7888,0.0621,-0.0000,0.0000,0.0000,])
+_kernel_params['r1']=np.array([1.0000,1.1019,1.2270,0.9856,0.1717,0.1558,0.2142,-0.0000,0.0000,-0.0000,0.0000,])
+_kernel_params['r2']=np.array([1.0000,1.3130,1.1483,1.2472,0.7480,0.6697,0.1524,0.1562,0.0877,0.0292,0.0000,])
+_kernel_params['r3']=np.array([1.0000,1.2498,1.4043,1.0969,0.0860,0.1838,0.2942,0.0723,0.0682,-0.0000,0.0000,])
+_kernel_params['r4']=np.array([1.0000,1.3722,1.2573,1.6649,1.4019,1.6920,1.7492,0.4951,0.2254,0.1171,0.0000,])
+_kernel_params['r5']=np.array([1.0000,1.2123,1.2441,0.9732,0.0766,0.1110,0.0164,0.0174,0.0159,-0.0000,0.0000,])
+_kernel_params['r6']=np.array([1.0000,0.9967,1.0351,0.8091,0.3163,0.3794,0.5617,-0.0000,-0.0000,0.0000,0.0000,])
+_kernel_params['r7']=np.array([1.0000,0.9842,1.3198,1.1438,0.5061,0.5434,0.3175,0.0574,0.0156,0.0045,0.0000,])
+_kernel_params['r8']=np.array([1.0000,1.6838,0.9991,1.3340,0.5631,0.6579,0.5212,0.0942,-0.0000,0.0000,0.0000,])
+_kernel_params['r9']=np.array([1.0000,1.2776,1.2246,1.2775,0.9397,1.0657,0.6500,0.1212,0.0663,0.0303,0.0000,])
+_kernel_params['z0']=np.array([1.0000,1.2187,1.3041,0.8125,0.5324,0.5660,0.2830,0.0637,0.0915,0.0045,0.0000,])
+_kernel_params['z1']=np.array([1.0000,0.4882,0.9247,0.4095,0.1006,0.1259,0.0635,0.0022,0.0028,-0.0000,0.0000,])
+_kernel_params['z2']=np.array([1.0000,0.8952,1.0721,0.6368,0.3757,0.4195,0.1516,0.0792,0.1059,-0.0000,0.0000,])
+_kernel_params['z3']=np.array([1.0000,0.9608,1.0748,0.6764,0.4919,0.4806,0.3256,0.0496,0.0401,0.0000,0.0000,])
+_kernel_params['z4']=np.array([1.0000,1.6451,1.4325,1.1856,1.0914,1.2408,0.8704,0.1198,0.0826,0.0037,0.0000,])
+_kernel_params['z5']=np.array([1.0000,0.4804,0.7011,0.3784,0.0633,0.0954,0.1605,0.0275,0.0182,-0.0000,0.0000,])
+_kernel_params['z6']=np.array([1.0000,0.9678,1.2216,0.7484,0.4634,0.4786,0.3571,0.0569,0.0382,-0.0000,0.0000,])
+_kernel_params['z7']=np.array([1.0000,0.5858,0.8845,0.4246,0.1513,0.1859,0.1553,0.0152,0.0197,-0.0000,0.0000,])
+_kernel_params['z8']=np.array([1.0000,0.9139,1.0364,0.7501,0.5155,0.3914,0.1731,0.0134,0.0307,-0.0000,0.0000,])
+_kernel_params['z9']=np.array([1.0000,0.8205,1.0013,0.7501,0.4873,0.3066,0.1290,0.0576,0.0158,-0.0000,0.0000,])
+
+#- Fourier transforms of the kernels, keyed by (camera, shape, downsample),
+#- least recently used first
+_kernel_ffts = OrderedDict()
+_kernel_ffts_lock = threading.Lock()
+_kernel_ffts_max_bytes = 512*1024**2
+
+def scattered_light_kernel(camera, downsample=1) :
+    """
+    Returns the scattered light convolution kernel of a camera.
+
+    Args:
+      camera: str, camera name, like 'b0'
+      downsample: int, size in pixels of the blocks of the kernel grid
+
+    Returns:
+      kern: 2D[2*hw+1,2*hw+1] kernel with hw=300//downsample,
+      normalized to a sum of one on the full resolution grid.
+      With downsample>1, the kernel value of a block is the average
+      over its pixels.
+    """
+    par = _kernel_params[camera]
+    hw = _kernel_nodes[-1]//downsample
+    x1d = downsample*np.arange(-hw,hw+1)
+    kern = np.zeros((2*hw+1,2*hw+1))
+    # offsets of the pixels in a block with respect to its center
+    for dy in np.arange(downsample)-(downsample-1)/2. :
+        for dx in np.arange(downsample)-(downsample-1)/2. :
+            r = np.sqrt((x1d[:,None]+dy)**2+(x1d[None,:]+dx)**2)
+            kern += np.interp(r,_kernel_nodes,par)
+    kern /= np.sum(kern)*downsample**2
+    return kern
+
+def _kernel_fft(camera, shape, downsample=1) :
+    """
+    Returns the Fourier transform shape and the transform of the kernel
+    convolved with images of given shape, keeping the recently used ones
+    in memory.
+    """
+    key = (camera, tuple(shape), downsample)
+    with _kernel_ffts_lock:
+        if key in _kernel_ffts:
+            _kernel_ffts.move_to_end(key)
+            return _kernel_ffts[key]
+
+    kern = scattered_light_kernel(camera, downsample)
+    fshape = tuple([scipy.fft.next_fast_len(n+m-1, real=True) for n,m in zip(shape,kern.shape)])
+    value = (fshape, scipy.fft.rfft2(kern,fshape))
+
+    with _kernel_ffts_lock:
+        _kernel_ffts[key] = value
+        nbytes = sum([x[1].nbytes for x in _kernel_ffts.values()])
+        while nbytes > _kernel_ffts_max_bytes and len(_kernel_ffts) > 1:
+            key, oldvalue = _kernel_ffts.popitem(last=False)
+            nbytes -= oldvalue[1].nbytes
+
+    return value
+
+def _upsample(coarse, shape, downsample) :
+    """
+    Bilinear interpolation of an image of downsample x downsample pixel
+    blocks (values at the center of the blocks) on the pixels of an image
+    of given shape
+    """
+    result = coarse
+    for axis in range(2) :
+        u = (np.arange(shape[axis])-(downsample-1)/2.)/downsample
+        u = np.clip(u,0,coarse.shape[axis]-1)
+        i = np.minimum(u.astype(int),coarse.shape[axis]-2)
+        w = u-i
+        if axis == 0 :
+            result = (1-w)[:,None]*result[i]+w[:,None]*result[i+1]
+        else :
+            result = (1-w)[None,:]*result[:,i]+w[None,:]*result[:,i+1]
+    return result
+
+def convolve_scattered_light(image, camera, downsample=1) :
+    """
+    Convolution of an image with the scattered light kernel of a camera,
+    same as scipy.signal.fftconvolve(image,kern,mode="same") with the
+    Fourier transform of the kernel computed once per camera and image shape.
+
+    With downsample>1, the image is binned in downsample x downsample pixel
+    blocks, convolved with the kernel averaged over blocks, and interpolated
+    back to the pixels. For spectral traces, the maximum difference with the
+    full resolution convolution is about 0.5% of the maximum of the convolved
+    image for a downsample of 2, and 2% for 4.
+
+    Args:
+      image: 2D np.array
+      camera: str, camera name, like 'b0'
+      downsample: int, size in pixels of the blocks (1 = exact convolution)
+
+    Returns:
+      np.array of same shape as image
+    """
+    ny, nx = image.shape
+    if downsample > 1 :
+        nyb = (ny+downsample-1)//downsample
+        nxb = (nx+downsample-1)//downsample
+        padded = np.zeros((nyb*downsample,nxb*downsample))
+        padded[:ny,:nx] = image
+        image = padded.reshape(nyb,downsample,nxb,downsample).sum(axis=(1,3))
+
+    fshape, kfft = _kernel_fft(camera, image.shape, downsample)
+    hw = _kernel_nodes[-1]//downsample
+    conv = scipy.fft.irfft2(scipy.fft.rfft2(image,fshape)*kfft,fshape)
+    conv = conv[hw:hw+image.shape[0],hw:hw+image.shape[1]]
+
+    if downsample > 1 :
+        conv = _upsample(conv, (ny,nx), downsample)
+    return conv
+
+def model_scattered_light(image,xyset,downsample=1) :
     """
     Model the scattered light in a preprocessed image.
     The method consist in convolving the "direct" light
@@ -24,6 +174,11 @@ def model_scattered_light(image,xyset) :
       image: desispec.image.Image object
       xyset: desispec.xytraceset.XYTraceSet object
 
+    Options:
+
+      downsample: int, convolve the image binned in downsample x downsample
+        pixel blocks, see convolve_scattered_light (1 = exact convolution)
+
     Returns:
 
       model: np.array of same shape as image.pix
@@ -32,72 +187,24 @@ def model_scattered_light(image,xyset) :
     log = get_logger()
 
     log.info("compute mask")
-    mask_in  = np.zeros(image.pix.shape,dtype=int)
+    mask_in  = np.zeros(image.pix.shape,dtype=bool)
     
-    yy = np.arange(image.pix.shape[0],dtype=int)
-    for fiber in range(xyset.nspec) :
-        xx = xyset.x_vs_y(fiber,yy).astype(int)
-        for x,y in zip(xx,yy) :
-            mask_in[y,x-2:x+3] = 1
-    mask_in *= (image.mask==0)*(image.ivar>0)
+    ny,nx = image.pix.shape
+    yy = np.arange(ny,dtype=int)
+    xx = np.array([xyset.x_vs_y(fiber,yy) for fiber in range(xyset.nspec)]).astype(int)
+    yy2d = np.tile(yy,(xyset.nspec,1))
+    for dx in range(-2,3) :
+        ok = (xx+dx>=0)&(xx+dx<nx)
+        mask_in[yy2d[ok],xx[ok]+dx] = True
+    mask_in &= (image.mask==0)&(image.ivar>0)
               
     log.info("convolving mask*image")
     
-
-    # convolution kernel shape found by fitting 
-    # one arc lamp image, preproc-z0-00043688.fits
-    # with the code desi_fit_scattered_light_kernel
-    ##################################################################
-    nodes=np.array([0,5,10,20,30,40,50,100,150,200,300])
-    hw = nodes[-1]
-    x1d = np.linspace(-hw,hw,2*hw+1)
-    x2d = np.tile(x1d,(2*hw+1,1))
-    r   = np.sqrt(x2d**2+x2d.T**2)
-    
-    params=dict()
-    params['b0']=np.array([1.0000,0.5112,1.1413,0.6052,0.3623,0.3427,0.2278,0.0841,0.0352,0.0431,0.0000,])
-    params['b1']=np.array([1.0000,0.5314,1.3406,0.6678,0.2432,0.1110,0.0370,0.0202,0.0254,0.0284,0.0000,])
-    params['b2']=np.array([1.0000,0.8836,1.0667,1.3196,0.6735,0.2275,0.1053,0.1047,0.0521,0.0229,0.0000,])
-    params['b3']=np.array([1.0000,0.6919,1.0962,0.7958,0.5117,0.3656,0.1786,0.0596,0.0365,0.0188,0.0000,])
-    params['b4']=np.array([1.0000,0.2730,1.0030,0.4884,0.1662,0.1428,0.0620,0.0190,0.0353,0.0266,0.0000,])
-    params['b5']=np.array([1.0000,0.5347,1.1061,0.6693,0.4260,0.3748,0.2058,0.0450,0.0230,0.0192,0.0000,])
-    params['b6']=np.array([1.0000,0.7443,1.0783,0.8645,0.5807,0.4181,0.1993,0.0539,0.0317,0.0186,0.0000,])
-    params['b7']=np.array([1.0000,0.2317,1.0386,0.3037,0.1214,0.0642,0.0330,0.0143,0.0328,0.0236,0.0000,])
-    params['b8']=np.array([1.0000,0.4321,1.2369,0.4828,0.2282,0.1275,0.0506,0.0209,0.0423,0.0342,0.0000,])
-    params['b9']=np.array([1.0000,0.7482,1.1079,0.9641,0.4154,0.2291,0.0711,0.0611,0.0352,0.0175,0.0000,])
-    params['r0']=np.array([1.0000,1.0634,1.1767,0.9618,0.5883,0.6366,0.7888,0.0621,-0.0000,0.0000,0.0000,])
-    params['r1']=np.array([1.0000,1.1019,1.2270,0.9856,0.1717,0.1558,0.2142,-0.0000,0.0000,-0.0000,0.0000,])
-    params['r2']=np.array([1.0000,1.3130,1.1483,1.2472,0.7480,0.6697,0.1524,0.1562,0.0877,0.0292,0.0000,])
-    params['r3']=np.array([1.0000,1.2498,1.4043,1.0969,0.0860,0.1838,0.2942,0.0723,0.0682,-0.0000,0.0000,])
-    params['r4']=np.array([1.0000,1.3722,1.2573,1.6649,1.4019,1.6920,1.7492,0.4951,0.2254,0.1171,0.0000,])
-    params['r5']=np.array([1.0000,1.2123,1.2441,0.9732,0.0766,0.1110,0.0164,0.0174,0.0159,-0.0000,0.0000,])
-    params['r6']=np.array([1.0000,0.9967,1.0351,0.8091,0.3163,0.3794,0.5617,-0.0000,-0.0000,0.0000,0.0000,])
-    params['r7']=np.array([1.0000,0.9842,1.3198,1.1438,0.5061,0.5434,0.3175,0.0574,0.0156,0.0045,0.0000,])
-    params['r8']=np.array([1.0000,1.6838,0.9991,1.3340,0.5631,0.6579,0.5212,0.0942,-0.0000,0.0000,0.0000,])
-    params['r9']=np.array([1.0000,1.2776,1.2246,1.2775,0.9397,1.0657,0.6500,0.1212,0.0663,0.0303,0.0000,])
-    params['z0']=np.array([1.0000,1.2187,1.3041,0.8125,0.5324,0.5660,0.2830,0.0637,0.0915,0.0045,0.0000,])
-    params['z1']=np.array([1.0000,0.4882,0.9247,0.4095,0.1006,0.1259,0.0635,0.0022,0.0028,-0.0000,0.0000,])
-    params['z2']=np.array([1.0000,0.8952,1.0721,0.6368,0.3757,0.4195,0.1516,0.0792,0.1059,-0.0000,0.0000,])
-    params['z3']=np.array([1.0000,0.9608,1.0748,0.6764,0.4919,0.4806,0.3256,0.0496,0.0401,0.0000,0.0000,])
-    params['z4']=np.array([1.0000,1.6451,1.4325,1.1856,1.0914,1.2408,0.8704,0.1198,0.0826,0.0037,0.0000,])
-    params['z5']=np.array([1.0000,0.4804,0.7011,0.3784,0.0633,0.0954,0.1605,0.0275,0.0182,-0.0000,0.0000,])
-    params['z6']=np.array([1.0000,0.9678,1.2216,0.7484,0.4634,0.4786,0.3571,0.0569,0.0382,-0.0000,0.0000,])
-    params['z7']=np.array([1.0000,0.5858,0.8845,0.4246,0.1513,0.1859,0.1553,0.0152,0.0197,-0.0000,0.0000,])
-    params['z8']=np.array([1.0000,0.9139,1.0364,0.7501,0.5155,0.3914,0.1731,0.0134,0.0307,-0.0000,0.0000,])
-    params['z9']=np.array([1.0000,0.8205,1.0013,0.7501,0.4873,0.3066,0.1290,0.0576,0.0158,-0.0000,0.0000,])
-    
     camera = image.meta["CAMERA"].strip().lower()
 
-    
     log.info("camera= '{}'".format(camera))
-    par=params[camera]
-    
-    kern = np.interp(r,nodes,par)
-    kern /= np.sum(kern)
-    
-    ##################################################################
 
-    model  = fftconvolve(image.pix*mask_in,kern,mode="same")
+    model  = convolve_scattered_light(np.where(mask_in,image.pix,0.),camera,downsample)
     model *= (model>0)
     
     log.info("calibrating scattered light model between fiber bundles")
@@ -140,9 +247,16 @@ def model_scattered_light(image,xyset) :
     log.info("interpolating over bundles, using fitted calibration")
     xx = np.arange(image.pix.shape[1])
     
-    for j in range(ny) :
-        func = interp1d(xinter[:,j],mod_scale[:,j], kind='linear', bounds_error = False, fill_value=0.)
-        model[j] *= func(xx)
+    # sort the nodes of each row
+    order = np.argsort(xinter,axis=0)
+    xinter = np.take_along_axis(xinter,order,axis=0)
+    mod_scale = np.take_along_axis(mod_scale,order,axis=0)
+    # interpolate all rows at once, shifting the coordinates of each row
+    # by an offset larger than the range of the nodes of a row
+    offset = (np.max(xinter)-np.min(xinter)+1.)*yy
+    scale = np.interp((xx[None,:]+offset[:,None]).ravel(),(xinter+offset).T.ravel(),mod_scale.T.ravel()).reshape(model.shape)
+    scale *= (xx[None,:]>=xinter[0][:,None])&(xx[None,:]<=xinter[-1][:,None])
+    model *= scale
     model *= (model>0)
 
     if camera == 'r2' :
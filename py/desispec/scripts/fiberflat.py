@@ -15,7 +15,7 @@ from desispec.io import write_fiberflat
 from desispec.fiberflat import compute_fiberflat
 from desiutil.log import get_logger
 from desispec.io.qa import load_qa_frame
-from desispec.io import write_qa_frame
+from desispec.io import write_qa_frame, qastore_from_qafile
 from desispec.qa import qa_plots
 from desispec.cosmics import reject_cosmic_rays_1d
 
@@ -71,7 +71,7 @@ def main(args) :
         qaframe.run_qa('FIBERFLAT', (frame, fiberflat))
         # Write
         if args.qafile is not None:
-            write_qa_frame(args.qafile, qaframe)
+            write_qa_frame(args.qafile, qaframe, store=qastore_from_qafile(args.qafile, qaframe))
             log.info("successfully wrote {:s}".format(args.qafile))
         # Figure(s)
         if args.qafig is not None:
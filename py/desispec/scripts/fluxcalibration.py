@@ -5,7 +5,7 @@ from __future__ import absolute_import, division
 from desispec.io import read_frame
 from desispec.io import read_fiberflat
 from desispec.io import read_sky
-from desispec.io import write_qa_frame
+from desispec.io import write_qa_frame, qastore_from_qafile
 from desispec.io.fluxcalibration import read_stdstar_models
 from desispec.io.fluxcalibration import write_flux_calibration
 from desispec.io.qa import load_qa_frame
@@ -159,7 +159,7 @@ def main(args) :
         qaframe.run_qa('FLUXCALIB', (frame, fluxcalib))
         # Write
         if args.qafile is not None:
-            write_qa_frame(args.qafile, qaframe)
+            write_qa_frame(args.qafile, qaframe, store=qastore_from_qafile(args.qafile, qaframe))
             log.info("successfully wrote {:s}".format(args.qafile))
         # Figure(s)
         if args.qafig is not None:
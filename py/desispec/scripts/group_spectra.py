@@ -6,13 +6,16 @@ from __future__ import absolute_import, division, print_function
 import os, sys, time
 
 import numpy as np
+import fitsio
 
 from desiutil.log import get_logger
 
 from .. import io
+from ..io.util import appended_extensions
 from ..pixgroup import FrameLite, SpectraLite
 from ..pixgroup import (get_exp2healpix_map, add_missing_frames,
-        frames2spectra, update_frame_cache, FrameLite)
+        frames2spectra, update_frame_cache, FrameLite, order_healpix_by_overlap)
+from ..parallel import dist_discrete
 
 def parse(options=None):
     import argparse
@@ -26,6 +29,20 @@ def parse(options=None):
             help="Use MPI for parallelism")
     parser.add_argument("--inframes", type=str, nargs='*', help="input frame files; ignore --reduxdir, --nights, --nside")
     parser.add_argument("--outfile", type=str, help="output to this file; only used with --inframes")
+    parser.add_argument("--no-index", action="store_true",
+            help="do not use or update the exposure to healpix index file")
+    parser.add_argument("--frame-cache-gb", type=float, default=None,
+            help="memory budget in GB per rank to keep frames for later pixels; "
+                 "default only keeps frames of the current pixel")
+    append = parser.add_mutually_exclusive_group()
+    append.add_argument("--append", action="store_true",
+            help="add new exposures to existing spectra files as appended "
+                 "extensions (NAPPEND keyword) instead of rewriting them; "
+                 "only desispec readers combine these extensions, see --compact")
+    append.add_argument("--compact", action="store_true",
+            help="also rewrite the spectra files without new exposures "
+                 "whose extensions were appended by --append, with a single "
+                 "HDU per EXTNAME")
 
     if options is None:
         args = parser.parse_args()
@@ -93,18 +110,30 @@ def main(args=None, comm=None):
     #- Get table NIGHT EXPID SPECTRO HEALPIX NTARGETS 
     t0 = time.time()
     exp2pix = get_exp2healpix_map(nights=nights, comm=comm,
-                                  specprod_dir=args.reduxdir)
+                                  specprod_dir=args.reduxdir, nside=args.nside,
+                                  use_index=not args.no_index)
     assert len(exp2pix) > 0
     if rank == 0:
         dt = time.time() - t0
         log.debug('Exposure to healpix mapping took {:.1f} sec'.format(dt))
         sys.stdout.flush()
 
-    allpix = sorted(set(exp2pix['HEALPIX']))
-    mypix = np.array_split(allpix, size)[rank]
+    #- Order pixels to reuse frames between consecutive pixels, and balance
+    #- contiguous blocks of pixels across ranks by number of frames
+    allpix, nframes = order_healpix_by_overlap(exp2pix)
+    if len(allpix) >= size:
+        first, npix = dist_discrete(nframes, size, rank)
+        mypix = allpix[first:first+npix]
+    else:
+        mypix = allpix[rank:rank+1]
     log.info('Rank {} will process {} pixels'.format(rank, len(mypix)))
     sys.stdout.flush()
 
+    if args.frame_cache_gb is not None:
+        max_memory = int(args.frame_cache_gb * 1024**3)
+    else:
+        max_memory = None
+
     frames = dict()
     for pix in mypix:
         iipix = np.where(exp2pix['HEALPIX'] == pix)[0]
@@ -134,10 +163,17 @@ def main(args=None, comm=None):
         if args.outdir:
             specfile = os.path.join(args.outdir, os.path.basename(specfile))
 
+        header = dict(HPXNSIDE=args.nside, HPXPIXEL=pix, HPXNEST=True)
         oldspectra = None
+        nappend = 0
         if os.path.exists(specfile):
-            oldspectra = SpectraLite.read(specfile)
-            fm = oldspectra.fibermap
+            with fitsio.FITS(specfile) as fx:
+                nappend = fx[0].read_header().get('NAPPEND', 0)
+                extensions = appended_extensions(
+                    [(hdu.get_extname(), hdu.get_extver()) for hdu in fx],
+                    nappend)
+                fm = np.concatenate([fx[i].read(columns=['NIGHT', 'EXPID', 'SPECTROID'])
+                                     for i in extensions['FIBERMAP']])
             for night, expid, spectro in set(zip(fm['NIGHT'], fm['EXPID'], fm['SPECTROID'])):
                 for band in ['b', 'r', 'z']:
                     camera = band + str(spectro)
@@ -145,25 +181,38 @@ def main(args=None, comm=None):
                         framekeys.remove((night, expid, camera))
 
         if len(framekeys) == 0:
-            log.info('pix {} already has all exposures; moving on'.format(pix))
+            if args.compact and nappend > 0:
+                log.info('pix {} already has all exposures; compacting {} appends'.format(
+                    pix, nappend))
+                SpectraLite.read(specfile).write(specfile, header=header)
+            else:
+                log.info('pix {} already has all exposures; moving on'.format(pix))
             continue
 
+        #- Without --append, previous spectra are combined with the new ones
+        #- and the file is rewritten with a single HDU per EXTNAME
+        if os.path.exists(specfile) and not args.append:
+            oldspectra = SpectraLite.read(specfile)
+
         #- Load new frames to add
         log.info('pix {} has {} frames to add'.format(pix, len(framekeys)))
-        update_frame_cache(frames, framekeys, specprod_dir=args.reduxdir)
+        update_frame_cache(frames, framekeys, specprod_dir=args.reduxdir,
+                max_memory=max_memory)
 
-        #- convert individual FrameLite objects into SpectraLite
-        newspectra = frames2spectra(frames, pix)
+        #- convert individual FrameLite objects into SpectraLite;
+        #- the cache may also have frames for other pixels
+        pixframes = dict([(key, frames[key]) for key in framekeys])
+        newspectra = frames2spectra(pixframes, pix, nside=args.nside)
 
-        #- Combine with any previous spectra if needed
-        if oldspectra:
-            spectra = oldspectra + newspectra
+        #- Write new spectra file, or append to the previous one
+        if args.append:
+            newspectra.write(specfile, header=header, append=True)
         else:
-            spectra = newspectra
-
-        #- Write new spectra file
-        header = dict(HPXNSIDE=args.nside, HPXPIXEL=pix, HPXNEST=True)
-        spectra.write(specfile, header=header)
+            if oldspectra:
+                spectra = oldspectra + newspectra
+            else:
+                spectra = newspectra
+            spectra.write(specfile, header=header)
     
     if rank == 0:
         dt = time.time() - t0
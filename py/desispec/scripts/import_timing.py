@@ -0,0 +1,144 @@
+"""
+desispec.scripts.import_timing
+==============================
+
+Measure the cold-start import time of the ``bin/desi_*`` entry points.
+
+Only the module level imports of each script are executed, in a fresh
+python interpreter, so that scripts which run at import time (or require
+arguments, MPI, or a database) can be timed safely.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import ast
+import glob
+import json
+import time
+import argparse
+import subprocess
+
+
+def parse(options=None):
+    p = argparse.ArgumentParser(description='Measure the import time of the desi_* entry points')
+    p.add_argument('-b', '--bindir', type=str, default=None,
+                   help='Directory with the desi_* scripts (default: desispec bin/).')
+    p.add_argument('-s', '--scripts', type=str, nargs='*', default=None,
+                   help='Only time these scripts (default: all bin/desi_* python scripts).')
+    p.add_argument('-n', '--repeat', type=int, default=3,
+                   help='Number of cold starts per script; the minimum is reported.')
+    p.add_argument('-o', '--output', type=str, default=None,
+                   help='Write the timings to this json file.')
+    p.add_argument('-r', '--reference', type=str, default=None,
+                   help='Compare with timings in this json file (from a previous --output).')
+    p.add_argument('--tolerance', type=float, default=0.25,
+                   help='Fractional slowdown w.r.t. --reference considered a regression.')
+    p.add_argument('--max-time', type=float, default=None,
+                   help='Import time (sec) above which a script is considered a regression.')
+
+    if options is None:
+        args = p.parse_args()
+    else:
+        args = p.parse_args(options)
+    return args
+
+
+def script_imports(filename):
+    """Return the python source of the module level imports of a script.
+
+    Args:
+        filename: path to a python script
+
+    Returns:
+        str of import statements, or None if filename is not a python script.
+    """
+    with open(filename) as fx:
+        source = fx.read()
+    if not source.startswith('#!') or 'python' not in source.split('\n', 1)[0]:
+        return None
+    try:
+        tree = ast.parse(source, filename=filename)
+    except SyntaxError:
+        return None
+
+    lines = list()
+    for node in tree.body:
+        if isinstance(node, ast.Import) or \
+                (isinstance(node, ast.ImportFrom) and node.module != '__future__'):
+            lines.append(ast.get_source_segment(source, node))
+    return '\n'.join(lines)
+
+
+def time_imports(code, repeat=3):
+    """Time the execution of code in fresh python interpreters.
+
+    Args:
+        code: python source to execute
+
+    Options:
+        repeat: number of interpreter starts
+
+    Returns:
+        minimum wall clock time in seconds, or None if code failed
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        proc = subprocess.run([sys.executable, '-c', code],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        dt = time.time() - t0
+        if proc.returncode != 0:
+            return None
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main(args):
+    if args.bindir is None:
+        args.bindir = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), 'bin')
+
+    if args.scripts:
+        filenames = [os.path.join(args.bindir, s) for s in args.scripts]
+    else:
+        filenames = sorted(glob.glob(os.path.join(args.bindir, 'desi_*')))
+
+    #- interpreter start up, subtracted from the script timings
+    baseline = time_imports('pass', args.repeat)
+
+    timings = dict()
+    for filename in filenames:
+        code = script_imports(filename)
+        if code is None:
+            continue
+        name = os.path.basename(filename)
+        dt = time_imports(code, args.repeat)
+        if dt is None:
+            print('{:32s}    FAILED'.format(name))
+            continue
+        timings[name] = max(dt - baseline, 0.)
+        print('{:32s} {:8.3f} sec'.format(name, timings[name]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fx:
+            json.dump(timings, fx, indent=2, sort_keys=True)
+
+    reference = dict()
+    if args.reference is not None:
+        with open(args.reference) as fx:
+            reference = json.load(fx)
+
+    regressions = list()
+    for name, dt in sorted(timings.items()):
+        if args.max_time is not None and dt > args.max_time:
+            regressions.append('{} {:.3f} sec > {:.3f} sec'.format(name, dt, args.max_time))
+        elif name in reference and dt > reference[name]*(1+args.tolerance):
+            regressions.append('{} {:.3f} sec > {:.3f} sec reference'.format(name, dt, reference[name]))
+
+    for line in regressions:
+        print('REGRESSION: ' + line)
+
+    return len(regressions)
@@ -142,6 +142,10 @@ Where supported commands are (use desi_pipe <command> --help for details):
         parser.add_argument("--db-sqlite-path", type=str, required=False,
             default=None, help="Override path to SQLite DB")
 
+        parser.add_argument("--db-sqlite-wal", required=False, default=False,
+            action="store_true", help="Use write-ahead logging for the "
+            "SQLite DB, so that reading the DB does not block updates.")
+
         parser.add_argument("--db-postgres", required=False, default=False,
             action="store_true", help="Use PostgreSQL database backend.  "
             "You must correctly configure your ~/.pgpass file!")
@@ -177,6 +181,7 @@ Where supported commands are (use desi_pipe <command> --help for details):
             calib=args.calib,
             db_sqlite=args.db_sqlite,
             db_sqlite_path=args.db_sqlite_path,
+            db_sqlite_wal=args.db_sqlite_wal,
             db_postgres=args.db_postgres,
             db_postgres_host=args.db_postgres_host,
             db_postgres_port=args.db_postgres_port,
@@ -345,13 +350,17 @@ Where supported commands are (use desi_pipe <command> --help for details):
             "matching these patterns will be examined.")
         parser.add_argument("--force-spec-done", action="store_true",
             help="force setting spectra file to state done if file exists independently of state of parent cframes.")
+        parser.add_argument("--index-cache", required=False, default=None,
+            help="file of directory listings, reused for the directories "
+            "unchanged since the previous sync and updated.")
 
         args = parser.parse_args(sys.argv[2:])
 
         dbpath = io.get_pipe_database()
         db = pipe.load_db(dbpath, mode="w")
 
-        control.sync(db, nightstr=args.nights,specdone=args.force_spec_done)
+        control.sync(db, nightstr=args.nights,specdone=args.force_spec_done,
+            index_cache=args.index_cache)
 
         return
 
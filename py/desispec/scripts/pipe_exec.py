@@ -34,6 +34,17 @@ def parse(options=None):
         action="store_true", help="Run tasks regardless of DB or file state.")
     parser.add_argument("--nodb", required=False, default=False,
         action="store_true", help="Do not use the production database.")
+    parser.add_argument("--state-service", required=False, default=False,
+        action="store_true", help="With MPI, one process owns the "
+        "production database and collects the task states of the others.")
+    parser.add_argument("--scheduler", required=False, default=None,
+        choices=["static", "dynamic"], help="Assign the tasks to the "
+        "process groups in advance (static) or let the groups take the next "
+        "task from a queue (dynamic).  Default $DESI_PIPE_RUN_SCHEDULER or "
+        "static.")
+    parser.add_argument("--queue-file", required=False, default=None,
+        help="With the dynamic scheduler, share the queue of tasks through "
+        "this file, for instance with other jobs.")
     parser.add_argument("--taskfile", required=False, default=None,
         help="Use a file containing the list of tasks.  If not specified, "
         "use --task or read list of tasks from STDIN")
@@ -132,10 +143,15 @@ def main(args, comm=None):
 
     if args.nodb:
         ready, done, failed = pipe.run_task_list(args.tasktype, tasklist, opts,
-                                           comm=comm, db=None, force=args.force)
+                                           comm=comm, db=None, force=args.force,
+                                           scheduler=args.scheduler,
+                                           queue_file=args.queue_file)
     else:
         ready, done, failed = pipe.run_task_list(args.tasktype, tasklist, opts,
-                                           comm=comm, db=db, force=args.force)
+                                           comm=comm, db=db, force=args.force,
+                                           state_service=args.state_service,
+                                           scheduler=args.scheduler,
+                                           queue_file=args.queue_file)
 
     t2 = datetime.datetime.now()
 
@@ -11,6 +11,7 @@ import argparse
 import os
 import sys
 from desispec import io
+from desispec.preproc import set_calibration_cache
 from desiutil.log import get_logger
 log = get_logger()
 
@@ -80,6 +81,12 @@ to use, but also only if a single camera is specified.
     parser.add_argument('--fill-header', type = str, default = None,  nargs ='*', help="fill camera header with contents of those of other hdus")
     parser.add_argument('--scattered-light', action="store_true", help="fit and remove scattered light")
     parser.add_argument('--psf', type = str, required=False, default=None, help="psf file to remove scattered light")
+    parser.add_argument('--ncpu', type = int, default = 1, required=False,
+                        help = 'number of processes to preprocess cameras in parallel')
+    parser.add_argument('--calib-cache-gb', type = float, default = 0, required=False,
+                        help = 'keep up to this many GB of calibration images in memory '
+                        'for the next exposures preprocessed by this process, '
+                        'e.g. a pipeline process; default 0 (no cache)')
     
     #- uses sys.argv if options=None
     args = parser.parse_args(options)
@@ -138,37 +145,83 @@ def main(args=None):
         fibermapfile = infile.replace('desi-', 'fibermap-').replace('.fits.fz', '.fits')
         args.fibermap = os.path.join(datadir, fibermapfile)
 
+    #- Read the fibermap only once for all cameras
+    fibermap = None
+    if os.path.exists(args.fibermap):
+        fibermap = io.read_fibermap(args.fibermap)
+
+    kwargs = dict(fibermapfile=args.fibermap, fibermap=fibermap,
+                  bias=bias, dark=dark, pixflat=pixflat, mask=mask, bkgsub=args.bkgsub,
+                  nocosmic=args.nocosmic,
+                  cosmics_nsig=args.cosmics_nsig,
+                  cosmics_cfudge=args.cosmics_cfudge,
+                  cosmics_c2fudge=args.cosmics_c2fudge,
+                  ccd_calibration_filename=ccd_calibration_filename,
+                  nocrosstalk=args.nocrosstalk,
+                  nogain=args.nogain,
+                  use_savgol=args.use_savgol,
+                  nodarktrail=args.nodarktrail,
+                  fill_header=args.fill_header,
+                  remove_scattered_light=args.scattered_light)
+
+    set_calibration_cache(int(args.calib_cache_gb * 1024**3))
+
+    #- Read and decompress the raw images of all cameras only once,
+    #- then hand them to the processes
+    ncpu = min(args.ncpu, len(args.cameras))
+    rawdata = io.read_raw_data(args.infile, args.cameras,
+                               fill_header=kwargs.pop('fill_header'), nthreads=ncpu)
+    cameras = list()
     for camera in args.cameras:
-        try:
-            img = io.read_raw(args.infile, camera,
-                              fibermapfile=args.fibermap,
-                              bias=bias, dark=dark, pixflat=pixflat, mask=mask, bkgsub=args.bkgsub,
-                              nocosmic=args.nocosmic,                              
-                              cosmics_nsig=args.cosmics_nsig,
-                              cosmics_cfudge=args.cosmics_cfudge,
-                              cosmics_c2fudge=args.cosmics_c2fudge,
-                              ccd_calibration_filename=ccd_calibration_filename,
-                              nocrosstalk=args.nocrosstalk,
-                              nogain=args.nogain,
-                              use_savgol=args.use_savgol,
-                              nodarktrail=args.nodarktrail,
-                              fill_header=args.fill_header,
-                              remove_scattered_light=args.scattered_light
-            )
-        except IOError:
-            log.error('Error while reading or preprocessing camera {} in {}'.format(camera, args.infile))
-            continue
-
-        if(args.zero_masked) :
-            img.pix *= (img.mask==0)
-
-        if args.outfile is None:
-            night = img.meta['NIGHT']
-            expid = img.meta['EXPID']
-            outfile = io.findfile('preproc', night=night, expid=expid, camera=camera,
-                                  outdir=args.outdir)
+        if camera.upper() in rawdata:
+            cameras.append(camera)
         else:
-            outfile = args.outfile
+            log.error('Camera {} not in {}'.format(camera, args.infile))
+
+    if ncpu > 1:
+        import multiprocessing
+        log.info('Preprocessing {} cameras with {} processes'.format(
+            len(cameras), ncpu))
+        with multiprocessing.Pool(ncpu) as pool:
+            pool.starmap(_preproc_camera,
+                         [(args, camera, rawdata.pop(camera.upper()), kwargs)
+                          for camera in cameras])
+    else:
+        for camera in cameras:
+            _preproc_camera(args, camera, rawdata.pop(camera.upper()), kwargs)
+
+def _preproc_camera(args, camera, rawdata, kwargs):
+    """
+    Preprocess one camera of args.infile and write its output file
+
+    Args:
+        args: parsed command line options from main()
+        camera: camera to process, e.g. 'b0'
+        rawdata: (rawimage, header, primary_header) of the camera
+            returned by io.read_raw_data
+        kwargs: dict of options passed to io.read_raw
+
+    Returns:
+        output filename, or None if the camera could not be preprocessed
+    """
+    try:
+        img = io.read_raw(args.infile, camera, rawdata=rawdata, **kwargs)
+    except IOError:
+        log.error('Error while reading or preprocessing camera {} in {}'.format(camera, args.infile))
+        return None
+
+    if(args.zero_masked) :
+        img.pix *= (img.mask==0)
+
+    if args.outfile is None:
+        night = img.meta['NIGHT']
+        expid = img.meta['EXPID']
+        outfile = io.findfile('preproc', night=night, expid=expid, camera=camera,
+                              outdir=args.outdir)
+    else:
+        outfile = args.outfile
+
+    io.write_image(outfile, img)
+    log.info("Wrote {}".format(outfile))
 
-        io.write_image(outfile, img)
-        log.info("Wrote {}".format(outfile))
+    return outfile
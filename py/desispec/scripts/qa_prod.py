@@ -5,6 +5,7 @@ import argparse
 import numpy as np
 
 from desispec.qa import __offline_qa_version__
+from desispec.parallel import default_nproc
 
 def parse(options=None):
     parser = argparse.ArgumentParser(description="Generate/Analyze Production Level QA [v{:s}]".format(__offline_qa_version__))
@@ -15,8 +16,16 @@ def parse(options=None):
                         help = 'slurp production QA files into one per night?')
     parser.add_argument('--remove', default = False, action='store_true',
                         help = 'remove frame QA files?')
+    parser.add_argument('--make_store', default = False, action='store_true',
+                        help = 'convert the QA files (YAML and slurped JSON) into one QA store per night')
+    parser.add_argument('--from_store', default = False, action='store_true',
+                        help = 'query the QA stores instead of loading the slurped QA files')
     parser.add_argument('--clobber', default=False, action='store_true',
                         help='clobber existing QA files?')
+    parser.add_argument('--ncpu', type=int, default=1,
+                        help='Number of processes generating the frame QA (of each MPI process), e.g. {}'.format(default_nproc))
+    parser.add_argument('--mpi', default=False, action='store_true',
+                        help='Distribute the frame QA among the MPI processes')
     parser.add_argument('--channel_hist', type=str, default=None,
                         help='Generate channel histogram(s)')
     parser.add_argument('--time_series', type=str, default=None,
@@ -53,6 +62,10 @@ def main(args) :
     log=get_logger()
 
     log.info("starting")
+    comm = None
+    if args.mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
     # Initialize
     if args.specprod_dir is None:
         specprod_dir = meta.specprod_root()
@@ -78,8 +91,15 @@ def main(args) :
         # Run
         if (args.make_frameqa & 2**0) or (args.make_frameqa & 2**1):
             # Allow for restricted nights
-            qa_prod.make_frameqa(make_plots=make_frame_plots, clobber=args.clobber,
-                                 restrict_nights=restrict_nights)
+            failed = qa_prod.make_frameqa(make_plots=make_frame_plots, clobber=args.clobber,
+                                          restrict_nights=restrict_nights, nproc=args.ncpu,
+                                          comm=comm)
+            if (len(failed) > 0) and ((comm is None) or (comm.rank == 0)):
+                log.error("Frame QA failed for {} frames".format(len(failed)))
+
+    # The rest runs on a single process
+    if (comm is not None) and (comm.rank > 0):
+        return
 
     # Slurp and write?
     if args.slurp:
@@ -87,12 +107,23 @@ def main(args) :
         qa_prod.slurp_nights(make=(args.make_frameqa > 0), remove=args.remove, write_nights=True,
                              restrict_nights=restrict_nights)
 
+    # Convert QA files into the QA stores?
+    if args.make_store:
+        files = qa_prod.make_store(restrict_nights=restrict_nights)
+        log.info("Wrote {:d} QA stores".format(len(files)))
+
+    # Load the QA
+    if args.from_store:
+        load_data = lambda : qa_prod.load_store(restrict_nights=restrict_nights)
+    else:
+        load_data = qa_prod.load_data
+
     # Channel histograms
     if args.channel_hist is not None:
         # imports
         from matplotlib.backends.backend_pdf import PdfPages
         #
-        qa_prod.load_data()
+        load_data()
         outfile = qa_prod.prod_name+'_chist.pdf'
         pp = PdfPages(outfile)
         # Default?
@@ -107,7 +138,7 @@ def main(args) :
     # Time plots
     if args.time_series is not None:
         # QATYPE-METRIC
-        qa_prod.load_data()
+        load_data()
         # Run
         qatype, metric = args.time_series.split('-')
         outfile= qaprod_dir+'/QA_time_{:s}.png'.format(args.time_series)
@@ -116,7 +147,7 @@ def main(args) :
     # <S/N> plot
     if args.S2N_plot:
         # Load up
-        qa_prod.load_data()
+        load_data()
         qa_prod.load_exposure_s2n()
         # Plot
         outfile= qaprod_dir+'/QA_S2N_{:s}.png'.format(args.xaxis)
@@ -125,7 +156,7 @@ def main(args) :
     # ZP plot
     if args.ZP_plot:
         # Load up
-        qa_prod.load_data()
+        load_data()
         # Plot
         outfile= qaprod_dir+'/QA_ZP_{:s}.png'.format(args.xaxis)
         dqqp.prod_ZP(qa_prod, xaxis=args.xaxis, outfile=outfile)
@@ -5,7 +5,7 @@ from desispec.io import read_frame
 from desispec.io import read_fiberflat
 from desispec.io import write_sky
 from desispec.io.qa import load_qa_frame
-from desispec.io import write_qa_frame
+from desispec.io import write_qa_frame, qastore_from_qafile
 from desispec.fiberflat import apply_fiberflat
 from desispec.sky import compute_sky
 from desispec.qa import qa_plots
@@ -76,7 +76,7 @@ def main(args) :
         qaframe.run_qa('SKYSUB', (frame, skymodel))
         # Write
         if args.qafile is not None:
-            write_qa_frame(args.qafile, qaframe)
+            write_qa_frame(args.qafile, qaframe, store=qastore_from_qafile(args.qafile, qaframe))
             log.info("successfully wrote {:s}".format(args.qafile))
         # Figure(s)
         if args.qafig is not None:
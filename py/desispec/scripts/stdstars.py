@@ -15,7 +15,7 @@ from astropy import units
 from astropy.table import Table
 
 from desispec import io
-from desispec.fluxcalibration import match_templates,normalize_templates,isStdStar
+from desispec.fluxcalibration import match_templates_for_stars,normalize_templates,isStdStar
 from desispec.interpolation import resample_flux
 from desiutil.log import get_logger
 from desispec.parallel import default_nproc
@@ -39,6 +39,7 @@ def parse(options=None):
     parser.add_argument('--z-max', type = float, default = 0.008, required = False, help = 'max peculiar velocity (blue/red)shift range')
     parser.add_argument('--z-res', type = float, default = 0.00002, required = False, help = 'dz grid resolution')
     parser.add_argument('--template-error', type = float, default = 0.1, required = False, help = 'fractional template error used in chi2 computation (about 0.1 for BOSS b1)')
+    parser.add_argument('--log-resampling', action = 'store_true', help = 'resample the redshifted templates through a log wavelength grid with cached matrices (faster, best fit coefficients and chi2 differ by less than about 1e-3)')
     parser.add_argument('--maxstdstars', type=int, default=30, \
             help='Maximum number of stdstars to include')
     
@@ -332,9 +333,10 @@ def main(args) :
 
     fitted_model_colors = np.zeros(nstars)
 
+    stars = []
     for star in range(nstars) :
 
-        log.info("finding best model for observed star #%d"%star)
+        log.info("selecting models for observed star #%d"%star)
 
         # np.array of wave,flux,ivar,resol
         wave = {}
@@ -372,17 +374,25 @@ def main(args) :
         log.info("star#%d fiber #%d, %s = %f, number of pre-selected models = %d/%d"%(
             star, starfibers[star], args.color, star_unextincted_colors[args.color][star],
             selection.size, stdflux.shape[0]))
-        
-        # Match unextincted standard stars to data
-        coefficients, redshift[star], chi2dof[star] = match_templates(
-            wave, flux, ivar, resolution_data,
-            stdwave, stdflux[selection],
-            teff[selection], logg[selection], feh[selection],
-            ncpu=args.ncpu, z_max=args.z_max, z_res=args.z_res,
-            template_error=args.template_error
-            )
-        
-        linear_coefficients[star,selection] = coefficients
+
+        stars.append(dict(star=star, wave=wave, flux=flux, ivar=ivar,
+                          resolution_data=resolution_data, selection=selection))
+
+    # Match unextincted standard stars to data,
+    # with a single pool of processes for all stars
+    log.info("finding best models for {} stars".format(len(stars)))
+    results = match_templates_for_stars(
+        stars, stdwave, stdflux, teff, logg, feh,
+        ncpu=args.ncpu, z_max=args.z_max, z_res=args.z_res,
+        template_error=args.template_error, log_resampling=args.log_resampling
+        )
+
+    for params, (coefficients, star_redshift, star_chi2dof) in zip(stars, results) :
+
+        star = params["star"]
+        redshift[star] = star_redshift
+        chi2dof[star] = star_chi2dof
+        linear_coefficients[star,params["selection"]] = coefficients
         
         log.info('Star Fiber: {}; TEFF: {:.3f}; LOGG: {:.3f}; FEH: {:.3f}; Redshift: {:g}; Chisq/dof: {:.3f}'.format(
             starfibers[star],
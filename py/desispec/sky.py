@@ -11,7 +11,9 @@ from collections import OrderedDict
 
 from desispec.resolution import Resolution
 from desispec.linalg import cholesky_solve
-from desispec.linalg import cholesky_invert
+from desispec.linalg import cholesky_solve_banded
+from desispec.linalg import cholesky_invert_banded
+from desispec.linalg import banded_to_sparse
 from desispec.linalg import spline_fit
 from desiutil.log import get_logger
 from desispec import util
@@ -123,6 +125,148 @@ def _model_variance(frame,cskyflux,cskyivar,skyfibers) :
     
 
      
+def _weighted_resolution_data(resolution_data, sqrtw, scale=None) :
+    """Diagonals of the matrices diag(sqrtw[fiber]) R[fiber] diag(scale[fiber])
+
+    Args:
+        resolution_data : 3D[nfibers, ndiag, nwave] resolution matrix diagonals
+        sqrtw : 2D[nfibers, nwave] square root of the weights applied to the rows of R
+        scale : optional 2D[nfibers, nwave] scale applied to the columns of R
+
+    Returns 3D[nfibers, ndiag, nwave] array, same storage as resolution_data
+    """
+    nfibers,ndiag,nwave = resolution_data.shape
+    hw = ndiag//2
+    # resolution_data[f,k,j] = R[f][j-hw+k,j] , so we pad the weights
+    # to get the row weight of each element with a simple shift
+    sqrtw_pad = np.zeros((nfibers,nwave+2*hw))
+    sqrtw_pad[:,hw:hw+nwave] = sqrtw
+    wdata = np.zeros(resolution_data.shape)
+    for k in range(ndiag) :
+        wdata[:,k] = resolution_data[:,k]*sqrtw_pad[:,k:k+nwave]
+    if scale is not None :
+        wdata *= scale[:,None,:]
+    return wdata
+
+def _banded_normal_matrix(wdata, fiber_weights=None) :
+    """Normal matrix of the weighted least square fit of the flux with a model R[fiber].X
+
+    A = sum_fiber fiber_weights[fiber] (sqrtw R)[fiber]^t (sqrtw R)[fiber]
+
+    Args:
+        wdata : 3D[nfibers, ndiag, nwave] diagonals of the weighted resolution
+                matrices sqrtw R, see _weighted_resolution_data
+        fiber_weights : optional 1D[nfibers] weights of each fiber
+
+    Returns 2D[ndiag, nwave] lower band storage of A, with Ab[d,j] = A[j+d,j]
+    (A has ndiag-1 non-zero diagonals on each side of the main diagonal)
+    """
+    nfibers,ndiag,nwave = wdata.shape
+    if fiber_weights is None :
+        fwdata = wdata
+    else :
+        fwdata = fiber_weights[:,None,None]*wdata
+
+    # A[j,j+d] = sum_fiber sum_k wdata[fiber,k,j]*wdata[fiber,k-d,j+d]
+    Ab = np.zeros((ndiag,nwave))
+    for d in range(ndiag) :
+        Ab[d,:nwave-d] = np.einsum("fkj,fkj->j",fwdata[:,d:,:nwave-d],wdata[:,:ndiag-d,d:])
+    return Ab
+
+def _banded_normal_vector(wdata, sqrtwflux, fiber_weights=None) :
+    """Vector B of the normal equation A.X=B of the weighted least square fit of the flux with a model R[fiber].X
+
+    B = sum_fiber fiber_weights[fiber] (sqrtw R)[fiber]^t sqrtwflux[fiber]
+
+    Args:
+        wdata : 3D[nfibers, ndiag, nwave] diagonals of the weighted resolution
+                matrices sqrtw R, see _weighted_resolution_data
+        sqrtwflux : 2D[nfibers, nwave] sqrt(ivar)*flux
+        fiber_weights : optional 1D[nfibers] weights of each fiber
+
+    Returns 1D[nwave] array
+    """
+    nfibers,ndiag,nwave = wdata.shape
+    hw = ndiag//2
+    if fiber_weights is not None :
+        sqrtwflux = fiber_weights[:,None]*sqrtwflux
+
+    # B[j] = sum_fiber sum_k wdata[fiber,k,j]*sqrtwflux[fiber,j-hw+k]
+    sqrtwflux_pad = np.zeros((nfibers,nwave+2*hw))
+    sqrtwflux_pad[:,hw:hw+nwave] = sqrtwflux
+    B = np.zeros(nwave)
+    for k in range(ndiag) :
+        B += np.sum(wdata[:,k]*sqrtwflux_pad[:,k:k+nwave],axis=0)
+    return B
+
+def _solve_banded_normal_equation(Ab, B, iteration=0) :
+    """Solves A.X=B for a banded normal matrix A, ignoring unconstrained parameters
+
+    Args:
+        Ab : 2D[ndiag, nparams] lower band storage of A, with Ab[d,j] = A[j+d,j]
+        B : 1D[nparams]
+
+    Optional:
+        iteration : iteration number (for logging)
+
+    Returns 1D[nparams] solution, with 0 for parameters with A[j,j]<=0
+    """
+    log = get_logger()
+    # parameters with no constraint have their whole row and column of A
+    # set to 0, replace them by an identity block to keep A positive definite
+    # (this is equivalent to solving the restricted system)
+    w = Ab[0]>0
+    Ab_pos_def = Ab.copy()
+    Ab_pos_def[0,~w] = 1.
+    Bw = B*w
+    try:
+        parameters = cholesky_solve_banded(Ab_pos_def,Bw)
+    except np.linalg.LinAlgError:
+        log.info("cholesky failed, trying svd in iteration {}".format(iteration))
+        A_pos_def = banded_to_sparse(Ab).toarray()[w][:,w]
+        parameters = np.zeros(B.size)
+        parameters[w]=np.linalg.lstsq(A_pos_def,B[w],rcond=None)[0]
+    return parameters
+
+def _banded_parameter_covariance(Ab) :
+    """Band of the covariance (inverse) of a banded normal matrix A
+
+    Args:
+        Ab : 2D[ndiag, nparams] lower band storage of A, with Ab[d,j] = A[j+d,j]
+
+    Returns 2D[ndiag, nparams] lower band storage of the covariance,
+    with covariance 0 for the parameters with A[j,j]<=0 (as np.linalg.pinv would do)
+    """
+    log = get_logger()
+    w = Ab[0]>0
+    Ab_pos_def = Ab.copy()
+    Ab_pos_def[0,~w] = 1.
+    try :
+        covb = cholesky_invert_banded(Ab_pos_def)
+        covb[0,~w] = 0.
+    except np.linalg.LinAlgError :
+        log.warning("cholesky_invert_banded failed, switching to np.linalg.pinv")
+        covar = np.linalg.pinv(banded_to_sparse(Ab).toarray())
+        nd,n = Ab.shape
+        covb = np.zeros(Ab.shape)
+        for d in range(nd) :
+            covb[d,:n-d] = np.diagonal(covar,-d)
+    return covb
+
+def _convolved_variance(R, covb) :
+    """Diagonal of R.C.R^t, where C is a banded symmetric covariance
+
+    Args:
+        R : sparse resolution matrix (nwave,nwave)
+        covb : 2D[ndiag, nwave] lower band storage of C. It must include
+               all the diagonals of C up to twice the half width of R to
+               get the exact result.
+
+    Returns 1D[nwave] variance
+    """
+    C = banded_to_sparse(covb)
+    return (R.dot(C).dot(R.T)).diagonal()
+
 def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=False,add_variance=True) :
     """Compute a sky model.
     
@@ -162,7 +306,8 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     current_ivar = current_ivar[skyfibers]
     flux = frame.flux[skyfibers]
 
-    Rsky = frame.R[skyfibers]
+    Rsky = frame.Rstack[skyfibers]
+    Rdata = Rsky.data
     
     input_ivar=None 
     if model_ivar :
@@ -211,44 +356,22 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
         # B = sum_fiber sum_wave_w ivar[fiber,w] R[fiber][w] * flux[fiber,w]
         # B = sum_fiber sum_wave_w sqrt(ivar)[fiber,w]*flux[fiber,w] sqrtwR[fiber,wave]
         
-        #A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        A=np.zeros((nwave,nwave))
-        B=np.zeros((nwave))
-        
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-        
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
-
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-            A += (sqrtwR.T*sqrtwR).todense()
-            B += sqrtwR.T*sqrtwflux[fiber]
-                        
+        # R is banded, so is A. We only store its lower diagonals, with
+        # A_band[d,j] = A[j+d,j] (LAPACK lower band storage)
+        log.info("iter %d accumulating"%iteration)
+        wdata = _weighted_resolution_data(Rdata,sqrtw)
+        A_band = _banded_normal_matrix(wdata)
+        B = _banded_normal_vector(wdata,sqrtwflux)
+
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
-        
+        parameters = _solve_banded_normal_equation(A_band,B,iteration)
+
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # the parameters are directly the unconvolve sky flux
-            # so we simply have to reconvolve it
-            fiber_convolved_sky_flux = Rsky[fiber].dot(parameters)
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        # the parameters are directly the unconvolve sky flux
+        # so we simply have to reconvolve it
+        convolved_sky_flux = Rsky.dot(parameters)
+        chi2=current_ivar*(flux-convolved_sky_flux)**2
             
         log.info("rejecting")
 
@@ -296,16 +419,9 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     # the sky inverse variances are very similar
     
     log.info("compute the parameter covariance")
-    # we may have to use a different method to compute this
-    # covariance
-   
-    try :
-        parameter_covar=cholesky_invert(A)
-        # the above is too slow
-        # maybe invert per block, sandwich by R 
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
+    # we only need the band of the covariance that is within
+    # twice the resolution half width, which is the band of A
+    parameter_covar_band=_banded_parameter_covariance(A_band)
     
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
@@ -316,11 +432,8 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     log.info("compute convolved sky and ivar")
     
     # The parameters are directly the unconvolved sky
-    # First convolve with average resolution :
-    convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
-        
-    # and keep only the diagonal
-    convolved_sky_var=np.diagonal(convolved_sky_covar)
+    # First convolve with average resolution and keep only the diagonal
+    convolved_sky_var=_convolved_variance(Rmean,parameter_covar_band)
         
     # inverse
     convolved_sky_ivar=(convolved_sky_var>0)/(convolved_sky_var+(convolved_sky_var==0))
@@ -329,9 +442,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     cskyivar = np.tile(convolved_sky_ivar, frame.nspec).reshape(frame.nspec, nwave)
 
     # The sky model for each fiber (simple convolution with resolution of each fiber)
-    cskyflux = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        cskyflux[i] = frame.R[i].dot(parameters)
+    cskyflux = frame.Rstack.dot(parameters)
 
 
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
@@ -342,7 +453,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
 
     # set sky flux and ivar to zero to poorly constrained regions
     # and add margins to avoid expolation issues with the resolution matrix
-    wmask = (np.diagonal(A)<=0).astype(float)
+    wmask = (A_band[0]<=0).astype(float)
     # empirically, need to account for the full width of the resolution band
     # (realized here by applying twice the resolution)
     wmask = Rmean.dot(Rmean.dot(wmask))
@@ -406,7 +517,8 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     current_ivar = current_ivar[skyfibers]
     flux = frame.flux[skyfibers]
     
-    Rsky = frame.R[skyfibers]
+    Rsky = frame.Rstack[skyfibers]
+    Rdata = Rsky.data
 
     input_ivar=None 
     if model_ivar :
@@ -482,47 +594,26 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
         # the parameters are the unconvolved sky flux at the wavelength i
         # and the polynomial coefficients
         
-        A=np.zeros((nwave,nwave),dtype=float)
-        B=np.zeros((nwave),dtype=float)
-        D=scipy.sparse.lil_matrix((nwave,nwave))
-        D2=scipy.sparse.lil_matrix((nwave,nwave))
-        
         Pol /= coef[0] # force constant term to 1.
         
         # solving for the deconvolved mean sky spectrum
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber (1st fit) %d/%d"%(iteration,fiber,nfibers))
-            D.setdiag(sqrtw[fiber])
-            D2.setdiag(Pol[fiber])
-            sqrtwRP = D.dot(Rsky[fiber]).dot(D2) # each row r of R is multiplied by sqrtw[r]
-            A += (sqrtwRP.T*sqrtwRP).todense()
-            B += sqrtwRP.T*sqrtwflux[fiber]
+        # A is banded, we only store its lower diagonals, with
+        # A_band[d,j] = A[j+d,j] (LAPACK lower band storage)
+        log.info("iter %d accumulating (1st fit)"%iteration)
+        wdata = _weighted_resolution_data(Rdata,sqrtw,scale=Pol)
+        A_band = _banded_normal_matrix(wdata)
+        B = _banded_normal_vector(wdata,sqrtwflux)
         
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
+        parameters = _solve_banded_normal_equation(A_band,B,iteration)
         # parameters = the deconvolved mean sky spectrum
         
         # now evaluate the polynomial coefficients
-        Ap=np.zeros((ncoef,ncoef),dtype=float)
-        Bp=np.zeros((ncoef),dtype=float)
-        D2.setdiag(parameters)
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber  (2nd fit) %d/%d"%(iteration,fiber,nfibers))
-            D.setdiag(sqrtw[fiber])
-            sqrtwRSM = D.dot(Rsky[fiber]).dot(D2).dot(skyfibers_monomials[:,fiber,:].T)
-            Ap += sqrtwRSM.T.dot(sqrtwRSM)
-            Bp += sqrtwRSM.T.dot(sqrtwflux[fiber])
+        # sqrtwRSM[c,fiber] = sqrtw[fiber]*R[fiber].(parameters*monomial[c,fiber])
+        log.info("iter %d sky fibers (2nd fit)"%iteration)
+        sqrtwRSM = np.array([sqrtw*Rsky.dot(parameters*skyfibers_monomials[c]) for c in range(ncoef)])
+        Ap = np.einsum("cfw,dfw->cd",sqrtwRSM,sqrtwRSM)
+        Bp = np.einsum("cfw,fw->c",sqrtwRSM,sqrtwflux)
         
         # Add huge prior on zeroth angular order terms to converge faster
         # (because those terms are degenerate with the mean deconvolved spectrum)    
@@ -541,8 +632,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
         
         # chi2 and outlier rejection
         log.info("iter %d compute chi2"%iteration)
-        for fiber in range(nfibers) :
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-Rsky[fiber].dot(Pol[fiber]*parameters))**2
+        chi2=current_ivar*(flux-Rsky.dot(Pol*parameters))**2
         
         log.info("rejecting")
 
@@ -595,11 +685,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     # so the sky model uncertainties are inaccurate
     
     log.info("compute the parameter covariance")
-    try :
-        parameter_covar=cholesky_invert(A)
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
+    parameter_covar_band=_banded_parameter_covariance(A_band)
     
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
@@ -610,11 +696,8 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     log.info("compute convolved sky and ivar")
     
     # The parameters are directly the unconvolved sky
-    # First convolve with average resolution :
-    convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
-        
-    # and keep only the diagonal
-    convolved_sky_var=np.diagonal(convolved_sky_covar)
+    # First convolve with average resolution and keep only the diagonal
+    convolved_sky_var=_convolved_variance(Rmean,parameter_covar_band)
         
     # inverse
     convolved_sky_ivar=(convolved_sky_var>0)/(convolved_sky_var+(convolved_sky_var==0))
@@ -623,11 +706,8 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     cskyivar = np.tile(convolved_sky_ivar, frame.nspec).reshape(frame.nspec, nwave)
 
     # The sky model for each fiber (simple convolution with resolution of each fiber)
-    cskyflux = np.zeros(frame.flux.shape)
-    
     Pol = allfibers_monomials.T.dot(coef).T
-    for fiber in range(frame.nspec):
-        cskyflux[fiber] = frame.R[fiber].dot(Pol[fiber]*parameters)
+    cskyflux = frame.Rstack.dot(Pol*parameters)
         
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -637,7 +717,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
 
     # set sky flux and ivar to zero to poorly constrained regions
     # and add margins to avoid expolation issues with the resolution matrix
-    wmask = (np.diagonal(A)<=0).astype(float)
+    wmask = (A_band[0]<=0).astype(float)
     # empirically, need to account for the full width of the resolution band
     # (realized here by applying twice the resolution)
     wmask = Rmean.dot(Rmean.dot(wmask))
@@ -702,7 +782,8 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     current_ivar = get_fiberbitmasked_frame_arrays(frame,bitmask='sky',ivar_framemask=True,return_mask=False)
     current_ivar = current_ivar[skyfibers]
     flux = frame.flux[skyfibers]
-    Rsky = frame.R[skyfibers]
+    Rsky = frame.Rstack[skyfibers]
+    Rdata = Rsky.data
     
     
     # need focal plane coordinates of fibers
@@ -776,55 +857,39 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
         # similarily
         # B[p]  =  sum_fiber monom[fiber,p] * sum_wave_w (sqrt(ivar)[fiber,w]*flux[fiber,w]) sqrtwR[fiber,wave]
         
-        A=np.zeros((nwave*ncoef,nwave*ncoef))
-        B=np.zeros((nwave*ncoef))
-        
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-        
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
-
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-
-            #wRtR=(sqrtwR.T*sqrtwR).tocsr()
-            wRtR=(sqrtwR.T*sqrtwR).todense()
-            wRtF=sqrtwR.T*sqrtwflux[fiber]
-            # loop on polynomial coefficients (double loop for A)
-            # fill only blocks of A and B
-            for p in range(ncoef) :
-                for k in range(ncoef) :
-                    A[p*nwave:(p+1)*nwave,k*nwave:(k+1)*nwave] += monomials[p,fiber]*monomials[k,fiber]*wRtR
-                B[p*nwave:(p+1)*nwave] += monomials[p,fiber]*wRtF
+        # A is banded if we order the parameters by wavelength first,
+        # with the interleaved index j*ncoef+p for wavelength j and polynomial term p.
+        # We only store its lower diagonals, with A_band[d,i] = A[i+d,i]
+        # (LAPACK lower band storage)
+        log.info("iter %d accumulating"%iteration)
+        wdata = _weighted_resolution_data(Rdata,sqrtw)
+        ndiag = wdata.shape[1]
+        A_band = np.zeros((ndiag*ncoef,nwave*ncoef))
+        B = np.zeros((nwave*ncoef))
+        for p in range(ncoef) :
+            for k in range(ncoef) :
+                # block (p,k) is the band of sum_fiber monom[fiber,p]*monom[fiber,k]*wRtR
+                Apk = _banded_normal_matrix(wdata,fiber_weights=monomials[p]*monomials[k])
+                for d in range(ndiag) :
+                    # element [(j+d)*ncoef+k,j*ncoef+p]
+                    i = d*ncoef+k-p
+                    if i<0 : continue # in the upper triangle, it is filled by the symmetric block (k,p)
+                    A_band[i,p::ncoef][:nwave-d] = Apk[d,:nwave-d]
+            B[p::ncoef] = _banded_normal_vector(wdata,sqrtwflux,fiber_weights=monomials[p])
                 
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
+        parameters = _solve_banded_normal_equation(A_band,B,iteration)
+        # back to the ordering by polynomial term first, with index p*nwave+j
+        parameters = parameters.reshape(nwave,ncoef).T.ravel()
         
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # loop on polynomial indices
-            unconvolved_fiber_sky_flux = np.zeros(nwave)
-            for p in range(ncoef) :
-                unconvolved_fiber_sky_flux += monomials[p,fiber]*parameters[p*nwave:(p+1)*nwave]
-            # then convolve
-            fiber_convolved_sky_flux = Rsky[fiber].dot(unconvolved_fiber_sky_flux)
+        # sum over polynomial indices
+        unconvolved_sky_flux = monomials.T.dot(parameters.reshape(ncoef,nwave))
+        # then convolve
+        convolved_sky_flux = Rsky.dot(unconvolved_sky_flux)
             
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        chi2=current_ivar*(flux-convolved_sky_flux)**2
             
         log.info("rejecting")
 
@@ -871,13 +936,9 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     # no need to restore the original ivar to compute the model errors when modeling ivar
     # the sky inverse variances are very similar
     
-    # is there a different method to compute this ?
     log.info("compute covariance")
-    try :
-        parameter_covar=cholesky_invert(A)
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
+    # band of the covariance, in the interleaved ordering of the parameters
+    parameter_covar_band=_banded_parameter_covariance(A_band)
     
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
@@ -886,71 +947,56 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     Rmean = Resolution(mean_res_data)
     
     log.info("compute convolved sky and ivar")
-        
-    cskyflux = np.zeros(frame.flux.shape)
-    cskyivar = np.zeros(frame.flux.shape)
 
     log.info("compute convolved parameter covariance")
     # The covariance of the parameters is composed of ncoef*ncoef blocks each of size nwave*nwave
     # A block (p,k) is the covariance of the unconvolved spectra p and k , corresponding to the polynomial indices p and k
     # We first sandwich each block with the average resolution.
+    # We only need the diagonals of each block within twice the resolution half width,
+    # which are all contained in the band of the covariance.
+    nbins = ndiag-1
+    offsets = np.arange(-nbins,nbins+1)
     convolved_parameter_covar=np.zeros((ncoef,ncoef,nwave))
     for p in range(ncoef) :
         for k in range(ncoef) :
-            convolved_parameter_covar[p,k] = np.diagonal(Rmean.dot(parameter_covar[p*nwave:(p+1)*nwave,k*nwave:(k+1)*nwave]).dot(Rmean.T.todense()))
-    
-    '''
-    import astropy.io.fits as pyfits
-    pyfits.writeto("convolved_parameter_covar.fits",convolved_parameter_covar,overwrite=True)
-    
-    # other approach
-    log.info("dense Rmean...")
-    Rmean=Rmean.todense()
-    log.info("invert Rinv...")
-    Rinv=np.linalg.inv(Rmean)
-    # check this
-    print("0?",np.max(np.abs(Rinv.dot(Rmean)-np.eye(Rmean.shape[0])))/np.max(np.abs(Rmean)))
-    convolved_parameter_ivar=np.zeros((ncoef,ncoef,nwave))
-    for p in range(ncoef) :
-        for k in range(ncoef) :
-            convolved_parameter_ivar[p,k] = np.diagonal(Rinv.T.dot(A[p*nwave:(p+1)*nwave,k*nwave:(k+1)*nwave]).dot(Rinv))
-    # solve for each wave separately
-    convolved_parameter_covar=np.zeros((ncoef,ncoef,nwave))
-    for i in range(nwave) :
-        print("inverting ivar of wave %d/%d"%(i,nwave))
-        convolved_parameter_covar[:,:,i] = cholesky_invert(convolved_parameter_ivar[:,:,i])
-    pyfits.writeto("convolved_parameter_covar_bis.fits",convolved_parameter_covar,overwrite=True)
-    import sys
-    sys.exit(12)
-    '''
+            # diagonals of the block (p,k), following scipy.sparse.dia_matrix.data ordering
+            # block_data[nbins+d,j] = block[j-d,j]
+            block_data = np.zeros((offsets.size,nwave))
+            for d in range(nbins+1) :
+                # block[j+d,j] = covar[(j+d)*ncoef+p,j*ncoef+k]
+                i = d*ncoef+p-k
+                if i>=0 :
+                    block_data[nbins-d] = parameter_covar_band[i,k::ncoef]
+                else :
+                    block_data[nbins-d] = parameter_covar_band[-i,p::ncoef]
+                if d>0 :
+                    # block[j-d,j] = covar[j*ncoef+k,(j-d)*ncoef+p]
+                    block_data[nbins+d,d:] = parameter_covar_band[d*ncoef+k-p,p::ncoef][:nwave-d]
+            block = scipy.sparse.dia_matrix((block_data,offsets),shape=(nwave,nwave))
+            convolved_parameter_covar[p,k] = Rmean.dot(block).dot(Rmean.T).diagonal()
     
     # Now we compute the sky model variance for each fiber individually
     # accounting for its focal plane coordinates
     # so that a target fiber distant for a sky fiber will naturally have a larger
     # sky model variance
     log.info("compute sky and variance per fiber")        
-    for i in range(frame.nspec):
-        # compute monomials
-        M = []
-        xi=(frame.fibermap["FIBERASSIGN_X"][i]-xm)/xs
-        yi=(frame.fibermap["FIBERASSIGN_Y"][i]-ym)/ys
-        for dx in range(angular_variation_deg+1) :
-            for dy in range(angular_variation_deg+1-dx) :
-                M.append((xi**dx)*(yi**dy))
-        M = np.array(M)
-
-        unconvolved_fiber_sky_flux=np.zeros(nwave)
-        convolved_fiber_skyvar=np.zeros(nwave)
-        for p in range(ncoef) :
-            unconvolved_fiber_sky_flux += M[p]*parameters[p*nwave:(p+1)*nwave]
-            for k in range(ncoef) :
-                convolved_fiber_skyvar += M[p]*M[k]*convolved_parameter_covar[p,k]
+    # compute monomials of all fibers
+    M = []
+    xi=(np.asarray(frame.fibermap["FIBERASSIGN_X"])-xm)/xs
+    yi=(np.asarray(frame.fibermap["FIBERASSIGN_Y"])-ym)/ys
+    for dx in range(angular_variation_deg+1) :
+        for dy in range(angular_variation_deg+1-dx) :
+            M.append((xi**dx)*(yi**dy))
+    M = np.array(M)
+
+    unconvolved_sky_flux = M.T.dot(parameters.reshape(ncoef,nwave))
+    convolved_skyvar = np.einsum("pi,ki,pkw->iw",M,M,convolved_parameter_covar)
 
-        # convolve sky model with this fiber's resolution
-        cskyflux[i] = frame.R[i].dot(unconvolved_fiber_sky_flux)
+    # convolve sky model with the resolution of each fiber
+    cskyflux = frame.Rstack.dot(unconvolved_sky_flux)
 
-        # save inverse of variance
-        cskyivar[i] = (convolved_fiber_skyvar>0)/(convolved_fiber_skyvar+(convolved_fiber_skyvar==0))
+    # save inverse of variance
+    cskyivar = (convolved_skyvar>0)/(convolved_skyvar+(convolved_skyvar==0))
 
     
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
@@ -961,7 +1007,7 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
 
     # set sky flux and ivar to zero to poorly constrained regions
     # and add margins to avoid expolation issues with the resolution matrix
-    wmask = (np.diagonal(A[:nwave,:nwave])<=0).astype(float)
+    wmask = (A_band[0,0::ncoef]<=0).astype(float)
     # empirically, need to account for the full width of the resolution band
     # (realized here by applying twice the resolution)
     wmask = Rmean.dot(Rmean.dot(wmask))
@@ -112,6 +112,7 @@ class Spectra(object):
 
         # copy data
 
+        self._index = None
         if fibermap is not None:
             self.fibermap = fibermap.copy()
         else:
@@ -223,6 +224,68 @@ class Spectra(object):
             return 0
 
 
+    @property
+    def fibermap(self):
+        """
+        (Table or array): the extended fibermap, one row per spectrum.
+        """
+        return self._fibermap
+
+    @fibermap.setter
+    def fibermap(self, value):
+        self._fibermap = value
+        self._index = None
+
+    def _column_index(self, column):
+        """
+        Return the cached index of a fibermap column, built on first use.
+
+        The index is a tuple (values, sorted_values, order) where values is a
+        copy of the column used to check that the fibermap was not modified in
+        place since the index was built, and order are the rows sorted by value.
+        """
+        if self._index is None:
+            self._index = {}
+        values = np.asarray(self.fibermap[column])
+        if column in self._index and np.array_equal(self._index[column][0], values):
+            return self._index[column]
+        order = np.argsort(values, kind="stable")
+        self._index[column] = (values.copy(), values[order], order)
+        return self._index[column]
+
+    def _match_rows(self, column, values):
+        """
+        Return a boolean array, True for the fibermap rows with a value
+        of column in values, using the cached index of the column.
+        """
+        junk, sorted_values, order = self._column_index(column)
+        if isinstance(values, (set, frozenset)):
+            values = list(values)
+        values = np.unique(np.atleast_1d(values))
+        begin = np.searchsorted(sorted_values, values, side="left")
+        end = np.searchsorted(sorted_values, values, side="right")
+        keep = np.zeros(sorted_values.size, dtype=bool)
+        counts = end - begin
+        if np.sum(counts) > 0:
+            #- indices of all sorted values in the [begin,end[ ranges
+            first = np.repeat(begin - np.cumsum(counts) + counts, counts)
+            keep[order[first + np.arange(np.sum(counts))]] = True
+        return keep
+
+    def _expid_fiber_index(self):
+        """
+        Return the cached dictionary of the fibermap rows for each (EXPID, FIBER).
+        """
+        expid, junk, junk = self._column_index("EXPID")
+        fiber, junk, junk = self._column_index("FIBER")
+        cached = self._index.get("EXPID_FIBER")
+        if cached is None or cached[0] is not expid or cached[1] is not fiber:
+            rows = {}
+            for i, key in enumerate(zip(expid.tolist(), fiber.tolist())):
+                rows.setdefault(key, []).append(i)
+            self._index["EXPID_FIBER"] = (expid, fiber, rows)
+        return self._index["EXPID_FIBER"][2]
+
     def select(self, nights=None, bands=None, targets=None, fibers=None, invert=False):
         """
         Select a subset of the data.
@@ -248,35 +311,31 @@ class Spectra(object):
         if len(keep_bands) == 0:
             raise RuntimeError("no valid bands were selected!")
 
-        keep_nights = None
-        if nights is None:
-            keep_nights = [ True for x in self.fibermap["NIGHT"] ]
-        else:
-            keep_nights = [ (x in nights) for x in self.fibermap["NIGHT"] ]
-        if sum(keep_nights) == 0:
+        nspec = len(self.fibermap)
+
+        keep_nights = np.ones(nspec, dtype=bool)
+        if nights is not None:
+            keep_nights = self._match_rows("NIGHT", nights)
+        if np.sum(keep_nights) == 0:
             raise RuntimeError("no valid nights were selected!")
 
-        keep_targets = None
-        if targets is None:
-            keep_targets = [ True for x in self.fibermap["TARGETID"] ]
-        else:
-            keep_targets = [ (x in targets) for x in self.fibermap["TARGETID"] ]
-        if sum(keep_targets) == 0:
+        keep_targets = np.ones(nspec, dtype=bool)
+        if targets is not None:
+            keep_targets = self._match_rows("TARGETID", targets)
+        if np.sum(keep_targets) == 0:
             raise RuntimeError("no valid targets were selected!")
 
-        keep_fibers = None
-        if fibers is None:
-            keep_fibers = [ True for x in self.fibermap["FIBER"] ]
-        else:
-            keep_fibers = [ (x in fibers) for x in self.fibermap["FIBER"] ]
-        if sum(keep_fibers) == 0:
+        keep_fibers = np.ones(nspec, dtype=bool)
+        if fibers is not None:
+            keep_fibers = self._match_rows("FIBER", fibers)
+        if np.sum(keep_fibers) == 0:
             raise RuntimeError("no valid fibers were selected!")
 
-        keep_rows = [ (x and y and z) for x, y, z in zip(keep_nights, keep_targets, keep_fibers) ]
+        keep_rows = keep_nights & keep_targets & keep_fibers
         if invert:
-            keep_rows = [ not x for x in keep_rows ]
+            keep_rows = ~keep_rows
 
-        keep = [ i for i, x in enumerate(keep_rows) if x ]
+        keep = np.where(keep_rows)[0]
         if len(keep) == 0:
             raise RuntimeError("selection has no spectra")
 
@@ -400,18 +459,19 @@ class Spectra(object):
         # Compute which targets / exposures are new
 
         nother = len(other.fibermap)
-        exists = np.zeros(nother, dtype=np.int)
+        exists = np.zeros(nother, dtype=int)
 
         indx_original = []
 
         if self.fibermap is not None:
-            for r in range(nother):
-                expid = other.fibermap[r]["EXPID"]
-                fiber = other.fibermap[r]["FIBER"]
-                for i, row in enumerate(self.fibermap):
-                    if (expid == row["EXPID"]) and (fiber == row["FIBER"]):
-                        indx_original.append(i)
-                        exists[r] += 1
+            #- hash join on (EXPID, FIBER) with the cached index of our rows
+            rows = self._expid_fiber_index()
+            keys = zip(np.asarray(other.fibermap["EXPID"]).tolist(),
+                       np.asarray(other.fibermap["FIBER"]).tolist())
+            for r, key in enumerate(keys):
+                match = rows.get(key, [])
+                indx_original.extend(match)
+                exists[r] = len(match)
 
         if len(np.where(exists > 1)[0]) > 0:
             raise RuntimeError("found duplicate spectra (same EXPID and FIBER) in the fibermap")
@@ -3,7 +3,7 @@ import unittest
 import numpy as np
 from desispec.spectra import Spectra
 from desispec.io import empty_fibermap
-from desispec.coaddition import coadd,fast_resample_spectra,spectroperf_resample_spectra
+from desispec.coaddition import coadd,coadd_cameras,fast_resample_spectra,spectroperf_resample_spectra
 from desispec.maskbits import fibermask
 
 class TestCoadd(unittest.TestCase):
@@ -30,6 +30,48 @@ class TestCoadd(unittest.TestCase):
         s1 = self._random_spectra(3,10)
         coadd(s1)
         
+    def test_coadd_multiple_targets(self):
+        """Test that coadding several targets at once is the same as one target at a time"""
+        nspec, nwave = 12, 30
+        s1 = self._random_spectra(nspec, nwave)
+        s1.fibermap["TARGETID"] = np.arange(nspec)%4 # interleaved targets
+        s1.fibermap["NIGHT"] = 20200101 # needed by Spectra.select
+        s1.fibermap["FIBERSTATUS"][5] = fibermask.BROKENFIBER
+        s1.flux['x'][6,12] += 100. # a cosmic ray
+        targets = np.unique(s1.fibermap["TARGETID"])
+        flux = s1.flux['x'].copy()
+
+        for cosmics_nsig in [0., 4.] :
+            s2 = s1.select(targets=targets)
+            coadd(s2, cosmics_nsig=cosmics_nsig)
+            self.assertTrue(np.all(s1.flux['x'] == flux)) # input not modified
+            self.assertTrue(np.all(s2.fibermap["TARGETID"] == targets))
+            for i,tid in enumerate(targets) :
+                s3 = s1.select(targets=[tid,])
+                coadd(s3, cosmics_nsig=cosmics_nsig)
+                self.assertTrue(np.allclose(s2.flux['x'][i], s3.flux['x'][0]))
+                self.assertTrue(np.allclose(s2.ivar['x'][i], s3.ivar['x'][0]))
+                self.assertTrue(np.allclose(s2.resolution_data['x'][i], s3.resolution_data['x'][0]))
+                self.assertEqual(s2.fibermap['COADD_NUMEXP'][i], s3.fibermap['COADD_NUMEXP'][0])
+
+            #- the cosmic ray is discarded
+            ivar = np.sum(s1.ivar['x'][[2,6,10],12])
+            if cosmics_nsig > 0 :
+                self.assertLess(s2.ivar['x'][2,12], ivar)
+            else :
+                self.assertAlmostEqual(s2.ivar['x'][2,12], ivar)
+
+    def test_coadd_cameras(self):
+        """Test coadd_cameras with several targets"""
+        s1 = self._random_spectra(6, 20)
+        s1.fibermap["TARGETID"] = np.arange(6)%3
+        coadd(s1)
+        s2 = coadd_cameras(s1)
+        self.assertEqual(s2.flux['x'].shape, (3, 20))
+        self.assertTrue(np.allclose(s2.flux['x'], s1.flux['x']))
+        self.assertTrue(np.allclose(s2.ivar['x'], s1.ivar['x']))
+        self.assertTrue(np.allclose(s2.resolution_data['x'], s1.resolution_data['x']))
+
     def test_spectroperf_resample(self):
         """Test spectroperf_resample"""
         s1 = self._random_spectra(1,20)
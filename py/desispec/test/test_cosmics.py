@@ -87,6 +87,45 @@ class TestCosmics(unittest.TestCase):
         cosmic = (image.pix > 0)
         self.assertTrue(np.all(image.mask[cosmic] & ccdmask.COSMIC))
 
+    def test_sparse_and_tiled(self):
+        """
+        Test that the sparse candidates and tiled repair match the full image versions
+        """
+        from desispec.cosmics import (_reject_cosmic_rays_ala_sdss_single_numba,
+            _reject_cosmic_rays_candidates, _neighbor_candidates,
+            _repair_mask_tiled, repair_mask)
+        rng = np.random.default_rng(0)
+        pix = rng.normal(size=(200,150))
+        pix[rng.integers(1,199,40),rng.integers(1,149,40)] += 50.
+        ivar = np.ones(pix.shape)
+        ivar[50:60,:] = 0.
+        psf_gradients = np.array([0.819245,0.847529,0.617514,0.656629])
+        selection = pix > 3.
+        dense = _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,3.,0.,0.9)
+        rows,cols = np.nonzero(selection[1:-1,1:-1])
+        sparse = _reject_cosmic_rays_candidates(pix,ivar,rows+1,cols+1,psf_gradients,3.,0.,0.9,nthreads=1)
+        threaded = _reject_cosmic_rays_candidates(pix,ivar,rows+1,cols+1,psf_gradients,3.,0.,0.9,nthreads=3,chunksize=10)
+        self.assertTrue(np.array_equal(sparse,threaded))
+        self.assertTrue(np.any(sparse))
+        self.assertTrue(np.array_equal(np.argwhere(dense),
+            np.column_stack([rows[sparse]+1,cols[sparse]+1])))
+
+        #- neighbors are unique, inside the CCD and not already rejected
+        rejected = np.zeros(pix.shape,dtype=bool)
+        rejected[[0,1,1,5],[3,1,2,149]] = True
+        nrows,ncols = _neighbor_candidates(np.array([1,1]),np.array([1,2]),rejected)
+        self.assertEqual(sorted(zip(nrows,ncols)),[(1,3),(2,1),(2,2),(2,3)])
+
+        #- tiled repair is identical to the full image repair
+        mask = np.zeros((300,250),dtype=bool)
+        mask[0:3,10:20] = True
+        mask[100,100:120:2] = True
+        mask[150:160:2,248] = True
+        mask[290:299,30] = True
+        for tile in (16,32,1000):
+            self.assertTrue(np.array_equal(_repair_mask_tiled(mask,tile),repair_mask.repair(mask)))
+        self.assertFalse(np.any(_repair_mask_tiled(np.zeros((10,10),dtype=bool))))
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()
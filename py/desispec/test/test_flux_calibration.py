@@ -68,6 +68,129 @@ class TestFluxCalibration(unittest.TestCase):
 
             #- TODO: come up with assertions for new return values
 
+    def test_match_templates_for_stars(self):
+        """
+        Test that fitting several stars at once gives the same result as one star at a time
+        """
+        from desispec.fluxcalibration import match_templates, match_templates_for_stars
+        frame=get_frame_data()
+        wave={"b":frame.wave,"r":frame.wave+10}
+        nmodels = 10
+        modelwave,modelflux=get_models(nmodels)
+        teff = np.random.uniform(5000, 7000, nmodels)
+        logg = np.random.uniform(4.0, 5.0, nmodels)
+        feh = np.random.uniform(-2.5, -0.5, nmodels)
+
+        stars = []
+        for i in range(3):
+            stars.append(dict(wave=wave,
+                              flux={"b":frame.flux[i],"r":frame.flux[i]*1.1},
+                              ivar={"b":frame.ivar[i].copy(),"r":frame.ivar[i]/1.1},
+                              resolution_data={"b":frame.resolution_data[i],"r":frame.resolution_data[i]},
+                              selection=np.arange(i,nmodels)))
+
+        for ncpu in (1, 2):
+            results = match_templates_for_stars(copy.deepcopy(stars), modelwave, modelflux, teff, logg, feh, ncpu=ncpu)
+            self.assertEqual(len(results), len(stars))
+            for star, (coef, redshift, chi2) in zip(stars, results):
+                sel = star["selection"]
+                coef2, redshift2, chi22 = match_templates(star["wave"], star["flux"], copy.deepcopy(star["ivar"]),
+                    star["resolution_data"], modelwave, modelflux[sel], teff[sel], logg[sel], feh[sel])
+                self.assertEqual(coef.size, sel.size)
+                self.assertTrue(np.allclose(coef, coef2))
+                self.assertAlmostEqual(redshift, redshift2)
+                self.assertAlmostEqual(chi2, chi22)
+
+    def test_resample_templates_redshift(self):
+        """
+        Test the resampling of the templates at a redshift, exact by default,
+        or with matrices cached per camera wavelength grid with log_resampling
+        """
+        from desispec import fluxcalibration
+        from desispec.fluxcalibration import resample_templates, resample_template
+        z_res = 0.00002
+        lstep = np.log10(1+z_res)
+        modelwave = np.arange(3000, 11000, 0.2)
+        modelflux = np.vstack([1+0.3*np.sin(modelwave/300.), 1+0.2*np.cos(modelwave/500.)])
+        modelflux -= 0.5*np.exp(-0.5*((modelwave-4861.)/2.)**2)
+        wave = {"b":np.arange(3600, 5900, 0.8)}
+        x = np.arange(11)-5
+        kernel = np.exp(-0.5*x**2)
+        resolution_data = {"b":np.tile((kernel/kernel.sum())[:,None], (1,wave["b"].size))}
+        fluxcalibration._resampling_matrices.clear()
+        for shift in (0, 37, -120):
+            z = 10**(-shift*lstep)-1
+            wave1, flux1, norm1 = resample_templates(wave, resolution_data, modelwave, modelflux, redshift=z)
+            for i in range(modelflux.shape[0]):
+                _, wave0, flux0, norm0 = resample_template(wave, resolution_data, modelwave*(1+z), modelflux[i], i)
+                self.assertTrue(np.allclose(wave1, wave0))
+                self.assertTrue(np.allclose(flux1[i], flux0, rtol=0, atol=1e-12))
+                self.assertTrue(np.allclose(norm1[i], norm0, rtol=0, atol=1e-12))
+            wave2, flux2, norm2 = resample_templates(wave, resolution_data, modelwave, modelflux, redshift=z,
+                                                     log_resampling=True, z_res=z_res)
+            self.assertTrue(np.allclose(wave1, wave2))
+            self.assertTrue(np.allclose(flux1, flux2, atol=1e-3))
+            self.assertTrue(np.allclose(norm1, norm2, atol=1e-3))
+        #- a single cached entry for the camera wavelength grid, whatever the redshift
+        self.assertEqual(len(fluxcalibration._resampling_matrices), 1)
+
+    def test_match_templates_resampling(self):
+        """
+        Test match_templates against the resampling of each template with resample_template
+        """
+        from unittest import mock
+        from desispec import fluxcalibration
+        from desispec.fluxcalibration import match_templates, resample_template
+        from desispec.resolution import Resolution
+        rng = np.random.RandomState(1)
+        #- templates with absorption lines
+        modelwave = np.arange(3500, 8000, 0.2)
+        nmodels = 6
+        lines = rng.uniform(3600, 7800, 80)
+        modelflux = np.zeros((nmodels, modelwave.size))
+        for i in range(nmodels):
+            modelflux[i] = 1+0.3*np.sin(modelwave/(300.+20*i))
+            for line in lines:
+                modelflux[i] -= rng.uniform(0.1, 0.6)*np.exp(-0.5*((modelwave-line)/rng.uniform(0.5, 3))**2)
+        teff = rng.uniform(5000, 7000, nmodels)
+        logg = rng.uniform(4.0, 5.0, nmodels)
+        feh = rng.uniform(-2.5, -0.5, nmodels)
+        wave = {"b":np.arange(3600, 5900, 0.8), "r":np.arange(5700, 7600, 0.8)}
+        x = np.arange(11)-5
+        kernel = np.exp(-0.5*(x/1.2)**2)
+        resolution_data = dict([(cam, np.tile((kernel/kernel.sum())[:,None], (1,wave[cam].size))) for cam in wave])
+
+        def reference_resample_templates(wave, resolution_data, template_wave, template_flux, redshift=0., **kwargs):
+            #- one template at a time, as match_templates did before resample_templates
+            results = [resample_template(wave, resolution_data, template_wave*(1+redshift), template_flux[i], i)
+                       for i in range(template_flux.shape[0])]
+            return results[0][1], np.vstack([r[2] for r in results]), np.vstack([r[3] for r in results])
+
+        for star in range(2):
+            z = rng.uniform(-0.003, 0.003)
+            model = 0.7*modelflux[star]+0.3*modelflux[star+3]
+            flux = dict()
+            ivar = dict()
+            for cam in wave:
+                starflux = 100*Resolution(resolution_data[cam]).dot(np.interp(wave[cam], modelwave*(1+z), model))
+                flux[cam] = starflux+np.sqrt(starflux)*rng.normal(size=starflux.size)
+                ivar[cam] = 1/starflux
+            def args():
+                #- match_templates modifies ivar
+                return (wave, flux, copy.deepcopy(ivar), resolution_data, modelwave, modelflux, teff, logg, feh)
+            with mock.patch.object(fluxcalibration, 'resample_templates', reference_resample_templates):
+                coef0, redshift0, chi20 = match_templates(*args(), template_error=0.1)
+            #- unchanged by default
+            coef, redshift, chi2 = match_templates(*args(), template_error=0.1)
+            self.assertTrue(np.allclose(coef, coef0, rtol=0, atol=1e-12))
+            self.assertEqual(redshift, redshift0)
+            self.assertAlmostEqual(chi2/chi20, 1., 10)
+            #- within 1e-3 with log_resampling
+            coef, redshift, chi2 = match_templates(*args(), template_error=0.1, log_resampling=True)
+            self.assertTrue(np.allclose(coef, coef0, rtol=0, atol=1e-3))
+            self.assertEqual(redshift, redshift0)
+            self.assertLess(abs(chi2/chi20-1), 1e-3)
+
     def test_normalize_templates(self):
         """
         Test for normalization to a given magnitude for calibration
@@ -130,6 +253,31 @@ class TestFluxCalibration(unittest.TestCase):
         self.assertTrue(np.array_equal(fluxCalib.wave, frame.wave))
         self.assertEqual(fluxCalib.calib.shape,frame.flux.shape)
 
+    def test_banded_normal_equation(self):
+        """Test the banded normal equation of the calibration fit against the dense one
+        """
+        from desispec.sky import _weighted_resolution_data, _banded_normal_matrix, _banded_normal_vector
+        from desispec.linalg import banded_to_sparse
+        frame = get_frame_data()
+        nstd, nwave = 4, frame.nwave
+        sqrtw = np.sqrt(frame.ivar[:nstd])*np.random.uniform(0.9, 1.1, size=(nstd, nwave))
+        sqrtw[1, 20:30] = 0.
+        model = np.random.uniform(1., 2., size=(nstd, nwave))
+        sqrtwflux = sqrtw*frame.flux[:nstd]
+        goodfiber = np.array([1., 1., 0., 1.])
+
+        A = np.zeros((nwave, nwave))
+        B = np.zeros(nwave)
+        for star in np.where(goodfiber>0)[0]:
+            sqrtwmodelR = sqrtw[star][:,None]*frame.R[star].toarray()*model[star]
+            A += sqrtwmodelR.T.dot(sqrtwmodelR)
+            B += sqrtwmodelR.T.dot(sqrtwflux[star])
+
+        wdata = _weighted_resolution_data(frame.Rstack.data[:nstd], sqrtw, scale=model)
+        A_band = _banded_normal_matrix(wdata, fiber_weights=goodfiber)
+        self.assertTrue(np.allclose(banded_to_sparse(A_band).toarray(), A))
+        self.assertTrue(np.allclose(_banded_normal_vector(wdata, sqrtwflux, fiber_weights=goodfiber), B))
+
     def test_apply_fluxcalibration(self):
         #get frame_data
         wave = np.arange(5000, 6000)
@@ -3,7 +3,7 @@ import unittest
 import numpy as np
 import desispec.io
 from desispec.frame import Frame, Spectrum
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 from desispec.test.util import get_frame_data
 
 class TestFrame(unittest.TestCase):
@@ -24,7 +24,17 @@ class TestFrame(unittest.TestCase):
         self.assertTrue(np.all(frame.resolution_data == rdata))
         self.assertEqual(frame.nspec, nspec)
         self.assertEqual(frame.nwave, nwave)
+        #- resolution matrices are built on first access
+        self.assertTrue(frame._R is None)
         self.assertTrue(isinstance(frame.R[0], Resolution))
+        self.assertEqual(len(frame.R), nspec)
+        self.assertTrue(isinstance(frame.Rstack, ResolutionStack))
+        self.assertTrue(np.allclose(frame.Rstack.dot(flux)[1], frame.R[1].dot(flux[1])))
+        #- reassigning the resolution data rebuilds the resolution matrices
+        rdata2 = np.random.uniform(size=(nspec, 5, nwave))
+        frame.resolution_data = rdata2
+        self.assertTrue(np.allclose(frame.R[1].data, rdata2[1]))
+        self.assertTrue(np.allclose(frame.Rstack.dot(flux)[1], Resolution(rdata2[1]).dot(flux[1])))
         #- check dimensionality mismatches
         self.assertRaises(AssertionError, lambda x: Frame(*x), (wave, wave, ivar, mask, rdata))
         self.assertRaises(AssertionError, lambda x: Frame(*x), (wave, flux[0:2], ivar, mask, rdata))
@@ -32,6 +42,7 @@ class TestFrame(unittest.TestCase):
         #- Check constructing with defaults (must set fibers by some method)
         frame = Frame(wave, flux, ivar, spectrograph=0)
         self.assertEqual(frame.flux.shape, frame.mask.shape)
+        self.assertFalse(hasattr(frame, 'R'))
         
         #- Check usage of fibers inputs
         fibers = np.arange(nspec)
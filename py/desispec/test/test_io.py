@@ -603,6 +603,28 @@ class TestIO(unittest.TestCase):
             self.assertTrue(data2.dtype.isnative, dtype+' is not native endian')
             self.assertTrue(np.all(data1 == data2))
 
+    def test_lazy_import(self):
+        """Test that desispec.io imports its functions on first access.
+        """
+        import subprocess
+        import desispec.io
+        from ..io.frame import read_frame
+        from ..io.util import fitsheader
+        self.assertIs(desispec.io.read_frame, read_frame)
+        self.assertIs(desispec.io.util.fitsheader, fitsheader)
+        self.assertIn('write_qa_frame', dir(desispec.io))
+        self.assertIn('fibermap', dir(desispec.io))
+        with self.assertRaises(AttributeError):
+            desispec.io.read_nothing
+        #- in a fresh interpreter, findfile doesn't import astropy tables
+        code = ("import sys; from desispec.io import findfile; "
+                "assert 'astropy.table' not in sys.modules; "
+                "assert 'desispec.io.qa' not in sys.modules")
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        proc = subprocess.run([sys.executable, '-c', code], env=env)
+        self.assertEqual(proc.returncode, 0)
+
     def test_findfile(self):
         """Test desispec.io.meta.findfile and desispec.io.download.filepath2url.
         """
@@ -0,0 +1,61 @@
+"""
+test desispec.kernels
+"""
+
+import os
+import unittest
+import tempfile
+import shutil
+import numpy as np
+import numba
+
+import desispec.kernels
+from desispec.kernels import jit, registered_kernels, set_cache_dir, compile_kernels
+
+
+@jit('(float64[::1],)')
+def _kernel_sum(x):
+    s = 0.
+    for i in range(x.size):
+        s += x[i]
+    return s
+
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.origcachedir = numba.config.CACHE_DIR
+
+    def tearDown(self):
+        set_cache_dir(self.origcachedir or None)
+        shutil.rmtree(self.cachedir)
+
+    def test_registry(self):
+        """Test that kernels are registered with their signatures"""
+        import desispec.cosmics
+        kernels = registered_kernels()
+        self.assertIn('desispec.cosmics.dilate_numba', kernels)
+        self.assertEqual(kernels[__name__+'._kernel_sum'], ['(float64[::1],)'])
+        self.assertEqual(_kernel_sum(np.arange(4.)), 6.)
+        #- other types are still compiled on demand
+        self.assertEqual(_kernel_sum(np.arange(4)), 6)
+
+    def test_compile_cache(self):
+        """Test that compile_kernels writes the kernels in the cache directory"""
+        timing = compile_kernels(cache_dir=self.cachedir)
+        self.assertIn(__name__+'._kernel_sum', timing)
+        self.assertEqual(numba.config.CACHE_DIR, self.cachedir)
+        cachefiles = [f for dirpath, dirnames, filenames in os.walk(self.cachedir)
+                      for f in filenames]
+        self.assertTrue(any(f.startswith('test_kernels._kernel_sum') for f in cachefiles))
+        self.assertTrue(any(f.startswith('cosmics.dilate_numba') for f in cachefiles))
+
+        #- the cache is indexed by the argument types of the calls
+        dispatcher, sigs = desispec.kernels._registry[__name__+'._kernel_sum']
+        argtypes = (numba.typeof(np.ones(3)),)
+        self.assertIsNotNone(dispatcher._cache.load_overload(argtypes, dispatcher.targetctx))
+
+#- This runs all test* functions in any TestCase class in this file
+if __name__ == '__main__':
+    unittest.main()
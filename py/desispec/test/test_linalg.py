@@ -9,6 +9,9 @@ import numpy.random
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
 from desispec.linalg import cholesky_invert
+from desispec.linalg import cholesky_solve_banded
+from desispec.linalg import cholesky_invert_banded
+from desispec.linalg import banded_to_sparse
 
 class TestLinalg(unittest.TestCase):
     
@@ -81,7 +84,52 @@ class TestLinalg(unittest.TestCase):
         d=np.inner(delta,delta)
         self.assertAlmostEqual(d,0.)
         
-        
+    def _random_banded_matrix(self,n,ndiag):
+        # create a random positive definite banded matrix A
+        # with ndiag-1 non-zero diagonals on each side
+        # (the identity makes sure it is well conditioned)
+        A = np.eye(n)
+        for i in range(2*n) :
+            H = np.zeros(n)
+            j = numpy.random.randint(n-ndiag+1)
+            H[j:j+ndiag] = numpy.random.random(ndiag)
+            A += np.outer(H,H.T)
+        Ab = np.zeros((ndiag,n))
+        for d in range(ndiag) :
+            Ab[d,:n-d] = np.diagonal(A,-d)
+        return A,Ab
+
+    def test_banded_to_sparse(self):
+        A,Ab = self._random_banded_matrix(30,4)
+        As = banded_to_sparse(Ab).toarray()
+        self.assertTrue(np.all(As==A))
+
+    def test_cholesky_solve_banded(self):
+        n = 30
+        A,Ab = self._random_banded_matrix(n,4)
+        # random X
+        X = numpy.random.random(n)
+        # compute B
+        B = A.dot(X)
+        # solve for X given A and B
+        Xs=cholesky_solve_banded(Ab,B)
+        self.assertTrue(np.allclose(Xs,cholesky_solve(A,B)))
+        self.assertTrue(np.allclose(Xs,X))
+
+    def test_cholesky_invert_banded(self):
+        n = 30
+        ndiag = 4
+        A,Ab = self._random_banded_matrix(n,ndiag)
+        Ai=cholesky_invert(A)
+        Aib=cholesky_invert_banded(Ab)
+        self.assertEqual(Aib.shape,Ab.shape)
+        for d in range(ndiag) :
+            self.assertTrue(np.allclose(Aib[d,:n-d],np.diagonal(Ai,-d)))
+            self.assertTrue(np.all(Aib[d,n-d:]==0))
+        # fewer diagonals
+        Aib2=cholesky_invert_banded(Ab,ndiag=2)
+        self.assertEqual(Aib2.shape,(2,n))
+        self.assertTrue(np.allclose(Aib2,Aib[:2]))
                 
     def runTest(self):
         pass
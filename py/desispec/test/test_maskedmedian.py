@@ -0,0 +1,96 @@
+"""
+tests desispec.maskedmedian
+"""
+
+import unittest
+
+import numpy as np
+
+import scipy.ndimage
+
+from desispec.maskedmedian import masked_median, clipped_mean, ImageStack
+from desispec.maskedmedian import masked_median_filter, dilate_mask
+
+
+class TestMaskedMedian(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.nimages = 6
+        self.shape = (40, 53)
+        self.images = rng.normal(size=(self.nimages,)+self.shape)
+        self.masks = (rng.uniform(size=self.images.shape) < 0.3).astype(np.uint32)*8
+        #- fully masked pixel
+        self.masks[:, 0, 0] = 1
+
+    def test_masked_median(self):
+        """Test the median in blocks of pixels against numpy"""
+        for nimages in (1, 2, 5, 6):
+            ref = np.ma.median(np.ma.masked_array(self.images[:nimages], mask=(self.masks[:nimages]!=0)), axis=0).data
+            for nthreads in (1, 3):
+                median = masked_median(self.images[:nimages], self.masks[:nimages], nthreads=nthreads, chunksize=500)
+                self.assertTrue(np.array_equal(median, ref))
+        self.assertEqual(median[0, 0], 0.)
+        median = masked_median(self.images, nthreads=2, chunksize=300)
+        self.assertTrue(np.array_equal(median, np.median(self.images, axis=0)))
+
+    def test_clipped_mean(self):
+        """Test the clipped mean in blocks of pixels"""
+        images = self.images.copy()
+        images[2, 10, 10] = 1000.
+        center = np.median(images, axis=0)
+        mean = clipped_mean(images, center, nsig=4., nthreads=2, chunksize=700)
+        ares = np.abs(images-center)
+        keep = (ares < 4*1.4826*np.median(ares, axis=0))
+        self.assertFalse(keep[2, 10, 10])
+        self.assertTrue(np.allclose(mean, np.sum(images*keep, axis=0)/np.sum(keep, axis=0)))
+
+    def test_image_stack(self):
+        """Test the memory mapped stack of images"""
+        stack = ImageStack(self.nimages, self.shape, masks=True)
+        for image, mask in zip(self.images, self.masks):
+            stack.add(image, mask)
+        with self.assertRaises(ValueError):
+            stack.add(self.images[0], self.masks[0])
+        median = stack.median(chunksize=1000)
+        self.assertTrue(np.array_equal(median, masked_median(self.images, self.masks)))
+        mean = stack.clipped_mean(median)
+        self.assertTrue(np.array_equal(mean, clipped_mean(self.images, median), equal_nan=True))
+        stack.close()
+        self.assertIsNone(stack.images)
+
+        #- median of the images added so far
+        stack = ImageStack(self.nimages, self.shape)
+        stack.add(self.images[0])
+        stack.add(self.images[1])
+        self.assertTrue(np.array_equal(stack.median(), np.median(self.images[:2], axis=0)))
+        stack.close()
+
+    def test_masked_median_filter(self):
+        """Test the sliding masked median against scipy.ndimage.generic_filter"""
+        def median_of_nonzero(values):
+            values = values[values!=0]
+            return np.median(values) if values.size > 0 else 0.
+        image = np.abs(self.images[0])*(self.masks[0]==0)
+        image[:, 7] = 0.
+        for shape in ([9, 1], [1, 9], [1, 4], [3, 5], [101, 1]):
+            ref = scipy.ndimage.generic_filter(image, median_of_nonzero, size=shape)
+            for nthreads in (1, 3):
+                filtered = masked_median_filter(image, shape, nthreads=nthreads)
+                self.assertTrue(np.array_equal(filtered, ref))
+
+    def test_dilate_mask(self):
+        """Test the dilation of a mask"""
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[0, 3] = mask[20, 30] = True
+        dilated = dilate_mask(mask, 2, 3)
+        self.assertEqual(dilated.dtype, mask.dtype)
+        self.assertEqual(np.sum(dilated), 3*7+5*7)
+        self.assertTrue(np.all(dilated[18:23, 27:34]))
+        self.assertTrue(np.all(dilated[0:3, 0:7]))
+        self.assertTrue(np.array_equal(dilate_mask(mask, 0, 0), mask))
+
+
+#- This runs all test* functions in any TestCase class in this file
+if __name__ == '__main__':
+    unittest.main()
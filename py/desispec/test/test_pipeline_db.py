@@ -0,0 +1,218 @@
+"""
+tests desispec.pipeline.db
+"""
+
+import os
+import unittest
+import unittest.mock
+import shutil
+import tempfile
+import pickle
+import numpy as np
+
+from desispec.pipeline.db import DataBaseSqlite, check_tasks
+from desispec.pipeline.dbservice import StateService, StateClient
+from desispec.pipeline.fsindex import FileIndex
+from desispec.pipeline.timing import RuntimeModel, runtime_model
+from desispec.pipeline.plan import compute_worker_tasks
+from desispec.pipeline.tasks.base import task_classes
+
+
+class TestPipelineDB(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.testdir, "desi.db")
+        self.names = list()
+        self.tasks = task_classes["preproc"]
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def _fill(self, db, nexp=700):
+        #- more tasks than the bound parameters of a single select
+        with db.cursor() as cur:
+            for expid in range(nexp):
+                props = dict(night=20200101, band="b", spec=0, expid=expid,
+                             flavor="science")
+                self.tasks.insert(cur, props)
+                self.names.append(self.tasks.name_join(props))
+
+    def test_states(self):
+        """Test batched state updates and lookups"""
+        db = DataBaseSqlite(self.dbpath, "w")
+        self._fill(db)
+        states = db.get_states_type("preproc", self.names)
+        self.assertEqual(len(states), len(self.names))
+        self.assertTrue(all([ x == "waiting" for x in states.values() ]))
+
+        db.set_states_type("preproc",
+            [ (x, "ready") for x in self.names[::2] ])
+        states = db.get_states_type("preproc", self.names)
+        for i, name in enumerate(self.names):
+            self.assertEqual(states[name], "waiting" if i % 2 else "ready")
+
+        #- single task updates, within and outside of a transaction
+        self.tasks.state_set(db, self.names[1], "running")
+        self.assertEqual(self.tasks.state_get(db, self.names[1]), "running")
+        with db.cursor() as cur:
+            self.tasks.state_set(db, self.names[3], "failed", cur=cur)
+            self.assertEqual(self.tasks.state_get(db, self.names[3], cur=cur),
+                             "failed")
+
+        #- a name with a quote is a value, not SQL
+        self.assertEqual(db.get_states_type("preproc", ["x' or '1'='1"]), {})
+
+    def test_submitted(self):
+        """Test batched updates of the submitted flag"""
+        db = DataBaseSqlite(self.dbpath, "w")
+        self._fill(db, nexp=10)
+        db.set_submitted(self.names[:4])
+        sub = db.get_submitted(self.names)
+        self.assertEqual([ sub[x] for x in self.names ], [1]*4 + [0]*6)
+        db.set_submitted(self.names[:2], unset=True)
+        sub = db.get_submitted(self.names)
+        self.assertEqual([ sub[x] for x in self.names ], [0]*2 + [1]*2 + [0]*6)
+
+    def test_connection(self):
+        """Test the transactions of the persistent connection"""
+        db = DataBaseSqlite(self.dbpath, "w")
+        self._fill(db, nexp=2)
+        #- an error rolls back the whole transaction
+        with self.assertRaises(RuntimeError):
+            with db.cursor() as cur:
+                self.tasks.state_set(db, self.names[0], "done", cur=cur)
+                raise RuntimeError("abort")
+        self.assertEqual(self.tasks.state_get(db, self.names[0]), "waiting")
+
+        #- the connection is not pickled, other processes open their own
+        db2 = pickle.loads(pickle.dumps(db))
+        self.assertIsNone(db2._conn)
+        self.assertEqual(self.tasks.state_get(db2, self.names[0]), "waiting")
+
+        #- other connections see the committed updates
+        self.tasks.state_set(db, self.names[0], "ready")
+        db3 = DataBaseSqlite(self.dbpath, "r")
+        self.assertEqual(self.tasks.state_get(db3, self.names[0]), "ready")
+
+    def test_wal(self):
+        """Test write-ahead logging is kept once enabled"""
+        db = DataBaseSqlite(self.dbpath, "w", wal=True)
+        with db.cursor() as cur:
+            cur.execute("pragma journal_mode")
+            self.assertEqual(cur.fetchone()[0], "wal")
+        db = DataBaseSqlite(self.dbpath, "w")
+        with db.cursor() as cur:
+            cur.execute("pragma journal_mode")
+            self.assertEqual(cur.fetchone()[0], "wal")
+
+    def test_state_service(self):
+        """Test the aggregation of the task states by a service"""
+        db = DataBaseSqlite(self.dbpath, "w")
+        self._fill(db, nexp=10)
+        service = StateService(db, self.names, interval=1000., maxbuffer=4)
+        client = StateClient(service=service)
+        states = check_tasks(self.names, db=client)
+        self.assertEqual(states, db.get_states(self.names))
+
+        #- the clients see the new states before they are in the DB
+        for name in self.names[:3]:
+            self.tasks.state_set(client, name, "running")
+        self.assertEqual(self.tasks.state_get(client, self.names[0]), "running")
+        self.assertEqual(self.tasks.state_get(db, self.names[0]), "waiting")
+
+        #- written in bulk when the buffer is full
+        self.tasks.state_set(client, self.names[0], "done")
+        self.tasks.state_set(client, self.names[3], "failed")
+        self.assertEqual(self.tasks.state_get(db, self.names[0]), "done")
+        self.assertEqual(self.tasks.state_get(db, self.names[3]), "failed")
+        self.tasks.state_set(client, self.names[1], "done")
+        self.assertEqual(self.tasks.state_get(db, self.names[1]), "running")
+        service.close()
+        self.assertEqual(self.tasks.state_get(db, self.names[1]), "done")
+        self.assertEqual(service.nupdate, 6)
+        self.assertEqual(service.nflush, 2)
+
+        #- postprocessing of the done tasks at each flush, which may make
+        #- other tasks ready
+        postprocessed = list()
+        def postprocessing(db, name, cur):
+            postprocessed.append(name)
+            self.tasks.state_set(db, self.names[9], "ready", cur=cur)
+        service = StateService(db, self.names, interval=1000., maxbuffer=1)
+        client = StateClient(service=service)
+        with unittest.mock.patch.object(self.tasks, "postprocessing",
+            postprocessing):
+            self.tasks.state_set(client, self.names[5], "running")
+            self.assertEqual(postprocessed, [])
+            self.tasks.state_set(client, self.names[5], "done")
+        self.assertEqual(postprocessed, [self.names[5]])
+        self.assertEqual(self.tasks.state_get(client, self.names[9]), "ready")
+        service.close()
+
+        with self.assertRaises(ValueError):
+            StateClient()
+
+    def test_file_index(self):
+        """Test the snapshot of the files of directories"""
+        subdirs = [ os.path.join(self.testdir, x) for x in ["a", "b"] ]
+        for d in subdirs:
+            os.makedirs(os.path.join(d, "sub"))
+            for i in range(3):
+                with open(os.path.join(d, "file{}.fits".format(i)), "w") as f:
+                    f.write("")
+            #- old enough to be saved
+            os.utime(d, ns=(0, 0))
+        index = FileIndex()
+        for d in subdirs:
+            for i in range(4):
+                path = os.path.join(d, "file{}.fits".format(i))
+                self.assertEqual(index.isfile(path), os.path.isfile(path))
+            self.assertFalse(index.isfile(os.path.join(d, "sub")))
+        self.assertFalse(index.isfile(os.path.join(self.testdir, "c", "x")))
+        self.assertEqual(index.nscan, 2)
+
+        #- saved listings are reused for the unchanged directories
+        cache = os.path.join(self.testdir, "index.json")
+        index.save(cache)
+        with open(os.path.join(subdirs[1], "file3.fits"), "w") as f:
+            f.write("")
+        index = FileIndex(cache)
+        self.assertTrue(index.isfile(os.path.join(subdirs[0], "file0.fits")))
+        self.assertTrue(index.isfile(os.path.join(subdirs[1], "file3.fits")))
+        self.assertEqual(index.nscan, 1)
+
+    def test_runtime_model(self):
+        """Test the run time model fitted to the measured run times"""
+        estimates = np.linspace(1., 10., 20)
+        model = RuntimeModel("preproc", estimates, 2.0 * estimates**0.8)
+        self.assertAlmostEqual(model.slope, 0.8)
+        self.assertAlmostEqual(model.predict(5.0), 2.0 * 5.0**0.8)
+        #- too few runs to fit the index
+        model = RuntimeModel("preproc", estimates[:3], 3.0 * estimates[:3])
+        self.assertEqual(model.slope, 1.0)
+        self.assertAlmostEqual(model.predict(5.0), 15.0)
+
+        db = DataBaseSqlite(self.dbpath, "w")
+        self._fill(db, nexp=4)
+        self.assertIsNone(runtime_model(db, "preproc"))
+        estimate = self.tasks.run_time(self.names[0], 4)
+        db.insert_task_timing([ dict(name=x, procs=4, runtime=0.5*estimate,
+            estimate=estimate, timefactor=0.5, maxmem=1.0) for x in self.names ])
+        runs = db.select_task_timing("preproc")
+        self.assertEqual(len(runs), 4)
+        self.assertEqual(runs[0]["tasktype"], "preproc")
+        self.assertEqual(db.select_task_timing("psf"), [])
+        model = runtime_model(db, "preproc")
+        self.assertAlmostEqual(model.run_time(self.names[0], 4), estimate)
+
+        #- the planning uses the model
+        tasks, times, dist = compute_worker_tasks("preproc", self.names, 1.0,
+            2, 4, db=db)
+        self.assertAlmostEqual(times[0], estimate)
+
+
+#- This runs all test* functions in any TestCase class in this file
+if __name__ == '__main__':
+    unittest.main()
@@ -81,6 +81,22 @@ class TestPipelineRun(unittest.TestCase):
         # sp.call(com, shell=True, env=os.environ.copy())
         pass
 
+    def test_task_memory(self):
+        from desispec.pipeline.run import _reset_peak_memory, _memory_peaks, _task_memory
+        #- a large task followed by a smaller one
+        x = np.ones(200*1024**2//8)
+        del x
+        reset = _reset_peak_memory()
+        start = _memory_peaks()
+        x = np.ones(50*1024**2//8)
+        maxmem = _task_memory(start, reset)
+        del x
+        #- the increase over the memory at the start of the task, whatever
+        #- the memory used by the process before
+        self.assertGreater(maxmem, 0.045)
+        if reset:
+            self.assertLess(maxmem, 0.1)
+
 
 def test_suite():
     """Allows testing of only this module with the command::
@@ -0,0 +1,102 @@
+"""
+tests desispec.pipeline.taskqueue
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+import multiprocessing
+
+from desispec.pipeline.taskqueue import TaskQueue, FileTaskQueue
+from desispec.pipeline.run import _queue_tasks
+
+
+def _take_all(path):
+    #- a process starting after the queue is drained has no task of its own
+    queue = FileTaskQueue(path, [])
+    tasks = list(_queue_tasks(queue, None, True))
+    queue.close()
+    return tasks
+
+
+def _crash(path, tasks, ntask):
+    #- take some tasks and exit without closing the queue
+    queue = FileTaskQueue(path, tasks)
+    for i in range(ntask):
+        queue.next_task()
+    os._exit(1)
+
+
+class TestPipelineTaskQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.tasks = [ "preproc_20200101_b_0_{:08d}".format(x) for x in range(50) ]
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_queue(self):
+        """Test that the tasks are taken in order"""
+        queue = TaskQueue(self.tasks)
+        self.assertEqual(list(_queue_tasks(queue, None, True)), self.tasks)
+        self.assertIsNone(queue.next_task())
+        self.assertEqual(list(_queue_tasks(TaskQueue(self.tasks), None, False)), [])
+
+    def test_file_queue(self):
+        """Test a queue shared by several processes through a file"""
+        path = os.path.join(self.testdir, "tasks.queue")
+        first = FileTaskQueue(path, self.tasks)
+        #- the other processes use the tasks of the file
+        second = FileTaskQueue(path, self.tasks[::-1])
+        self.assertEqual(second.tasks, self.tasks)
+        self.assertEqual(first.next_task(), self.tasks[0])
+        self.assertEqual(second.next_task(), self.tasks[1])
+        self.assertEqual(first.next_task(), self.tasks[2])
+
+        #- the last process to close the queue removes the file
+        first.close()
+        self.assertTrue(os.path.exists(path))
+        second.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".users"))
+
+        path = os.path.join(self.testdir, "shared.queue")
+        queue = FileTaskQueue(path, self.tasks)
+        with multiprocessing.Pool(3) as pool:
+            taken = pool.map(_take_all, [path,]*3)
+        taken = [ x for proctasks in taken for x in proctasks ]
+        self.assertEqual(sorted(taken), sorted(self.tasks))
+        queue.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_stale_file_queue(self):
+        """Test that a rerun does not use the queue file of a previous run"""
+        path = os.path.join(self.testdir, "tasks.queue")
+        #- drained by a run that is still going
+        queue = FileTaskQueue(path, self.tasks)
+        self.assertEqual(list(_queue_tasks(queue, None, True)), self.tasks)
+        rerun = FileTaskQueue(path, self.tasks[:2])
+        self.assertEqual(list(_queue_tasks(rerun, None, True)), self.tasks[:2])
+        queue.close()
+        rerun.close()
+        self.assertFalse(os.path.exists(path))
+
+        #- left by a run that crashed after taking some tasks
+        proc = multiprocessing.Process(target=_crash, args=(path, self.tasks, 10))
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 1)
+        self.assertTrue(os.path.exists(path))
+        rerun = FileTaskQueue(path, self.tasks[::-1])
+        self.assertEqual(rerun.tasks, self.tasks[::-1])
+        self.assertEqual(list(_queue_tasks(rerun, None, True)), self.tasks[::-1])
+        rerun.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".users"))
+
+#- This runs all test* functions in any TestCase class in this file
+if __name__ == '__main__':
+    unittest.main()
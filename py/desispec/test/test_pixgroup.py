@@ -1,5 +1,6 @@
 import unittest, os, sys, shutil, tempfile
 import numpy as np
+import fitsio
 from astropy.io import fits
 from copy import deepcopy
 
@@ -11,6 +12,9 @@ if __name__ == '__main__':
 from ..test.util import get_frame_data
 from ..io import findfile, write_frame, read_spectra, specprod_root
 from ..scripts import group_spectra
+from ..pixgroup import get_exp2healpix_map, read_exp2healpix_index, write_exp2healpix_index
+from ..pixgroup import order_healpix_by_overlap, update_frame_cache
+from ..pixgroup import FrameLite, SpectraLite, frames2spectra
 from desispec.maskbits import fibermask
 
 class TestPixGroup(unittest.TestCase):
@@ -101,6 +105,42 @@ class TestPixGroup(unittest.TestCase):
             self.assertEqual(len(spectra.fibermap), nspec)
             self.assertEqual(spectra.flux['b'].shape[0], nspec)
 
+            #- by default, a single HDU per EXTNAME
+            with fits.open(specfile) as fx:
+                names = [hdu.name for hdu in fx]
+                self.assertEqual(names.count('FIBERMAP'), 1)
+                self.assertEqual(fx[0].header['NAPPEND'], 0)
+
+    def test_regroup_append_compact(self):
+        specfile = os.path.join(self.outdir, 'spectra-64-19456.fits')
+        for night in self.nights[0:2]:
+            cmd = 'desi_group_spectra --append -o {} --nights {}'.format(self.outdir, night)
+            args = group_spectra.parse(cmd.split()[1:])
+            group_spectra.main(args)
+        appended = read_spectra(specfile)
+        nspec = self.nspec_per_frame * self.nframe_per_night * 2
+        self.assertEqual(len(appended.fibermap), nspec)
+        with fits.open(specfile) as fx:
+            self.assertEqual(fx[0].header['NAPPEND'], 1)
+            names = [hdu.name for hdu in fx]
+            self.assertEqual(names.count('FIBERMAP'), 2)
+
+        #- without --append, the file is rewritten with a single HDU per EXTNAME
+        cmd = 'desi_group_spectra -o {} --nights {}'.format(self.outdir, self.nights[2])
+        args = group_spectra.parse(cmd.split()[1:])
+        group_spectra.main(args)
+        nspec = self.nspec_per_frame * self.nframe_per_night * 3
+        with fits.open(specfile) as fx:
+            self.assertEqual(fx[0].header['NAPPEND'], 0)
+            names = [hdu.name for hdu in fx]
+            self.assertEqual(names.count('FIBERMAP'), 1)
+            self.assertEqual(len(fx['FIBERMAP'].data), nspec)
+        spectra = read_spectra(specfile)
+        nold = len(appended.fibermap)
+        self.assertTrue(np.all(spectra.fibermap['EXPID'][:nold] == appended.fibermap['EXPID']))
+        for band in spectra.bands:
+            self.assertTrue(np.all(spectra.flux[band][:nold] == appended.flux[band]))
+
     def test_regroup_fiberstatus_propagation(self):
         #- run on a specific set of nights
         cmd = 'desi_group_spectra -o {} --nights {}'.format(self.outdir, self.badnight)
@@ -175,6 +215,129 @@ class TestPixGroup(unittest.TestCase):
         self.assertEqual(len(spectra.fibermap), nspec)
         self.assertEqual(spectra.flux['b'].shape[0], nspec)
 
+    def test_exp2healpix_index(self):
+        #- Index is created on first call and matches a scan without index
+        indexfile = os.path.join(self.outdir, 'exp2healpix-64.fits')
+        exp2pix = get_exp2healpix_map(indexfile=indexfile)
+        noindex = get_exp2healpix_map(use_index=False)
+        self.assertTrue(os.path.exists(indexfile))
+        self.assertTrue(np.all(exp2pix == noindex))
+        self.assertEqual(len(exp2pix), len(self.nights)*self.nframe_per_night)
+
+        #- Unchanged files are not rescanned; fake a different answer in
+        #- the index to prove it is used
+        index = read_exp2healpix_index(indexfile)
+        index['NTARGETS'] += 1000
+        write_exp2healpix_index(indexfile, index)
+        exp2pix = get_exp2healpix_map(indexfile=indexfile)
+        self.assertTrue(np.all(exp2pix['NTARGETS'] == noindex['NTARGETS'] + 1000))
+
+        #- Modified files are rescanned
+        night, expid = self.nights[1], self.nframe_per_night + 1
+        filename = findfile('cframe', night, expid, 'b0')
+        os.utime(filename, (0, os.path.getmtime(filename)+10))
+        exp2pix = get_exp2healpix_map(indexfile=indexfile)
+        ii = (exp2pix['NIGHT'] == night) & (exp2pix['EXPID'] == expid)
+        self.assertTrue(np.all(exp2pix['NTARGETS'][ii] == noindex['NTARGETS'][ii]))
+        self.assertTrue(np.all(exp2pix['NTARGETS'][~ii] == noindex['NTARGETS'][~ii] + 1000))
+
+        #- Only the requested nights are returned but others stay in the index
+        exp2pix = get_exp2healpix_map(nights=self.nights[0:1], indexfile=indexfile)
+        self.assertTrue(np.all(exp2pix['NIGHT'] == self.nights[0]))
+        index = read_exp2healpix_index(indexfile)
+        self.assertEqual(len(index), len(noindex))
+
+        #- nside mismatch ignores the index
+        self.assertIsNone(read_exp2healpix_index(indexfile, nside=32))
+
+    def test_order_healpix_by_overlap(self):
+        exp2pix = np.zeros(7, dtype=[('NIGHT', 'i4'), ('EXPID', 'i8'),
+            ('SPECTRO', 'i4'), ('HEALPIX', 'i8'), ('NTARGETS', 'i8')])
+        exp2pix['EXPID'] = [1, 1, 2, 2, 3, 3, 4]
+        exp2pix['HEALPIX'] = [10, 30, 30, 20, 20, 30, 40]
+        pixels, nframes = order_healpix_by_overlap(exp2pix)
+        self.assertEqual(list(pixels), [10, 30, 20, 40])
+        self.assertEqual(list(nframes), [1, 3, 2, 1])
+
+    def test_frame_cache(self):
+        keys = [(self.nights[0], expid, camera) for expid in (2, 3) for camera in ('b0', 'r0')]
+
+        #- without budget the cache only has the requested frames
+        frames = dict()
+        update_frame_cache(frames, keys[0:2])
+        update_frame_cache(frames, keys[2:4])
+        self.assertEqual(list(frames.keys()), keys[2:4])
+
+        #- with a budget, least recently used frames are dropped first
+        nbytes = frames[keys[2]].nbytes
+        update_frame_cache(frames, keys[0:1], max_memory=3*nbytes)
+        self.assertEqual(list(frames.keys()), [keys[2], keys[3], keys[0]])
+        update_frame_cache(frames, keys[2:3] + keys[1:2], max_memory=3*nbytes)
+        self.assertEqual(list(frames.keys()), [keys[0], keys[2], keys[1]])
+
+        #- requested frames are kept even if over budget
+        update_frame_cache(frames, keys, max_memory=0)
+        self.assertEqual(sorted(frames.keys()), sorted(keys))
+
+    def test_regroup_frame_cache(self):
+        cmd = 'desi_group_spectra -o {} --frame-cache-gb 1'.format(self.outdir)
+        args = group_spectra.parse(cmd.split()[1:])
+        group_spectra.main(args)
+
+        specfile = os.path.join(self.outdir, 'spectra-64-19456.fits')
+        spectra = read_spectra(specfile)
+        nspec = self.nspec_per_frame * self.nframe_per_night * len(self.nights)
+        self.assertEqual(len(spectra.fibermap), nspec)
+
+    def test_spectralite_append(self):
+        frames = list()
+        for expid in (2, 3):
+            frames.append(dict([((self.nights[0], expid, cam),
+                FrameLite.read(findfile('cframe', self.nights[0], expid, cam)))
+                for cam in ('b0', 'r0', 'z0')]))
+        sp1 = frames2spectra(frames[0])
+        sp2 = frames2spectra(frames[1])
+        full = sp1 + sp2
+
+        header = dict(HPXPIXEL=19456)
+        fullfile = os.path.join(self.outdir, 'full.fits')
+        appendfile = os.path.join(self.outdir, 'append.fits')
+        full.write(fullfile, header=header)
+        sp1.write(appendfile, header=header, append=True)
+        sp2.write(appendfile, header=dict(FOO='bar'), append=True)
+
+        def check(filename):
+            sp = SpectraLite.read(filename)
+            self.assertTrue(np.all(sp.fibermap == full.fibermap))
+            for band in full.bands:
+                self.assertTrue(np.all(sp.flux[band] == full.flux[band]))
+                self.assertTrue(np.all(sp.ivar[band] == full.ivar[band]))
+                self.assertTrue(np.all(sp.mask[band] == full.mask[band]))
+                self.assertTrue(np.all(sp.resolution_data[band] == full.resolution_data[band]))
+            with fits.open(filename, checksum=True) as fx:
+                self.assertEqual(fx[0].header['HPXPIXEL'], 19456)
+            spectra = read_spectra(filename)
+            self.assertEqual(len(spectra.fibermap), len(full.fibermap))
+
+        check(appendfile)
+        with fits.open(appendfile) as fx:
+            self.assertEqual(fx[0].header['FOO'], 'bar')
+            self.assertEqual(fx[0].header['NAPPEND'], 1)
+            self.assertEqual(fx[-1].header['EXTVER'], 2)
+
+        #- the HDUs of an interrupted append are ignored, then removed
+        #- by the next append
+        with fitsio.FITS(appendfile, 'rw') as fx:
+            fx.write(sp2.flux['b'], extname='B_FLUX', extver=3)
+        check(appendfile)
+        sp2.write(appendfile, append=True)
+        sp = SpectraLite.read(appendfile)
+        self.assertEqual(len(sp.fibermap), len(full.fibermap) + len(sp2.fibermap))
+        self.assertTrue(np.all(sp.mask['z'][len(full.fibermap):] == sp2.mask['z']))
+        with fits.open(appendfile) as fx:
+            names = [hdu.name for hdu in fx if hdu.header.get('EXTVER') == 3]
+            self.assertEqual(names.count('B_FLUX'), 1)
+
 def test_suite():
     """Allows testing of only this module with the command::
 
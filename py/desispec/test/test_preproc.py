@@ -11,6 +11,8 @@ from pkg_resources import resource_filename
 
 import desispec.scripts.preproc
 from desispec.preproc import preproc, parse_sec_keyword, _clipped_std_bias
+from desispec.preproc import get_calibration_image, set_calibration_cache
+from desispec.preproc import _overscan, _overscan_per_row
 from desispec.preproc import get_amp_ids
 from desispec import io
 
@@ -392,6 +394,70 @@ class TestPreProc(unittest.TestCase):
         img = io.read_image(self.pixfile)
         self.assertEqual(img.pix.shape, (2*self.ny, 2*self.nx))
 
+    def test_preproc_script_ncpu(self):
+        cameras = ['b0', 'r0', 'z0']
+        for camera in cameras:
+            io.write_raw(self.rawfile, self.rawimage, self.header, primary_header = self.primary_header, camera=camera)
+        outdir = os.path.join(self.calibdir, 'preproc')
+        args = ['--infile', self.rawfile, '--cameras', ','.join(cameras),
+                '--outdir', outdir, '--ncpu', '2']
+        desispec.scripts.preproc.main(args)
+        for camera in cameras:
+            outfile = io.findfile('preproc', night=self.header['NIGHT'], expid=self.header['EXPID'],
+                                  camera=camera, outdir=outdir)
+            img = io.read_image(outfile)
+            self.assertEqual(img.meta['CAMERA'], camera)
+            self.assertEqual(img.pix.shape, (2*self.ny, 2*self.nx))
+
+    def test_read_raw_data(self):
+        cameras = ['b0', 'r0', 'z0']
+        for camera in cameras:
+            io.write_raw(self.rawfile, self.rawimage, self.header, primary_header = self.primary_header, camera=camera)
+        rawdata = io.read_raw_data(self.rawfile, cameras + ['b1'], nthreads=2)
+        self.assertEqual(sorted(rawdata.keys()), ['B0', 'R0', 'Z0'])
+        for camera in cameras:
+            rawimage, header, primary_header = rawdata[camera.upper()]
+            self.assertTrue(np.all(rawimage == self.rawimage))
+            self.assertEqual(header['CAMERA'].strip().lower(), camera)
+            self.assertIn('EXPTIME', primary_header)
+            img = io.read_raw(self.rawfile, camera, rawdata=rawdata[camera.upper()])
+            self.assertEqual(img.pix.shape, (2*self.ny, 2*self.nx))
+
+    def test_calibration_cache(self):
+        dark = np.ones((2*self.ny, 2*self.nx))
+        fits.writeto(self.calibfile, dark)
+        primary_header = dict(self.primary_header, EXPTIME=10.0)
+        set_calibration_cache(1024**3)
+        try:
+            image1 = preproc(self.rawimage, self.header, primary_header = primary_header, dark=self.calibfile)
+            image2 = preproc(self.rawimage, self.header, primary_header = primary_header, dark=self.calibfile)
+            self.assertTrue(np.all(image1.pix == image2.pix))
+
+            #- cached images are copies, and a modified file is read again
+            dark1 = get_calibration_image(None, 'DARK', self.calibfile)
+            dark1 *= 2
+            self.assertTrue(np.all(get_calibration_image(None, 'DARK', self.calibfile) == 1))
+            fits.writeto(self.calibfile, 3*dark, overwrite=True)
+            self.assertTrue(np.all(get_calibration_image(None, 'DARK', self.calibfile) == 3))
+            self.assertGreater(len(desispec.preproc._calibration_images), 0)
+        finally:
+            set_calibration_cache(0)
+        #- disabling the cache releases the images
+        self.assertEqual(len(desispec.preproc._calibration_images), 0)
+        get_calibration_image(None, 'DARK', self.calibfile)
+        self.assertEqual(len(desispec.preproc._calibration_images), 0)
+
+    def test_overscan_per_row(self):
+        rng = np.random.RandomState(0)
+        pix = np.round(rng.normal(1000, 3, size=(200, 50))) + rng.uniform(0, 0.3, size=(200, 1))
+        pix[5] = 1000.0     #- no readnoise; clipping fails
+        pix[7, 3] = 1e5     #- outlier
+        overscan, readnoise = _overscan_per_row(pix)
+        for i in range(pix.shape[0]):
+            o, r = _overscan(pix[i])
+            self.assertEqual(overscan[i], o)
+            self.assertEqual(readnoise[i], r)
+
     def test_clipped_std_bias(self):
         '''Compare to www.wolframalpha.com integrals'''
         self.assertAlmostEqual(_clipped_std_bias(1), 0.53956, places=5)
@@ -109,18 +109,18 @@ class TestQA(unittest.TestCase):
         qafrm.qa_data['FLUXCALIB']['METRICS'] = {}
         qafrm.qa_data['FLUXCALIB']['METRICS']['ZP'] = ZPval
         qafrm.qa_data['FLUXCALIB']['METRICS']['RMS_ZP'] = 0.05
+        # Generate frame too (for QA_Exposure), before the QA file that is derived from it
+        frame = self._make_frame(camera=camera, flavor=flavor, night=night, expid=expid)
+        frame_file = findfile('frame', night=night, expid=expid, specprod_dir=self.testDir, camera=camera)
+        _ = write_frame(frame_file, frame)
+        self.files_written.append(frame_file)
+
         # Outfile
         qafile = findfile('qa_data', night=night, expid=expid,
                          specprod_dir=self.testDir, camera=camera)
         # WRITE
         write_qa_frame(qafile, qafrm)
         self.files_written.append(qafile)
-
-        # Generate frame too (for QA_Exposure)
-        frame = self._make_frame(camera=camera, flavor=flavor, night=night, expid=expid)
-        frame_file = findfile('frame', night=night, expid=expid, specprod_dir=self.testDir, camera=camera)
-        _ = write_frame(frame_file, frame)
-        self.files_written.append(frame_file)
         #
         return qafile
 
@@ -196,6 +196,34 @@ class TestQA(unittest.TestCase):
         qafrm2 = load_qa_frame(outfile, frame_meta=frm0.meta)
         assert qafrm2.night == qafrm0.night
 
+    def test_qa_frame_write_store(self):
+        from desispec.io import qastore_from_qafile, read_qa_store
+        night = '20160105'
+        frm0 = self._make_frame(night=night)
+        qafrm0 = QA_Frame(frm0)
+        qafrm0.init_skysub()
+        # The default QA file of the frame goes to the store of the night
+        outfile = findfile('qa_data', night=night, expid=self.expids[0],
+                           specprod_dir=self.testDir, camera='b0')
+        self.files_written.append(outfile)
+        store = qastore_from_qafile(outfile, qafrm0)
+        self.assertEqual(store, findfile('qa_store', night=night))
+        self.files_written.append(store)
+        write_qa_frame(outfile, qafrm0, store=store)
+        mdict = read_qa_store(store)
+        self.assertIn('SKYSUB', mdict[night][str(self.expids[0])]['b0'])
+        os.remove(store)
+        # Not QA written elsewhere
+        otherfile = os.path.join(self.testDir, 'qa-b0-test.yaml')
+        self.files_written.append(otherfile)
+        self.assertIsNone(qastore_from_qafile(otherfile, qafrm0))
+        # A store that cannot be written does not fail the frame QA
+        badstore = os.path.join(self.testDir, 'qa-metrics-bad.sqlite')
+        self.files_written.append(badstore)
+        with open(badstore, 'w') as f:
+            f.write('not a database'*100)
+        write_qa_frame(otherfile, qafrm0, store=badstore)
+        self.assertTrue(os.path.exists(otherfile))
 
     def test_init_qa_exposure(self):
         """Test simple init.
@@ -272,6 +300,76 @@ class TestQA(unittest.TestCase):
         tbl2 = qaprod.get_qa_table('FLUXCALIB', 'RMS_ZP')
         assert len(tbl2) == 8
 
+    def test_make_frameqa(self):
+        self._write_flat_files()  # fiberflats for the sky QA
+        self._write_qaframes()
+        qaprod = QA_Prod(self.testDir)
+        # Up-to-date QA files
+        self.assertEqual(len(qaprod.frameqa_units()), 0)
+        self.assertEqual(len(qaprod.frameqa_units(clobber=True)), 8)
+        # QA files older than their frame
+        qafiles = {}
+        for expid, night in zip(self.expids, self.nights):
+            for camera in self.cameras:
+                frame_file = findfile('frame', night=night, expid=expid, specprod_dir=self.testDir, camera=camera)
+                qafiles[frame_file] = findfile('qa_data', night=night, expid=expid, specprod_dir=self.testDir, camera=camera)
+                mtime = os.path.getmtime(frame_file)-10.
+                os.utime(qafiles[frame_file], (mtime, mtime))
+        units = qaprod.frameqa_units()
+        self.assertEqual(sorted(unit[0] for unit in units), sorted(qafiles))
+        self.assertTrue(all(unit[1] for unit in units))
+        failed = qaprod.make_frameqa(nproc=2)
+        self.assertEqual(failed, [])
+        self.assertEqual(len(qaprod.frameqa_units()), 0)
+        # One frame
+        mtime = os.path.getmtime(frame_file)-10.
+        os.utime(qafiles[frame_file], (mtime, mtime))
+        self.assertEqual([unit[0] for unit in qaprod.frameqa_units()], [frame_file])
+        qaprod.make_frameqa()
+        self.assertEqual(len(qaprod.frameqa_units()), 0)
+
+    def test_qa_store(self):
+        from desispec.io import read_qa_data, write_qa_store, read_qa_store, query_qa_store, convert_qa_yaml
+        self._write_qaframes()
+        night, expid = self.nights[0], self.expids[0]
+        # Frame QA
+        qafile = findfile('qa_data', night=night, expid=expid, specprod_dir=self.testDir, camera='b0')
+        store = os.path.join(self.testDir, 'qa-metrics-frame.sqlite')
+        self.files_written.append(store)
+        write_qa_store(store, read_qa_data(qafile))
+        mdict = read_qa_store(store)
+        self.assertEqual(mdict[night][str(expid)]['flavor'], 'science')
+        self.assertEqual(mdict[night][str(expid)]['b0'], read_qa_data(qafile)[night][expid]['b0'])
+        # Rewrite with new values
+        qadict = read_qa_data(qafile)
+        qadict[night][expid]['b0']['FLUXCALIB']['METRICS']['ZP'] = [25., 1.]
+        write_qa_store(store, qadict)
+        tbl = query_qa_store(store, 'FLUXCALIB', 'ZP')
+        self.assertEqual(len(tbl), 1)
+        self.assertEqual(tbl['ZP'][0], 25.)
+        self.assertEqual(len(query_qa_store(store, 'FLUXCALIB', 'NOTAMETRIC')), 0)
+        # Exposures of a production
+        qaprod = QA_Prod(self.testDir)
+        qaprod.make_frameqa()
+        qaprod.slurp_nights(write_nights=True, remove=False)
+        qaprod.build_data()
+        tbl = qaprod.get_qa_table('FLUXCALIB', 'RMS_ZP', channels=['b'])
+        meta = qaprod.data[night][expid]['meta']
+        qaprod.load_store()
+        self.assertEqual(len(qaprod.qa_store), 2)
+        tbl2 = qaprod.get_qa_table('FLUXCALIB', 'RMS_ZP', channels=['b'])
+        self.assertEqual(len(tbl2), 8)
+        self.assertEqual(sorted(zip(tbl['EXPID'], tbl['CAMERA'])), list(zip(tbl2['EXPID'], tbl2['CAMERA'])))
+        self.assertEqual(list(tbl2['FLAVOR']), ['science']*8)
+        self.assertEqual(len(qaprod.get_qa_table('FLUXCALIB', 'RMS_ZP', nights=[night], channels=['r'])), 0)
+        mdict = read_qa_store(qaprod.qa_store)
+        self.assertEqual(mdict[night][str(expid)]['meta'], meta)
+        # Conversion of the YAML files
+        store2 = os.path.join(self.testDir, 'qa-metrics-test.sqlite')
+        self.files_written.append(store2)
+        convert_qa_yaml(qaprod.qaprod_dir, night, outfile=store2)
+        self.assertEqual(len(query_qa_store(store2, 'SKYSUB', 'NSKY_FIB')), 4)
+
     def test_init_qa_night(self):
         self._write_qaframes()  # Generate a set of science QA frames
         night = self.nights[0]
@@ -6,7 +6,7 @@ import unittest, os
 import numpy as np
 from math import log
 
-from desispec.interpolation import resample_flux
+from desispec.interpolation import resample_flux, resampling_matrix
 
 class TestResample(unittest.TestCase):
     """
@@ -81,6 +81,18 @@ class TestResample(unittest.TestCase):
             self.assertAlmostEqual(ivar_in,ivar_out)
 
 
+    def test_resampling_matrix(self):
+        """Test that the resampling matrix gives the same result as resample_flux"""
+        x = np.sort(np.random.uniform(0, 100, 500))
+        y = np.random.uniform(0, 1, (3,x.size))
+        for xout in (np.linspace(10, 90, 37), np.linspace(-10, 110, 50)) :
+            for extrapolate in (False, True) :
+                m = resampling_matrix(xout, x, extrapolate=extrapolate)
+                self.assertEqual(m.shape, (xout.size, x.size))
+                yout = m.dot(y.T).T
+                for i in range(y.shape[0]) :
+                    self.assertTrue(np.allclose(yout[i], resample_flux(xout, x, y[i], extrapolate=extrapolate)))
+
     # def test_same_bin(self):
     #     '''test reproducibility if two input bins are the same'''
     #     x  = np.array([1, 2, 3, 3, 4, 5])
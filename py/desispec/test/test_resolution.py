@@ -6,7 +6,7 @@ import unittest
 import numpy as np
 import scipy.sparse
 
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 import desispec.resolution
 
 class TestResolution(unittest.TestCase):
@@ -145,6 +145,48 @@ class TestResolution(unittest.TestCase):
         self.assertTrue(data is data2)
         self.assertTrue(offsets is offsets2)
 
+    def test_resolution_stack(self):
+        nspec, ndiag, nwave = 4, 11, 50
+        data = np.random.uniform(size=(nspec, ndiag, nwave))
+        Rstack = ResolutionStack(data)
+        self.assertEqual(len(Rstack), nspec)
+        self.assertEqual(Rstack.shape, (nspec, nwave, nwave))
+        self.assertTrue(Rstack.data is data)
+
+        #- dot and transpose_dot agree with per-spectrum sparse matrices
+        x = np.random.uniform(size=(nspec, nwave))
+        y = Rstack.dot(x)
+        yt = Rstack.transpose_dot(x)
+        y1 = Rstack.dot(x[0])
+        for i in range(nspec):
+            R = Resolution(data[i])
+            self.assertTrue(np.allclose(y[i], R.dot(x[i])))
+            self.assertTrue(np.allclose(yt[i], R.T.dot(x[i])))
+            self.assertTrue(np.allclose(y1[i], R.dot(x[0])))
+            self.assertTrue(np.all(Rstack.to_sparse(i).toarray() == R.toarray()))
+
+        #- indexing
+        self.assertTrue(isinstance(Rstack[1], Resolution))
+        sub = Rstack[1:3]
+        self.assertTrue(isinstance(sub, ResolutionStack))
+        self.assertEqual(len(sub), 2)
+        self.assertTrue(np.allclose(sub.dot(x[1:3]), y[1:3]))
+        sub = Rstack[[0,3]]
+        self.assertTrue(np.allclose(sub.dot(x[[0,3]]), y[[0,3]]))
+
+        #- mean resolution
+        self.assertTrue(np.allclose(Rstack.mean().data, np.mean(data, axis=0)))
+
+        #- bad inputs
+        with self.assertRaises(ValueError):
+            ResolutionStack(data[0])
+        with self.assertRaises(ValueError):
+            ResolutionStack(data[:, 1:])
+        with self.assertRaises(ValueError):
+            Rstack.dot(np.ones(nwave+1))
+        with self.assertRaises(ValueError):
+            Rstack.dot(np.ones((nspec+1, nwave)))
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()           
@@ -0,0 +1,84 @@
+"""
+tests desispec.scatteredlight
+"""
+
+import unittest
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+from desispec.image import Image
+from desispec import scatteredlight
+from desispec.scatteredlight import scattered_light_kernel, convolve_scattered_light, model_scattered_light
+
+
+class _TraceSet(object):
+    """Traces of 500 fibers in 20 bundles, with the x_vs_y method of XYTraceSet"""
+    nspec = 500
+
+    def __init__(self, ny):
+        fibers = np.arange(self.nspec)
+        self.ny = ny
+        self.x0 = 20 + 2.*fibers + 6.*(fibers//25)
+
+    def x_vs_y(self, fiber, y):
+        u = 2.*np.asarray(y)/self.ny-1.
+        return self.x0[fiber]+3.*u-2.*u**2
+
+
+class TestScatteredLight(unittest.TestCase):
+
+    def setUp(self):
+        self.ny = 1000
+        self.xyset = _TraceSet(self.ny)
+        self.nx = int(self.xyset.x0[-1])+30
+        yy = np.arange(self.ny)
+        pix = np.zeros((self.ny, self.nx))
+        for fiber in range(self.xyset.nspec):
+            x = self.xyset.x_vs_y(fiber, yy).astype(int)
+            pix[yy, x] += 100*(1.+0.5*np.sin(yy/50.+fiber))
+        self.pix = pix
+        scatteredlight._kernel_ffts.clear()
+
+    def test_kernel(self):
+        """Test the normalization of the kernel"""
+        kern = scattered_light_kernel('b0')
+        self.assertEqual(kern.shape, (601, 601))
+        self.assertAlmostEqual(np.sum(kern), 1.)
+        kern4 = scattered_light_kernel('b0', downsample=4)
+        self.assertEqual(kern4.shape, (151, 151))
+        self.assertAlmostEqual(np.sum(kern4), 1./16)
+
+    def test_convolve(self):
+        """Test the convolution with a cached kernel transform"""
+        ref = fftconvolve(self.pix, scattered_light_kernel('r3'), mode="same")
+        conv = convolve_scattered_light(self.pix, 'r3')
+        self.assertTrue(np.allclose(conv, ref, rtol=0, atol=1e-10*np.max(ref)))
+        self.assertEqual(len(scatteredlight._kernel_ffts), 1)
+        conv = convolve_scattered_light(self.pix, 'r3')
+        self.assertTrue(np.allclose(conv, ref, rtol=0, atol=1e-10*np.max(ref)))
+        self.assertEqual(len(scatteredlight._kernel_ffts), 1)
+
+        #- convolution of the binned image
+        for downsample, accuracy in [(2, 0.01), (4, 0.03)]:
+            conv = convolve_scattered_light(self.pix, 'r3', downsample=downsample)
+            self.assertEqual(conv.shape, ref.shape)
+            self.assertLess(np.max(np.abs(conv-ref)), accuracy*np.max(ref))
+
+    def test_model(self):
+        """Test the scattered light model of an image"""
+        ivar = np.ones(self.pix.shape)
+        mask = np.zeros(self.pix.shape, dtype=np.int32)
+        mask[100:110, 200:300] = 1
+        image = Image(self.pix+10., ivar, mask=mask, meta={"CAMERA": "z1"}, camera="z1")
+        model = model_scattered_light(image, self.xyset)
+        self.assertEqual(model.shape, self.pix.shape)
+        self.assertTrue(np.all(model >= 0))
+        self.assertGreater(np.max(model), 0)
+        model2 = model_scattered_light(image, self.xyset, downsample=2)
+        self.assertLess(np.max(np.abs(model2-model)), 0.05*np.max(model))
+
+
+#- This runs all test* functions in any TestCase class in this file
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ import warnings
 
 import numpy as np
 import numpy.testing as nt
+from astropy.io import fits
 
 #from astropy.table import Table
 
@@ -129,6 +130,85 @@ class TestSpectra(unittest.TestCase):
         self.verify(comp, self.fmap1)
 
 
+    def test_append(self):
+        """Test appending spectra to an existing file"""
+        spec1 = Spectra(bands=self.bands, wave=self.wave, flux=self.flux,
+            ivar=self.ivar, mask=self.mask, resolution_data=self.res,
+            fibermap=self.fmap1, meta=self.meta, extra=self.extra)
+        spec2 = Spectra(bands=self.bands, wave=self.wave, flux=self.flux,
+            ivar=self.ivar, mask=self.mask, resolution_data=self.res,
+            fibermap=self.fmap2, meta=self.meta, extra=self.extra)
+
+        #- append to a missing file creates it
+        write_spectra(self.fileappend, spec1, append=True)
+        write_spectra(self.fileappend, spec2, append=True)
+
+        comp = read_spectra(self.fileappend)
+        self.assertEqual(comp.num_spectra(), 2*self.nspec)
+        self.verify(comp.select(targets=self.fmap1["TARGETID"]), self.fmap1)
+        self.verify(comp.select(targets=self.fmap2["TARGETID"]), self.fmap2)
+        nt.assert_array_almost_equal(comp.extra["b"]["FOO"][self.nspec:], self.extra["b"]["FOO"])
+        rows = [1, self.nspec - 1, self.nspec, 2*self.nspec - 1]
+        sub = read_spectra(self.fileappend, rows=rows)
+        for band in self.bands:
+            nt.assert_array_equal(sub.flux[band], comp.flux[band][rows])
+            nt.assert_array_equal(sub.mask[band], comp.mask[band][rows])
+
+        #- checksums were updated
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            with fits.open(self.fileappend, checksum=True) as hdus:
+                for hdu in hdus:
+                    hdu.data
+
+        #- HDUs must match
+        spec3 = Spectra(bands=["b", "r"], wave=self.wave, flux=self.flux,
+            ivar=self.ivar, mask=self.mask, resolution_data=self.res,
+            fibermap=self.fmap1, meta=self.meta)
+        with self.assertRaises(ValueError):
+            write_spectra(self.fileappend, spec3, append=True)
+        self.assertEqual(read_spectra(self.fileappend).num_spectra(), 2*self.nspec)
+
+    def test_read_selection(self):
+        """Test reading a subset of spectra, bands and HDUs"""
+        spec = Spectra(bands=self.bands, wave=self.wave, flux=self.flux,
+            ivar=self.ivar, mask=self.mask, resolution_data=self.res,
+            fibermap=self.fmap1, meta=self.meta, extra=self.extra)
+        write_spectra(self.fileio, spec)
+
+        #- targets, fibers and rows are selected in file order
+        targets = self.fmap1["TARGETID"][[3,1]]
+        for comp in (read_spectra(self.fileio, targets=targets),
+                     read_spectra(self.fileio, fibers=self.fmap1["FIBER"][[1,3]]),
+                     read_spectra(self.fileio, rows=[3,1])):
+            self.assertEqual(comp.num_spectra(), 2)
+            nt.assert_array_equal(comp.fibermap, self.fmap1[[1,3]])
+            for band in self.bands:
+                nt.assert_array_almost_equal(comp.flux[band], self.flux[band][[1,3]])
+                nt.assert_array_almost_equal(comp.ivar[band], self.ivar[band][[1,3]])
+                nt.assert_array_equal(comp.mask[band], self.mask[band][[1,3]])
+                nt.assert_array_almost_equal(comp.resolution_data[band], self.res[band][[1,3]])
+                nt.assert_array_almost_equal(comp.extra[band]["FOO"], self.extra[band]["FOO"][[1,3]])
+
+        #- non contiguous rows
+        comp = read_spectra(self.fileio, rows=[0,2,3])
+        for band in self.bands:
+            nt.assert_array_almost_equal(comp.flux[band], self.flux[band][[0,2,3]])
+
+        #- bands and skipped HDUs
+        band = self.bands[1]
+        comp = read_spectra(self.fileio, bands=[band,], skip_hdus=["RESOLUTION", "FOO"])
+        self.assertEqual(comp.bands, [band,])
+        self.assertIsNone(comp.resolution_data)
+        self.assertIsNone(comp.extra)
+        nt.assert_array_almost_equal(comp.flux[band], self.flux[band])
+        nt.assert_array_equal(comp.mask[band], self.mask[band])
+
+        with self.assertRaises(ValueError):
+            read_spectra(self.fileio, skip_hdus=["FLUX"])
+        with self.assertRaises(RuntimeError):
+            read_spectra(self.fileio, targets=[-1])
+
     def test_empty(self):
 
         spec = Spectra(meta=self.meta)
@@ -177,6 +257,57 @@ class TestSpectra(unittest.TestCase):
         nt = comp.select(nights=nights, invert=True)
         self.verify(nt, self.fmap2)
 
+    def test_select_index(self):
+        spec = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar,
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap1,
+            meta=self.meta, extra=self.extra)
+
+        #- lists, arrays and sets select the same rows, in the original order
+        for targets in ([460, 457, 999], np.array([460, 457]), {457, 460}):
+            sel = spec.select(targets=targets)
+            nt.assert_array_equal(sel.fibermap["TARGETID"], [457, 460])
+            nt.assert_array_equal(sel.flux["b"], self.flux["b"][[1, 4]])
+
+        sel = spec.select(targets=[456, 457, 458], fibers=[124, 125, 126])
+        nt.assert_array_equal(sel.fibermap["FIBER"], [124, 125])
+        sel = spec.select(nights=[0, 1], invert=True)
+        nt.assert_array_equal(sel.fibermap["NIGHT"], [2, 3, 4])
+
+        with self.assertRaises(RuntimeError):
+            spec.select(targets=[999])
+
+        #- the index follows in place modifications and reassignment of the fibermap
+        spec.fibermap["TARGETID"][0] = 999
+        sel = spec.select(targets=[999])
+        nt.assert_array_equal(sel.fibermap["FIBER"], [123])
+        spec.fibermap = spec.fibermap[::-1]
+        sel = spec.select(targets=[999])
+        self.assertEqual(len(sel.fibermap), 1)
+
+    def test_update_duplicates(self):
+        spec = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar,
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap1,
+            meta=self.meta, extra=self.extra)
+        other = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar,
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap2,
+            meta=self.meta, extra=self.extra)
+
+        #- updating twice with the same spectra replaces them
+        spec.update(other)
+        spec.update(other)
+        self.assertEqual(spec.num_spectra(), 2 * self.nspec)
+        nt.assert_array_equal(spec.fibermap["TARGETID"],
+            np.concatenate([self.fmap1["TARGETID"], self.fmap2["TARGETID"]]))
+
+        #- duplicate (EXPID, FIBER) in the original spectra
+        spec.fibermap["EXPID"][self.nspec:] = self.fmap1["EXPID"]
+        spec.fibermap["FIBER"][self.nspec:] = self.fmap1["FIBER"]
+        dup = Spectra(bands=self.bands, wave=self.wave, flux=self.flux, ivar=self.ivar,
+            mask=self.mask, resolution_data=self.res, fibermap=self.fmap1,
+            meta=self.meta, extra=self.extra)
+        with self.assertRaises(RuntimeError):
+            spec.update(dup)
+
 
 def test_suite():
     """Allows testing of only this module with the command::
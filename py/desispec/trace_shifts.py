@@ -14,7 +14,6 @@ from numpy.linalg.linalg import LinAlgError
 import astropy.io.fits as pyfits
 from numpy.polynomial.legendre import legval,legfit
 from scipy.signal import fftconvolve
-import numba
 
 import specter.psf
 from desispec.io import read_image
@@ -22,6 +21,7 @@ from desiutil.log import get_logger
 from desispec.linalg import cholesky_solve,cholesky_solve_and_invert
 from desispec.interpolation import resample_flux
 from desispec.qproc.qextract import qproc_boxcar_extraction
+from desispec.kernels import jit
 
 def write_traces_in_psf(input_psf_filename,output_psf_filename,xytraceset) :
     """
@@ -423,7 +423,7 @@ def compute_dy_using_boxcar_extraction(xytraceset, image, fibers, width=7, degyy
     
     return compute_dy_from_spectral_cross_correlations_of_frame(flux=flux, ivar=ivar, wave=wave, xcoef=xcoef, ycoef=ycoef, wavemin=wavemin, wavemax=wavemax, reference_flux = mflux , n_wavelength_bins = degyy+4)
 
-@numba.jit
+@jit('(float64[:,::1],float64[:,::1],float64[::1],float64[::1],int64)')
 def numba_cross_profile(image_flux,image_ivar,x,wave,hw=3) :
     n0=image_flux.shape[0]
     swdx=np.zeros(n0)